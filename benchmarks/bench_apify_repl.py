@@ -0,0 +1,100 @@
+"""
+Round-trip benchmark for ApifyRepl against a local stand-in HTTP server.
+
+The stand-in server implements the /repl/exec, /repl/eval and /repl/batch
+endpoints of an apify device with a CPython namespace. Compares a new
+connection per command, pooled keep-alive connections and batched
+commands.
+
+    python benchmarks/bench_apify_repl.py [number of commands]
+"""
+import contextlib
+import http.client
+import io
+import json
+import os
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from mpy_device.apify_repl import ApifyRepl
+
+
+class ApifyHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+    namespace = dict()
+
+    def log_message(self, *args):
+        pass
+
+    def run(self, mode, command):
+        if mode == 'eval':
+            return eval(command, self.namespace)
+        with contextlib.redirect_stdout(io.StringIO()) as out:
+            exec(command, self.namespace)
+        return out.getvalue()
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(
+            int(self.headers['Content-Length'])).decode())
+        mode = self.path.rsplit('/', 1)[-1]
+        try:
+            if mode == 'batch':
+                result = [self.run(c['mode'], c['command']) for c in body]
+            else:
+                result = self.run(mode, body)
+            status = 200
+        except Exception as e:
+            result, status = str(e), 500
+        content = json.dumps(result).encode()
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+
+class SingleShotApifyRepl(ApifyRepl):
+    """
+    Opens a new connection per command like ApifyRepl did before pooling.
+    """
+    def run_cmd(self, command, mode):
+        connection = http.client.HTTPConnection(self.ip, self.port)
+        connection.request("POST", "/repl/{}".format(mode),
+                           body=json.dumps(command))
+        resp = connection.getresponse().read()
+        connection.close()
+        return self.to_string(json.loads(resp.decode("ascii")))
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    server = ThreadingHTTPServer(('127.0.0.1', 0), ApifyHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    address = '127.0.0.1:{}'.format(server.server_address[1])
+
+    commands = [('eval', '{} * 2'.format(i)) for i in range(count)]
+    runs = (
+        ('new connection', SingleShotApifyRepl(address),
+         lambda dev: [dev.eval(c) for _, c in commands]),
+        ('keep-alive', ApifyRepl(address),
+         lambda dev: [dev.eval(c) for _, c in commands]),
+        ('batch', ApifyRepl(address),
+         lambda dev: dev.batch(commands)),
+    )
+    for name, dev, run in runs:
+        start = time.perf_counter()
+        results = run(dev)
+        duration = time.perf_counter() - start
+        assert results[-1] == str((count - 1) * 2)
+        dev.close()
+        print('{:<16} {:>8.3f}s {:>10.1f} commands/s'
+              .format(name, duration, count / duration))
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,182 @@
+"""
+End-to-end benchmarks against the device emulator.
+
+Runs the tools over the raw REPL of an emulated device (see mpy_emulator)
+with a throttled baud rate and injected latency, so the numbers track the
+number of round trips and transferred bytes rather than the host speed:
+
+- exec: round-trip latency of single commands
+- sync_small: sync of a tree of small files, initial and without changes
+- transfer_large: put_file and get_file of a large file
+- fuse_ls_lR: recursive listing with attributes through MpyFuseOperations
+  (skipped if fusepy or libfuse is missing)
+
+Results can be stored and compared to detect regressions:
+
+    python benchmarks/bench_emulator.py --save baseline
+    python benchmarks/bench_emulator.py --compare baseline
+
+The comparison exits with status 1 if a benchmark is slower than the stored
+result by more than the threshold.
+"""
+import argparse
+import json
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from mpy_device import MpyDevice
+from mpy_emulator import MpyEmulator
+from mpy_sync import sync
+
+RESULTS = os.path.join(os.path.dirname(__file__), 'results')
+
+
+def bench_exec(dev, args):
+    dev.exec('x = 0')
+    times = []
+    for _ in range(args.commands):
+        start = time.perf_counter()
+        dev.exec('x += 1')
+        times.append(time.perf_counter() - start)
+    times.sort()
+    return {'exec_mean': statistics.mean(times),
+            'exec_p50': times[len(times) // 2],
+            'exec_p95': times[int(len(times) * 0.95)]}
+
+
+def bench_sync_small(dev, args):
+    src = tempfile.mkdtemp(prefix='mpy_bench_')
+    try:
+        for d in range(args.dirs):
+            os.makedirs(os.path.join(src, 'dir{}'.format(d)))
+            for f in range(args.files):
+                with open(os.path.join(src, 'dir{}'.format(d),
+                                       'file{}.py'.format(f)), 'w') as fp:
+                    fp.write('value = {}\n'.format('x' * 200))
+        start = time.perf_counter()
+        for _ in sync(src, dev, mode='hash'):
+            pass
+        initial = time.perf_counter() - start
+        start = time.perf_counter()
+        for _ in sync(src, dev, mode='hash'):
+            pass
+        unchanged = time.perf_counter() - start
+    finally:
+        shutil.rmtree(src)
+    return {'sync_small_initial': initial, 'sync_small_unchanged': unchanged}
+
+
+def bench_transfer_large(dev, args):
+    tmp = tempfile.mkdtemp(prefix='mpy_bench_')
+    try:
+        local = os.path.join(tmp, 'large.bin')
+        with open(local, 'wb') as f:
+            f.write(os.urandom(args.size * 1024))
+        start = time.perf_counter()
+        dev.put_file(local, '/large.bin')
+        put = time.perf_counter() - start
+        start = time.perf_counter()
+        dev.get_file('/large.bin', local + '.back')
+        get = time.perf_counter() - start
+    finally:
+        shutil.rmtree(tmp)
+    return {'transfer_large_put': put, 'transfer_large_get': get}
+
+
+def bench_fuse_ls_lR(dev, args):
+    try:
+        from mpy_fuse import MpyFuseOperations
+    except (ImportError, OSError):
+        return {}
+    dev.exec('import os')
+    for d in range(args.dirs):
+        dev.exec('os.mkdir("/tree{0}")\n'
+                 'for i in range({1}):\n'
+                 '    open("/tree{0}/f%d" % i, "w").close()'
+                 .format(d, args.files))
+    start = time.perf_counter()
+    ops = MpyFuseOperations(dev, cache_ttl=0)
+    pending = ['/']
+    while pending:
+        path = pending.pop()
+        for name in ops('readdir', path, None):
+            if name in ('.', '..'):
+                continue
+            child = path.rstrip('/') + '/' + name
+            if ops('getattr', child)['st_mode'] & 0o40000:
+                pending.append(child)
+    return {'fuse_ls_lR': time.perf_counter() - start}
+
+
+BENCHMARKS = (bench_exec, bench_sync_small, bench_transfer_large,
+              bench_fuse_ls_lR)
+
+
+def run(args):
+    results = dict()
+    for benchmark in BENCHMARKS:
+        with MpyEmulator(baudrate=args.baudrate,
+                         latency=args.latency) as emulator:
+            with MpyDevice(emulator.port) as dev:
+                results.update(benchmark(dev, args))
+    return results
+
+
+def compare(results, baseline, threshold):
+    """
+    :return: names of the benchmarks slower than the baseline by more than
+     the threshold
+    """
+    regressions = []
+    for name, value in sorted(results.items()):
+        base = baseline.get(name)
+        if base is None:
+            print('{:24} {:9.4f}s'.format(name, value))
+            continue
+        change = (value - base) / base if base else 0.0
+        regressed = change > threshold
+        if regressed:
+            regressions.append(name)
+        print('{:24} {:9.4f}s  baseline {:9.4f}s  {:+7.1%}{}'.format(
+            name, value, base, change, '  REGRESSION' if regressed else ''))
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--baudrate', type=int, default=115200)
+    parser.add_argument('--latency', type=float, default=0.002)
+    parser.add_argument('--commands', type=int, default=200,
+                        help='Commands of the exec benchmark')
+    parser.add_argument('--dirs', type=int, default=4)
+    parser.add_argument('--files', type=int, default=8,
+                        help='Files per directory')
+    parser.add_argument('--size', type=int, default=64,
+                        help='Size of the large file in KiB')
+    parser.add_argument('--save', metavar='NAME',
+                        help='Store the results as benchmarks/results/NAME.json')
+    parser.add_argument('--compare', metavar='NAME',
+                        help='Compare with benchmarks/results/NAME.json')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='Relative slowdown reported as regression')
+    args = parser.parse_args()
+
+    results = run(args)
+    baseline = dict()
+    if args.compare:
+        with open(os.path.join(RESULTS, args.compare + '.json')) as f:
+            baseline = json.load(f)['results']
+    regressions = compare(results, baseline, args.threshold)
+    if args.save:
+        os.makedirs(RESULTS, exist_ok=True)
+        with open(os.path.join(RESULTS, args.save + '.json'), 'w') as f:
+            json.dump({'settings': {k: v for k, v in vars(args).items()
+                                    if k not in ('save', 'compare')},
+                       'results': results}, f, indent=2, sort_keys=True)
+    sys.exit(1 if regressions else 0)
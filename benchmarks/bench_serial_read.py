@@ -0,0 +1,79 @@
+"""
+Throughput benchmark for the SerialRepl frame reader.
+
+Replays a large exec-reply through an in-memory serial port and compares the
+buffered frame reader against byte-at-a-time polling.
+
+    python benchmarks/bench_serial_read.py [payload size in KiB]
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from mpy_device.serial_repl import SerialRepl
+
+
+class LoopbackSerial(object):
+    """
+    In-memory stand-in for serial.Serial which delivers a fixed reply
+    in pieces of at most `chunk` bytes, like a UART fifo would.
+    """
+    def __init__(self, data, chunk=64):
+        self.data = data
+        self.pos = 0
+        self.chunk = chunk
+
+    @property
+    def in_waiting(self):
+        return min(self.chunk, len(self.data) - self.pos)
+
+    def read(self, size=1):
+        data = self.data[self.pos:self.pos + size]
+        self.pos += len(data)
+        return data
+
+    def write(self, data):
+        return len(data)
+
+
+def legacy_reader(port):
+    def read_until(until):
+        buf = b''
+        while buf[-len(until):] != until.encode():
+            buf += port.read(1)
+        return buf[:-len(until)].decode('utf8')
+    return read_until
+
+
+def buffered_reader(port):
+    repl = SerialRepl.__new__(SerialRepl)
+    repl.dev = 'loopback'
+    repl.timeout = 1
+    repl.serial = port
+    repl.buffer = bytearray()
+    return repl.read_until
+
+
+def measure(reader, payload):
+    read_until = reader(LoopbackSerial(b'OK' + payload + b'\x04\x04'))
+    start = time.perf_counter()
+    read_until('OK')
+    read_until('\x04')
+    read_until('\x04')
+    return time.perf_counter() - start
+
+
+def main():
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 64
+    payload = b'0123456789abcde\n' * (size * 64)
+    for name, reader in (('byte-at-a-time', legacy_reader),
+                         ('buffered', buffered_reader)):
+        duration = measure(reader, payload)
+        print('{:<16} {:>8.3f}s {:>10.1f} KiB/s'
+              .format(name, duration, size / duration))
+
+
+if __name__ == '__main__':
+    main()
@@ -3,15 +3,100 @@ import argparse
 mpy_sync_parser = argparse.ArgumentParser(
     description="Synchronizes a local folder with the device file system")
 mpy_sync_parser.add_argument("src", help="Local source code directory")
-mpy_sync_parser.add_argument("dest", help="Micropython device mountpoint")
+mpy_sync_parser.add_argument("dest", help="Micropython device mountpoint "
+                                         "or device with --device")
+mpy_sync_parser.add_argument("--hash", action="store_true",
+                             help="Detect changes by content instead of mtime")
+mpy_sync_parser.add_argument("-d", "--device", action="store_true",
+                             help="Synchronize directly with the device")
+mpy_sync_parser.add_argument("-b", "--board", metavar="DEVICE",
+                             help="Device mounted at dest, files unknown to "
+                                  "the --hash manifest are hashed on it "
+                                  "(e.g. through mpy_daemon)")
+mpy_sync_parser.add_argument("--delta", action="store_true",
+                             help="Transfer only changed blocks of files "
+                                  "(requires --device)")
+mpy_sync_parser.add_argument("-z", "--compress", action="store_true",
+                             help="Compress uploads (requires --device)")
+mpy_sync_parser.add_argument("-c", "--compile", action="store_true",
+                             help="Upload .py files precompiled as .mpy")
+mpy_sync_parser.add_argument("--mpy-cross", default="mpy-cross",
+                             help="mpy-cross executable used by --compile")
+mpy_sync_parser.add_argument("--metrics", metavar="FILE",
+                             help="Write metrics to FILE after the sync, "
+                                  "in Prometheus format if it ends with .prom")
+mpy_sync_parser.add_argument("-w", "--watch", action="store_true",
+                             help="Keep synchronizing changes until "
+                                  "interrupted")
+mpy_sync_parser.add_argument("--debounce", type=float, default=0.05,
+                             help="Seconds without changes before a watched "
+                                  "burst of changes is synchronized")
+mpy_sync_parser.add_argument("--run", metavar="SCRIPT",
+                             help="With --watch, run SCRIPT on the device and "
+                                  "restart it after every change "
+                                  "(requires --device)")
 
 mpy_run_parser = argparse.ArgumentParser(
     description="Runs a script on the device")
 mpy_run_parser.add_argument("device", help="Micropython Device")
 mpy_run_parser.add_argument("script", help=".py-Script to run")
 mpy_run_parser.add_argument("-s", "--sync_path", help="Synchronization path")
+mpy_run_parser.add_argument("-l", "--local", action="store_true",
+                            help="Run the local script from RAM without "
+                                 "writing it to the device")
+mpy_run_parser.add_argument("-b", "--bundle", action="store_true",
+                            help="With --local, send the local modules "
+                                 "imported by the script along")
 
 mpy_fuse_parser = argparse.ArgumentParser(
     description="Mounts a device file system")
 mpy_fuse_parser.add_argument("device", help="Micropython Device")
 mpy_fuse_parser.add_argument("mntpoint", help="Mounting point")
+mpy_fuse_parser.add_argument("-t", "--threaded", action="store_true",
+                             help="Handle file system calls concurrently")
+mpy_fuse_parser.add_argument("-z", "--compress", action="store_true",
+                             help="Compress file writes")
+mpy_fuse_parser.add_argument("--metrics", metavar="FILE",
+                             help="Write metrics periodically to FILE, "
+                                  "in Prometheus format if it ends with .prom")
+mpy_fuse_parser.add_argument("--metrics-interval", type=float, default=10.0,
+                             help="Seconds between metric dumps")
+
+mpy_multi_parser = argparse.ArgumentParser(
+    description="Synchronizes and runs a script on many devices in parallel")
+mpy_multi_parser.add_argument("script", help=".py-Script to run")
+mpy_multi_parser.add_argument("devices", nargs="+",
+                              help="Micropython Devices or glob patterns "
+                                   "e.g. /dev/ttyUSB*")
+mpy_multi_parser.add_argument("-s", "--sync_path",
+                              help="Synchronization path")
+mpy_multi_parser.add_argument("-j", "--jobs", type=int,
+                              help="Number of devices handled in parallel")
+mpy_multi_parser.add_argument("-c", "--compile", action="store_true",
+                              help="Upload .py files precompiled as .mpy")
+mpy_multi_parser.add_argument("--mpy-cross", default="mpy-cross",
+                              help="mpy-cross executable used by --compile")
+
+mpy_daemon_parser = argparse.ArgumentParser(
+    description="Keeps devices connected for the other tools, which use it "
+                "if MPY_DAEMON_SOCKET is set")
+mpy_daemon_parser.add_argument("-S", "--socket",
+                               help="Unix socket to listen on, defaults to "
+                                    "mpy_daemon-<uid>.sock in the temporary "
+                                    "directory")
+
+mpy_emulator_parser = argparse.ArgumentParser(
+    description="Emulates a micropython device on a pseudo-terminal")
+mpy_emulator_parser.add_argument("root", nargs="?",
+                                 help="Directory used as device file system, "
+                                      "defaults to a temporary directory")
+mpy_emulator_parser.add_argument("-b", "--baudrate", type=int,
+                                 help="Throttle the transfer to the baud rate")
+mpy_emulator_parser.add_argument("-l", "--latency", type=float, default=0.0,
+                                 help="Seconds added to every command")
+mpy_emulator_parser.add_argument("--max-baudrate", type=int,
+                                 help="Fastest REPL UART rate which transfers "
+                                      "correctly")
+mpy_emulator_parser.add_argument("--no-raw-paste", action="store_true",
+                                 help="Emulate firmware without raw-paste "
+                                      "mode")
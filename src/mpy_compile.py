@@ -0,0 +1,140 @@
+"""
+Module to precompile python sources to micropython bytecode (.mpy) with a
+local mpy-cross.
+"""
+import hashlib
+import os
+import shutil
+import subprocess
+import threading
+from pathlib import Path
+
+
+class MpyCompileError(Exception):
+    pass
+
+
+class MpyCompiler(object):
+    """
+    mpy-cross wrapper with a cache of compiled outputs.
+
+    Compiled files are cached by the digest of the source, the source name,
+    the compiler version and the target architecture. The architecture and
+    bytecode version can be detected from a connected board.
+
+.. code-block:: python
+
+        compiler = MpyCompiler()
+        with MpyDevice('/dev/tty.SLAB_USBtoUART') as dev:
+            compiler.detect(dev)
+            for f in sync('src/', dev, compiler=compiler):
+                print(f)
+
+    """
+    # architectures in the order of sys.implementation._mpy
+    ARCHITECTURES = (None, 'x86', 'x64', 'armv6', 'armv6m', 'armv7m',
+                     'armv7em', 'armv7emsp', 'armv7emdp', 'xtensa',
+                     'xtensawin', 'rv32imc')
+    BOARD_ARCHITECTURES = (('ESP8266', 'xtensa'),
+                           ('ESP32', 'xtensawin'),
+                           ('RP2040', 'armv6m'),
+                           ('PYBv1', 'armv7emsp'))
+    DEFAULT_CACHE_DIR = Path('~/.cache/mpy_compile')
+
+    def __init__(self, executable='mpy-cross', march=None, cache_dir=None):
+        self.executable = executable
+        self.march = march
+        self.mpy_version = None
+        self.cache_dir = Path(cache_dir or self.DEFAULT_CACHE_DIR).expanduser()
+        self.lock = threading.Lock()
+        self._version = None
+
+    def __repr__(self):
+        return 'MpyCompiler({}, march={}, mpy_version={})'\
+            .format(self.executable, self.march, self.mpy_version)
+
+    @property
+    def version(self):
+        """
+        :return: version string of mpy-cross
+        """
+        if self._version is None:
+            self._version = self.run('--version').strip()
+        return self._version
+
+    def run(self, *args):
+        if shutil.which(self.executable) is None:
+            raise MpyCompileError('{} not found'.format(self.executable))
+        proc = subprocess.run([self.executable] + list(args),
+                              stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        if proc.returncode != 0:
+            raise MpyCompileError(proc.stderr.decode('utf-8', 'replace'))
+        return proc.stdout.decode('utf-8', 'replace')
+
+    def detect(self, device):
+        """
+        Detects the bytecode version and architecture of a board from
+        sys.implementation._mpy or, for older firmware, from the board type.
+
+        :param device: connected MpyDevice
+        """
+        device.exec('import sys')
+        ret = device.eval('getattr(sys.implementation, "_mpy", None)')
+        if ret.isdigit():
+            flags = int(ret)
+            self.mpy_version = flags & 0xff
+            arch = (flags >> 10) & 0x0f
+            if arch < len(self.ARCHITECTURES):
+                self.march = self.ARCHITECTURES[arch]
+            return
+
+        board_type = getattr(device, 'board_type', None) or ''
+        for name, arch in self.BOARD_ARCHITECTURES:
+            if name in board_type:
+                self.march = arch
+
+    def key(self, source_digest, name):
+        """
+        :param source_digest: sha256 hex digest of the source
+        :param name: source name stored in the bytecode
+        :return: key of the compiled output
+        """
+        digest = hashlib.sha256(source_digest.encode())
+        for part in (name, self.version, str(self.march),
+                     str(self.mpy_version)):
+            digest.update(b'\0' + part.encode())
+        return digest.hexdigest()
+
+    def compile(self, f_src, name):
+        """
+        Compiles a source file or returns the cached output.
+
+        :param f_src: path of the .py file
+        :param name: source name stored in the bytecode, e.g. the path
+         relative to the synchronized folder
+        :raises: MpyCompileError: if mpy-cross fails or generates an
+         incompatible bytecode version
+        :return: path of the .mpy file
+        """
+        with open(str(f_src), 'rb') as f:
+            source = f.read()
+        key = self.key(hashlib.sha256(source).hexdigest(), str(name))
+        output = self.cache_dir / (key + '.mpy')
+        with self.lock:
+            if not output.exists():
+                self.cache_dir.mkdir(parents=True, exist_ok=True)
+                tmp = output.with_suffix('.tmp{}-{}'.format(
+                    os.getpid(), threading.get_ident()))
+                args = ['-s', str(name), '-o', str(tmp)]
+                if self.march:
+                    args.append('-march={}'.format(self.march))
+                self.run(*(args + [str(f_src)]))
+                os.replace(str(tmp), str(output))
+
+        with output.open('rb') as f:
+            header = f.read(2)
+        if self.mpy_version is not None and header[1] != self.mpy_version:
+            raise MpyCompileError(
+                '{} generates bytecode version {}, the board expects {}'
+                .format(self.version, header[1], self.mpy_version))
+        return output
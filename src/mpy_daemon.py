@@ -0,0 +1,236 @@
+"""
+Module to keep micropython devices connected in a local session daemon.
+
+The daemon owns one device connection per port and keeps it in raw REPL
+mode. Clients connect over a Unix socket with DaemonDevice, which is used
+by MpyDevice if the environment variable MPY_DAEMON_SOCKET is set.
+"""
+import errno
+import json
+import os
+import socket
+import socketserver
+import stat
+import sys
+import threading
+from collections import defaultdict
+
+from mpy_device import MpyDevice, MpyDeviceError
+from mpy_device.daemon_device import DEFAULT_SOCKET, decode, encode
+
+
+class ClientDisconnected(ConnectionError):
+    """
+    Raised if the output of a command cannot be sent to the client.
+    """
+
+
+class StreamOutput(object):
+    """
+    File-like object which forwards the device output to the client.
+    """
+    def __init__(self, handler):
+        self.handler = handler
+
+    def write(self, s):
+        if s:
+            try:
+                self.handler.send({'output': s})
+            except ConnectionError as e:
+                raise ClientDisconnected(str(e))
+        return len(s)
+
+    def flush(self):
+        pass
+
+
+class SessionHandler(socketserver.StreamRequestHandler):
+    """
+    Handles the requests of one client connection in its own thread.
+    """
+    def send(self, message):
+        self.wfile.write(json.dumps(message).encode() + b'\n')
+        self.wfile.flush()
+
+    def handle(self):
+        daemon = self.server.mpy_daemon
+        acquired = defaultdict(int)
+        try:
+            for line in self.rfile:
+                request = json.loads(line.decode())
+                name = request['device']
+                method = request['method']
+                lock = daemon.lock(name)
+                if method == 'acquire':
+                    lock.acquire()
+                    acquired[name] += 1
+                    self.send({'result': None})
+                elif method == 'release':
+                    if acquired[name]:
+                        lock.release()
+                        acquired[name] -= 1
+                    self.send({'result': None})
+                else:
+                    with lock:
+                        response = daemon.call(name, method, request, self)
+                    if response is None:
+                        # the client has gone
+                        return
+                    self.send(response)
+        finally:
+            for name, count in acquired.items():
+                for _ in range(count):
+                    daemon.lock(name).release()
+
+
+class UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class MpyDaemon(object):
+    """
+    micropython session daemon
+
+.. code-block:: python
+
+        daemon = MpyDaemon()
+        daemon.serve_forever()
+
+    """
+    METHODS = ('exec', 'eval', 'execfile', 'stream', 'put_file', 'get_file',
+               'put_file_delta', 'hash_files', 'hash_blocks', 'unique_id')
+
+    def __init__(self, socket_path=None):
+        self.socket_path = socket_path or DEFAULT_SOCKET
+        self.devices = dict()
+        self.locks = dict()
+        self.devices_lock = threading.Lock()
+        self.server = None
+
+    def __repr__(self):
+        return 'MpyDaemon({}, devices={})'\
+            .format(self.socket_path, list(self.devices))
+
+    def lock(self, name):
+        with self.devices_lock:
+            return self.locks.setdefault(name, threading.RLock())
+
+    def device(self, name):
+        """
+        :param name: device name
+        :return: connected device in raw REPL mode, opened on first use
+        """
+        if name not in self.devices:
+            dev = MpyDevice(name, daemon=False)
+            dev.enter_raw_repl()
+            self.devices[name] = dev
+        return self.devices[name]
+
+    def call(self, name, method, request, handler):
+        """
+        Executes a request, the device lock must be held.
+
+        :return: response message, None if the client disconnected
+        """
+        if method not in self.METHODS:
+            return {'error': 'Unknown method {}'.format(method)}
+        args = [decode(a) for a in request.get('args', [])]
+        kwargs = {k: decode(v) for k, v in request.get('kwargs', {}).items()}
+        if method in ('exec', 'eval', 'execfile'):
+            kwargs['output'] = None
+            if request.get('output'):
+                kwargs['output'] = StreamOutput(handler)
+        try:
+            if method == 'stream':
+                # forwards the output without collecting it
+                output = StreamOutput(handler)
+                chunks = self.device(name).stream(*args)
+                try:
+                    for text in chunks:
+                        output.write(text)
+                finally:
+                    # interrupts the command if the client has gone
+                    chunks.close()
+                result = None
+            else:
+                result = getattr(self.device(name), method)(*args, **kwargs)
+        except ClientDisconnected:
+            # the device is fine, only this client is dropped
+            return None
+        except MpyDeviceError as e:
+            return {'error': str(e)}
+        except Exception as e:
+            # connection problems, reconnect on the next request
+            self.disconnect(name)
+            return {'error': '{}: {}'.format(e.__class__.__name__, e)}
+        return {'result': encode(result)}
+
+    def disconnect(self, name):
+        dev = self.devices.pop(name, None)
+        if dev is not None:
+            try:
+                dev.close()
+            except Exception:
+                pass
+
+    def serve_forever(self):
+        """
+        Listens for clients until shutdown() is called.
+
+        :raises: OSError: if another daemon listens on the socket
+        """
+        self.remove_stale_socket()
+        # only the owner may connect and run commands on the devices
+        umask = os.umask(0o077)
+        try:
+            self.server = UnixServer(self.socket_path, SessionHandler)
+        finally:
+            os.umask(umask)
+        self.server.mpy_daemon = self
+        try:
+            self.server.serve_forever()
+        finally:
+            self.server.server_close()
+            os.unlink(self.socket_path)
+            for name in list(self.devices):
+                self.disconnect(name)
+
+    def remove_stale_socket(self):
+        """
+        Removes the socket file left behind by a daemon which did not shut
+        down cleanly.
+
+        :raises: OSError: if a daemon still accepts connections on it
+        """
+        try:
+            mode = os.stat(self.socket_path).st_mode
+        except FileNotFoundError:
+            return
+        if not stat.S_ISSOCK(mode):
+            return
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(self.socket_path)
+        except (ConnectionRefusedError, FileNotFoundError):
+            os.unlink(self.socket_path)
+            return
+        finally:
+            probe.close()
+        raise OSError(errno.EADDRINUSE, 'Another mpy_daemon listens on {}'
+                      .format(self.socket_path))
+
+    def shutdown(self):
+        self.server.shutdown()
+
+
+if __name__ == '__main__':
+    from cli import mpy_daemon_parser
+    args = mpy_daemon_parser.parse_args()
+
+    daemon = MpyDaemon(args.socket)
+    try:
+        daemon.remove_stale_socket()
+    except OSError as e:
+        sys.exit(e.strerror)
+    print('Listening on {}'.format(daemon.socket_path))
+    daemon.serve_forever()
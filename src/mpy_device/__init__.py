@@ -1,6 +1,13 @@
+import os
+
+from .agent import DeviceAgent
 from .apify_repl import ApifyRepl
+from .async_device import AsyncApifyRepl, AsyncSerialRepl
 from .serial_repl import SerialRepl
-from .base_device import MpyDeviceError
+from .daemon_device import DaemonDevice
+from .base_device import MpyBatchError, MpyDeviceError
+from .bundle import ScriptBundle
+from .metrics import METRICS, Metrics
 
 
 class MpyDevice(object):
@@ -16,9 +23,39 @@ class MpyDevice(object):
             freq = dev.eval('machine.freq()')
             dev.execfile('main.py')
 
+    If the environment variable MPY_DAEMON_SOCKET is set, the device is
+    accessed through the mpy_daemon listening on this socket. If
+    MPY_BAUDRATE_UPGRADE is set, serial devices are switched to a faster
+    baud rate (see SerialRepl.upgrade_baudrate).
     """
 
-    def __new__(cls, dev):
+    def __new__(cls, dev, daemon=None):
+        if daemon is None:
+            daemon = os.environ.get('MPY_DAEMON_SOCKET')
+        if daemon:
+            return DaemonDevice(dev, socket_path=daemon)
         if ":" in dev:
             return ApifyRepl(dev)
-        return SerialRepl(dev)
+        return SerialRepl(dev, upgrade=bool(
+            os.environ.get('MPY_BAUDRATE_UPGRADE')))
+
+
+class AsyncMpyDevice(object):
+    """
+    asyncio micropython board interface
+
+    Counterpart of MpyDevice with awaitable commands, which allows to drive
+    many devices from one event loop.
+.. code-block:: python
+
+        async with AsyncMpyDevice('/dev/ttyUSB0') as dev:
+            await dev.exec('import machine')
+            freq = await dev.eval('machine.freq()')
+            await dev.execfile('main.py', output=sys.stdout, timeout=60)
+
+    """
+
+    def __new__(cls, dev, timeout=None):
+        if ":" in dev:
+            return AsyncApifyRepl(dev, timeout=timeout)
+        return AsyncSerialRepl(dev, timeout=timeout)
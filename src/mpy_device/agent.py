@@ -0,0 +1,164 @@
+import hashlib
+import json
+
+from .base_device import MpyDeviceError
+
+AGENT_SOURCE = '''\
+import os
+try:
+    import json
+except ImportError:
+    import ujson as json
+
+_listing = None
+
+
+def out(value):
+    print(json.dumps(value))
+
+
+def stat(path):
+    out(os.stat(path))
+
+
+def statvfs(path):
+    out(os.statvfs(path))
+
+
+def opendir(path, count):
+    global _listing
+    _listing = (path.rstrip('/') + '/', os.ilistdir(path))
+    readdir(count)
+
+
+def readdir(count):
+    global _listing
+    prefix, listing = _listing
+    entries = []
+    for entry in listing:
+        entries.append((entry[0],) + tuple(os.stat(prefix + entry[0])))
+        if len(entries) == count:
+            break
+    if len(entries) < count:
+        _listing = None
+    out(entries)
+
+
+def closedir():
+    global _listing
+    _listing = None
+'''
+
+
+class DeviceAgent(object):
+    """
+    Helper module on the device which answers with JSON encoded values
+
+    The module is stored as /lib/_mpy_agent.py on the device and replaced
+    if its version, the hash of its source, differs from the host. mpy_fuse
+    hides it from directory listings and mpy_sync never copies or deletes
+    it.
+.. code-block:: python
+
+        with MpyDevice('/dev/ttyUSB0') as dev:
+            agent = DeviceAgent(dev)
+            mode, *_ = agent.call('stat', "/it's here.py")
+            freq = agent.eval('machine.freq()')
+
+    """
+    MODULE = '_mpy_agent'
+    DIRECTORY = '/lib'
+    PATH = DIRECTORY + '/' + MODULE + '.py'
+    # location of older versions, which shadows /lib in sys.path
+    LEGACY_PATH = '/' + MODULE + '.py'
+    VERSION = hashlib.sha256(AGENT_SOURCE.encode()).hexdigest()[:12]
+
+    def __init__(self, device):
+        self.device = device
+        self.installed = False
+
+    def __repr__(self):
+        return 'DeviceAgent({}, {})'.format(self.device, self.VERSION)
+
+    def source(self):
+        return "VERSION = '{}'\n{}".format(self.VERSION, AGENT_SOURCE)
+
+    def version(self):
+        """
+        :return: version of the agent installed on the device or None
+        """
+        try:
+            self.device.exec('import {}'.format(self.MODULE))
+        except MpyDeviceError:
+            return None
+        return self.device.eval('getattr({}, "VERSION", None)'
+                                .format(self.MODULE))
+
+    def install(self):
+        """
+        Uploads the agent unless the same version is already on the device
+        and imports it. Does nothing after the first call.
+        """
+        if self.installed:
+            return
+        if self.version() != self.VERSION:
+            self.device.exec('import os\n'
+                             'try:\n'
+                             '    os.remove({!r})\n'
+                             'except OSError:\n'
+                             '    pass\n'
+                             'try:\n'
+                             '    os.mkdir({!r})\n'
+                             'except OSError:\n'
+                             '    pass\n'
+                             '_transfer = open({!r}, "wb")'
+                             .format(self.LEGACY_PATH, self.DIRECTORY,
+                                     self.PATH))
+            try:
+                self.device.write_chunks('_transfer', self.source().encode())
+            finally:
+                self.device.exec('_transfer.close()')
+            self.device.exec('import sys\n'
+                             'sys.modules.pop("{0}", None)\n'
+                             'import {0}'.format(self.MODULE))
+        self.installed = True
+
+    @staticmethod
+    def decode(ret):
+        """
+        :param ret: output of a command, the last line holds the result
+        :raises: MpyDeviceError: if the result is not valid JSON
+        :return: decoded value, None without output
+        """
+        lines = ret.strip().splitlines()
+        if not lines:
+            return None
+        try:
+            return json.loads(lines[-1])
+        except ValueError:
+            raise MpyDeviceError('Cannot decode agent result {!r}'
+                                 .format(ret))
+
+    def call(self, function, *args):
+        """
+        Calls a function of the agent.
+
+        :param function: name of the agent function
+        :param args: arguments, passed by their repr
+        :raises: MpyDeviceError: if the function raises an Exception
+        :return: decoded return value
+        """
+        self.install()
+        return self.decode(self.device.exec('{}.{}({})'.format(
+            self.MODULE, function, ', '.join(repr(a) for a in args))))
+
+    def eval(self, expression):
+        """
+        Evaluates an python expression on the device.
+
+        :param expression: Python expression with a JSON serializable value
+        :return: decoded value, tuples are decoded as lists
+        """
+        self.install()
+        return self.decode(self.device.exec('{}.out({})'.format(
+            self.MODULE, expression)))
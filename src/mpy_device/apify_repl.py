@@ -1,15 +1,40 @@
 import json
 import http.client
+import queue
+import socket
+import time
 
 
-from .base_device import BaseDevice
+from .base_device import BaseDevice, MpyBatchError, MpyDeviceError
+from .metrics import METRICS
 
 
 class ApifyRepl(BaseDevice):
-    def __init__(self, ip_with_port):
+    """
+    micropython board interface over the HTTP API of an apify device
+
+    Connections are kept alive and pooled, so consecutive commands share one
+    TCP connection. batch() sends several commands in one request.
+.. code-block:: python
+
+        with MpyDevice('192.168.4.1:80') as dev:
+            freq, _ = dev.batch([('eval', 'machine.freq()'),
+                                 ('exec', 'machine.idle()')])
+
+    """
+    DEFAULT_TIMEOUT = 10
+    POOL_SIZE = 4
+
+    def __init__(self, ip_with_port, compress=False, timeout=None,
+                 verbose=False):
+        super().__init__(compress=compress)
         ip, port = ip_with_port.split(":")
         self.ip = ip
         self.port = port
+        self.timeout = timeout or ApifyRepl.DEFAULT_TIMEOUT
+        self.verbose = verbose
+        self.pool = queue.LifoQueue(maxsize=ApifyRepl.POOL_SIZE)
+        self.batch_supported = True
 
     def connect(self):
         pass
@@ -21,20 +46,131 @@ class ApifyRepl(BaseDevice):
         pass
 
     def close(self):
-        pass
+        while not self.pool.empty():
+            self.pool.get_nowait().close()
 
-    def run_cmd(self, command, mode):
-        print("({}) {}".format(mode, command))
-        connection = http.client.HTTPConnection(self.ip, self.port)
-        connection.request("POST", "/repl/{}".format(mode),
-                                body=json.dumps(command))
-        resp = connection.getresponse().read()
-        connection.close()
-        v = json.loads(resp.decode("ascii"))
-        if isinstance(v, list):
-            return str(tuple(v))
+    def acquire_connection(self):
+        """
+        :return: tuple of a connection and whether it was reused from the
+         pool
+        """
+        try:
+            return self.pool.get_nowait(), True
+        except queue.Empty:
+            connection = http.client.HTTPConnection(self.ip, self.port,
+                                                    timeout=self.timeout)
+            connection.connect()
+            # headers and body are sent separately, do not wait for acks
+            connection.sock.setsockopt(socket.IPPROTO_TCP,
+                                       socket.TCP_NODELAY, 1)
+            return connection, False
+
+    def release_connection(self, connection):
+        try:
+            self.pool.put_nowait(connection)
+        except queue.Full:
+            connection.close()
+
+    def post(self, path, body):
+        """
+        Posts a JSON body over a pooled keep-alive connection.
+        A request is only retried if a pooled connection failed before any
+        response arrived, i.e. the device closed the idle connection. Once
+        a response started or a new connection failed, the command may have
+        run on the device and the error is raised.
+
+        :param path: request path
+        :param body: JSON serializable request body
+        :raises: MpyDeviceError: if the device responds with an error status
+        :return: tuple of HTTP status and decoded JSON response
+        """
+        data = json.dumps(body).encode('utf-8')
+        headers = {'Connection': 'keep-alive',
+                   'Content-Type': 'application/json'}
+        self.round_trips += 1
+        start = time.perf_counter()
+        while True:
+            connection, reused = self.acquire_connection()
+            try:
+                connection.request("POST", path, body=data, headers=headers)
+                response = connection.getresponse()
+            except ConnectionError:
+                # nothing of the response was received
+                connection.close()
+                if reused:
+                    continue
+                raise
+            except http.client.HTTPException:
+                connection.close()
+                raise
+            try:
+                content = response.read()
+            except (http.client.HTTPException, ConnectionError):
+                connection.close()
+                raise
+            if response.will_close:
+                connection.close()
+            else:
+                self.release_connection(connection)
+            break
+
+        if METRICS.enabled:
+            METRICS.observe('mpy_command_seconds', time.perf_counter() - start,
+                            transport='http')
+            METRICS.count('mpy_bytes_sent_total', len(data), transport='http')
+            METRICS.count('mpy_bytes_received_total', len(content),
+                          transport='http')
+
+        if response.status == 404:
+            return response.status, None
+        if response.status != 200:
+            raise MpyDeviceError(content.decode('utf-8', 'replace'))
+        return response.status, json.loads(content.decode('utf-8'))
+
+    @staticmethod
+    def to_string(value):
+        if isinstance(value, list):
+            return str(tuple(value))
         else:
-            return str(v)
+            return str(value)
+
+    def run_cmd(self, command, mode):
+        if self.verbose:
+            print("({}) {}".format(mode, command))
+        status, value = self.post("/repl/{}".format(mode), command)
+        if status == 404:
+            raise MpyDeviceError('Unknown REPL mode {}'.format(mode))
+        return self.to_string(value)
+
+    def batch(self, commands):
+        """
+        Sends several commands in one request to the batch endpoint.
+        Falls back to one request per command if the device has no batch
+        endpoint.
+
+        :param commands: list of tuples of mode ('exec' or 'eval') and command
+        :raises: MpyBatchError: with the error of the first failing command
+        :return: list of results as strings
+        """
+        results = []
+        if self.batch_supported:
+            status, values = self.post(
+                "/repl/batch", [{'mode': mode, 'command': command}
+                                for mode, command in commands])
+            if status != 404:
+                for value in values:
+                    if isinstance(value, dict) and 'error' in value:
+                        raise MpyBatchError(value['error'], len(results),
+                                            results)
+                    results.append(self.to_string(value))
+                return results
+            self.batch_supported = False
+        for mode, command in commands:
+            try:
+                results.append(self.run_cmd(command, mode=mode))
+            except MpyDeviceError as e:
+                raise MpyBatchError(str(e), len(results), results)
+        return results
 
     def exec(self, command, output=None):
         return self.run_cmd(command, mode="exec")
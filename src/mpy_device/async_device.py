@@ -0,0 +1,513 @@
+import asyncio
+import base64
+import codecs
+import itertools
+import json
+
+from .base_device import BaseDevice, MpyDeviceError
+from .raw_repl import RawRepl
+from .serial_repl import SerialRepl
+
+
+class AsyncBaseDevice(object):
+    """
+    asyncio micropython board interface
+
+    Commands of one device are serialized by a lock, commands of different
+    devices run concurrently in one event loop without additional threads.
+    Cancelling a command or exceeding its timeout interrupts the script on
+    the board.
+.. code-block:: python
+
+        async with AsyncMpyDevice('/dev/ttyUSB0') as dev:
+            freq = await dev.eval('machine.freq()', timeout=1)
+            async for chunk in dev.stream_file('main.py'):
+                print(chunk, end='')
+
+    """
+    CHUNK_SIZE = BaseDevice.CHUNK_SIZE
+    PIPELINE_SIZE = BaseDevice.PIPELINE_SIZE
+
+    def __init__(self, timeout=None, compress=False):
+        self.timeout = timeout
+        self.compress = compress
+        self.inflate = None
+        self.lock = asyncio.Lock()
+        self.transfers = itertools.count()
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close()
+
+    async def open(self):
+        raise NotImplementedError()
+
+    async def close(self):
+        raise NotImplementedError()
+
+    def stream(self, command):
+        """
+        Executes a python statement on the device and yields its output
+        on stdout as soon as it is received.
+
+        :param command: Python command (expression or statement) to execute
+        :raises: MpyDeviceError: after the output if the command raised an
+         Exception on the board
+        :return: asynchronous iterator of output strings
+        """
+        raise NotImplementedError()
+
+    def stream_file(self, filename):
+        """
+        Executes a script located on the device and yields its output.
+
+        :param filename: Filename of the script to run on the device.
+        :return: asynchronous iterator of output strings
+        """
+        return self.stream('exec(open({!r}).read())'.format(str(filename)))
+
+    async def collect(self, chunks, output=None):
+        received = []
+        async for chunk in chunks:
+            received.append(chunk)
+            if output:
+                output.write(chunk)
+                output.flush()
+        return ''.join(received)
+
+    async def exec(self, command, output=None, timeout=None):
+        """
+        Executes a python expression or statement on the device
+
+        :param command: Python command (expression or statement) to execute
+        :param output: File-object to redirect the output of stdout
+        :param timeout: seconds until the command is interrupted, defaults
+         to the timeout of the instance (None waits forever)
+        :raises: MpyDeviceError: if the command raises an Exception on the board
+        :raises: asyncio.TimeoutError: if the command did not finish in time
+        :return: output on stdout as string
+        """
+        timeout = self.timeout if timeout is None else timeout
+        return await asyncio.wait_for(
+            self.collect(self.stream(command), output=output), timeout)
+
+    async def eval(self, expression, output=None, timeout=None):
+        """
+        Evaluates an python expression on the device and returns the
+        return-value as string.
+
+        :param expression: Python expression to evaluate
+        :param output: File-object to redirect the output of stdout
+        :param timeout: seconds until the evaluation is interrupted
+        :return: Return value of the expression as string
+        """
+        ret = await self.exec('print({})'.format(expression), output=output,
+                              timeout=timeout)
+        return ret.strip()
+
+    async def execfile(self, filename, output=None, timeout=None):
+        """
+        Executes a script on the device.
+        The Script must be located on the device.
+
+        :param filename: Filename of the script to run on the device.
+        :param output: File-object to redirect the output of stdout
+        :param timeout: seconds until the script is interrupted
+        :return: output on stdout as string
+        """
+        timeout = self.timeout if timeout is None else timeout
+        return await asyncio.wait_for(
+            self.collect(self.stream_file(filename), output=output), timeout)
+
+    async def batch(self, commands, timeout=None):
+        """
+        Executes several commands in one submission like BaseDevice.batch.
+
+        :param commands: list of tuples of mode ('exec' or 'eval') and command
+        :param timeout: seconds until the batch is interrupted
+        :raises: MpyBatchError: with the error of the first failing command
+        :return: list of results as strings
+        """
+        if not commands:
+            return []
+        output = await self.exec(BaseDevice.batch_script(commands),
+                                 timeout=timeout)
+        return BaseDevice.batch_results(commands, output)
+
+    async def probe_inflate(self):
+        """
+        Looks up a zlib decompressor on the device like
+        BaseDevice.probe_inflate.
+
+        :return: True if the device can decompress data
+        """
+        if self.inflate is None:
+            results = await self.batch([('exec', BaseDevice.PROBE_INFLATE),
+                                        ('eval', '_inflate is not None')])
+            self.inflate = results[1] == 'True'
+        return self.inflate
+
+    def transfer_variable(self):
+        """
+        :return: name of a new file object variable on the device, so
+         concurrent transfers do not share one
+        """
+        return '_transfer{}'.format(next(self.transfers))
+
+    async def put_file(self, local, remote, chunk_size=None, compress=None):
+        """
+        Copies a local file byte-exact to the device. Chunks are sent in
+        batches of up to PIPELINE_SIZE bytes like BaseDevice.put_file.
+
+        :param local: path of the local file
+        :param remote: path of the file on the device
+        :param chunk_size: number of bytes transferred per command
+        :param compress: compress the transfer, defaults to the compress
+         setting of the device
+        :raises: MpyDeviceError: if the device wrote less bytes than sent
+         or the file size on the device mismatches
+        :return: number of bytes copied
+        """
+        chunk_size = chunk_size or self.CHUNK_SIZE
+        compress = self.compress if compress is None else compress
+        compress = compress and await self.probe_inflate()
+        with open(str(local), 'rb') as f:
+            data = f.read()
+        var = self.transfer_variable()
+        commands = []
+        sizes = []
+        for start in range(0, len(data), chunk_size):
+            chunk = data[start:start + chunk_size]
+            commands.append(BaseDevice.chunk_command(var, chunk, compress)[0])
+            sizes.append(len(chunk))
+
+        await self.exec('import ubinascii\n{} = open({!r}, "wb")'
+                        .format(var, str(remote)))
+        try:
+            for submission in BaseDevice.split_submissions(commands, sizes):
+                written = await self.batch(
+                    [command for command, _ in submission])
+                BaseDevice.verify_written(submission, written)
+        except BaseException:
+            await self.exec('{0}.close()\ndel {0}'.format(var))
+            raise
+        size = int((await self.batch([
+            ('exec', '{0}.close()\ndel {0}\nimport os'.format(var)),
+            ('eval', 'os.stat({!r})[6]'.format(str(remote)))]))[1])
+        if size != len(data):
+            raise MpyDeviceError('{} has {} bytes on the device, expected {}'
+                                 .format(remote, size, len(data)))
+        return len(data)
+
+    async def get_file(self, remote, local, chunk_size=None):
+        """
+        Copies a file byte-exact from the device. Up to PIPELINE_SIZE
+        bytes of chunks are requested in one submission like
+        BaseDevice.get_file.
+
+        :param remote: path of the file on the device
+        :param local: path of the local file
+        :param chunk_size: number of bytes transferred per command
+        :raises: MpyDeviceError: if the received size mismatches
+        :return: number of bytes copied
+        """
+        chunk_size = chunk_size or self.CHUNK_SIZE
+        depth = max(1, self.PIPELINE_SIZE // chunk_size)
+        var = self.transfer_variable()
+        size = int((await self.batch([
+            ('exec', 'import os, ubinascii\n{} = open({!r}, "rb")'
+             .format(var, str(remote))),
+            ('eval', 'os.stat({!r})[6]'.format(str(remote)))]))[1])
+        data = bytearray()
+        try:
+            while True:
+                chunks = await self.batch(
+                    [BaseDevice.read_command(var, chunk_size)] * depth)
+                chunks = [base64.b64decode(chunk) for chunk in chunks]
+                data += b''.join(chunks)
+                if len(chunks[-1]) < chunk_size:
+                    break
+        finally:
+            await self.exec('{0}.close()\ndel {0}'.format(var))
+        if len(data) != size:
+            raise MpyDeviceError('Received {} of {} bytes of {}'
+                                 .format(len(data), size, remote))
+        with open(str(local), 'wb') as f:
+            f.write(data)
+        return len(data)
+
+
+class AsyncSerialRepl(AsyncBaseDevice):
+    """
+    asyncio micropython board interface over a serial port
+
+    The port is opened with the handshake of SerialRepl and afterwards read
+    without blocking when the event loop reports it readable. The raw REPL
+    protocol is shared with SerialRepl, see RawRepl.
+    """
+    QUIET_TIMEOUT = 0.1
+
+    def __init__(self, dev, timeout=None, raw_paste=True, compress=False):
+        super().__init__(timeout=timeout, compress=compress)
+        self.dev = dev
+        self.protocol = RawRepl(raw_paste=raw_paste)
+        self.serial = None
+        self.buffer = bytearray()
+        self.interrupted = False
+
+    def __repr__(self):
+        return 'AsyncSerialRepl({})'.format(self.dev)
+
+    async def open(self):
+        loop = asyncio.get_running_loop()
+        repl = await loop.run_in_executor(None, SerialRepl, self.dev)
+        self.serial = repl.serial
+        self.serial.timeout = 0
+        await self.enter_raw_repl()
+
+    async def close(self):
+        if self.serial is not None:
+            self.serial.close()
+            self.serial = None
+
+    async def perform(self, steps):
+        """
+        Performs the I/O requests of RawRepl protocol steps like
+        SerialRepl.perform.
+
+        :param steps: generator of RawRepl protocol steps
+        :return: asynchronous iterator of the streamed output
+        """
+        result = None
+        while True:
+            try:
+                op, arg = steps.send(result)
+            except StopIteration:
+                return
+            result = None
+            if op == RawRepl.STREAM_UNTIL:
+                async for text in self.iter_until(arg):
+                    yield text
+            elif op == RawRepl.WRITE:
+                self.serial.write(arg)
+            elif op == RawRepl.READ_UNTIL:
+                result = await self.read_until(arg)
+            elif op == RawRepl.READ_BYTES:
+                result = await self.read_bytes(arg)
+            elif op == RawRepl.PENDING:
+                result = bool(self.buffer or self.serial.in_waiting)
+
+    async def complete(self, steps):
+        async for _ in self.perform(steps):
+            pass
+
+    async def enter_raw_repl(self):
+        await self.complete(self.protocol.enter())
+
+    async def readable(self, timeout=None):
+        """
+        Waits until the serial port has data to read.
+
+        :param timeout: seconds to wait, None waits forever
+        :return: False if the timeout passed without data
+        """
+        if self.serial.in_waiting:
+            return True
+        loop = asyncio.get_running_loop()
+        ready = loop.create_future()
+        fd = self.serial.fileno()
+        loop.add_reader(fd, lambda: ready.done() or ready.set_result(True))
+        try:
+            return await asyncio.wait_for(ready, timeout)
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            loop.remove_reader(fd)
+
+    async def fill(self):
+        await self.readable()
+        self.buffer += self.serial.read(max(1, self.serial.in_waiting))
+
+    async def iter_until(self, until):
+        """
+        Reads from the device until a marker is received and yields the
+        data in front of the marker as it arrives. The marker is consumed.
+
+        :param until: marker to read until
+        :return: asynchronous iterator of received strings
+        """
+        until = until.encode()
+        decoder = codecs.getincrementaldecoder('utf-8')('replace')
+        while True:
+            text, found = RawRepl.take_until(self.buffer, until, decoder)
+            if text:
+                yield text
+            if found:
+                return
+            await self.fill()
+
+    async def read_until(self, until):
+        return ''.join([text async for text in self.iter_until(until)])
+
+    async def read_bytes(self, size):
+        while len(self.buffer) < size:
+            await self.fill()
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
+
+    def interrupt(self):
+        """
+        Sends CTRL-C to stop the running command. The connection is
+        resynchronized before the next command.
+        """
+        if self.serial is not None:
+            self.serial.write(SerialRepl.CTRL_C)
+            self.interrupted = True
+
+    async def recover(self):
+        """
+        Discards the remains of an interrupted command and reenters the
+        raw REPL.
+        """
+        if not self.interrupted:
+            return
+        self.buffer.clear()
+        while await self.readable(AsyncSerialRepl.QUIET_TIMEOUT):
+            self.serial.read(max(1, self.serial.in_waiting))
+        self.interrupted = False
+        await self.enter_raw_repl()
+
+    async def stream(self, command):
+        async with self.lock:
+            await self.recover()
+            try:
+                async for text in self.perform(
+                        self.protocol.execute(command.encode())):
+                    yield text
+            except BaseException:
+                if self.protocol.busy:
+                    # cancelled, timed out or abandoned by the caller
+                    self.interrupt()
+                raise
+
+
+class AsyncApifyRepl(AsyncBaseDevice):
+    """
+    asyncio micropython board interface over the HTTP API of an apify device
+
+    Commands are posted over one keep-alive connection. The HTTP API answers
+    after the command finished, so the output is streamed in one piece and
+    a cancelled command only drops the connection.
+    """
+    DEFAULT_TIMEOUT = 10
+
+    def __init__(self, ip_with_port, timeout=None, compress=False):
+        super().__init__(timeout=timeout or AsyncApifyRepl.DEFAULT_TIMEOUT,
+                         compress=compress)
+        self.ip, self.port = ip_with_port.split(':')
+        self.reader = None
+        self.writer = None
+
+    def __repr__(self):
+        return 'AsyncApifyRepl({}:{})'.format(self.ip, self.port)
+
+    async def open(self):
+        pass
+
+    async def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.reader = self.writer = None
+
+    async def read_response(self, status_line):
+        status = int(status_line.split()[1])
+        headers = dict()
+        while True:
+            line = (await self.reader.readline()).decode('latin-1').strip()
+            if not line:
+                break
+            name, value = line.split(':', 1)
+            headers[name.strip().lower()] = value.strip()
+        if 'content-length' in headers:
+            content = await self.reader.readexactly(
+                int(headers['content-length']))
+        else:
+            content = await self.reader.read()
+            headers['connection'] = 'close'
+        return status, headers, content
+
+    async def post(self, path, body):
+        """
+        Posts a JSON body like ApifyRepl.post. Only a request on a reused
+        connection which failed before any response arrived is retried.
+
+        :return: tuple of HTTP status and decoded JSON response
+        """
+        data = json.dumps(body).encode('utf-8')
+        request = ('POST {} HTTP/1.1\r\n'
+                   'Host: {}:{}\r\n'
+                   'Connection: keep-alive\r\n'
+                   'Content-Type: application/json\r\n'
+                   'Content-Length: {}\r\n\r\n'
+                   .format(path, self.ip, self.port, len(data))).encode()
+        while True:
+            reused = self.writer is not None
+            if not reused:
+                self.reader, self.writer = await asyncio.open_connection(
+                    self.ip, int(self.port))
+            received = False
+            try:
+                self.writer.write(request + data)
+                await self.writer.drain()
+                status_line = await self.reader.readline()
+                if not status_line:
+                    raise ConnectionResetError('Connection closed by {}'
+                                               .format(self))
+                received = True
+                status, headers, content = await self.read_response(
+                    status_line)
+            except (ConnectionError, asyncio.IncompleteReadError,
+                    IndexError, ValueError):
+                await self.close()
+                if reused and not received:
+                    continue
+                raise
+            except BaseException:
+                # the response of a cancelled request is never read
+                await self.close()
+                raise
+            if headers.get('connection', '').lower() == 'close':
+                await self.close()
+            break
+
+        if status == 404:
+            return status, None
+        if status != 200:
+            raise MpyDeviceError(content.decode('utf-8', 'replace'))
+        return status, json.loads(content.decode('utf-8'))
+
+    async def run_cmd(self, command, mode):
+        async with self.lock:
+            status, value = await self.post('/repl/{}'.format(mode), command)
+        if status == 404:
+            raise MpyDeviceError('Unknown REPL mode {}'.format(mode))
+        if isinstance(value, list):
+            return str(tuple(value))
+        return str(value)
+
+    async def stream(self, command):
+        yield await self.run_cmd(command, mode='exec')
+
+    async def eval(self, expression, output=None, timeout=None):
+        timeout = self.timeout if timeout is None else timeout
+        value = await asyncio.wait_for(
+            self.run_cmd(expression, mode='eval'), timeout)
+        if output:
+            # the value is written like the printed value of the serial REPL
+            output.write(value + '\n')
+            output.flush()
+        return value
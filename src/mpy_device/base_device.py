@@ -1,10 +1,58 @@
+import base64
+import hashlib
 import sys
+import textwrap
+import time
+import zlib
+from contextlib import contextmanager
+
+from .bundle import ScriptBundle
 
 
 class MpyDeviceError(Exception):
     pass
 
 
+class MpyBatchError(MpyDeviceError):
+    """
+    Raised if a command of a batch fails. Holds the index of the failing
+    command and the results of the commands executed before.
+    """
+    def __init__(self, message, index, results):
+        super().__init__(message)
+        self.index = index
+        self.results = results
+
+
+class Pipeline(object):
+    """
+    Collects commands which are sent to the device in one submission when
+    the context of BaseDevice.pipeline() is left.
+    """
+    def __init__(self):
+        self.commands = []
+        self.results = None
+
+    def __repr__(self):
+        return 'Pipeline({} commands)'.format(len(self.commands))
+
+    def exec(self, command):
+        """
+        :param command: Python statement to execute
+        :return: index of the output in results
+        """
+        self.commands.append(('exec', command))
+        return len(self.commands) - 1
+
+    def eval(self, expression):
+        """
+        :param expression: Python expression to evaluate
+        :return: index of the value in results
+        """
+        self.commands.append(('eval', expression))
+        return len(self.commands) - 1
+
+
 class BaseDevice(object):
     """
     micropython board interface
@@ -19,6 +67,34 @@ class BaseDevice(object):
             dev.execfile('main.py')
 
     """
+    CHUNK_SIZE = 512
+    PIPELINE_SIZE = 2048
+    STREAM_LINE_SIZE = 4096
+    BATCH_SEPARATOR = '\x1e'
+    BATCH_ERROR = '\x15'
+    DELTA_BLOCK_SIZE = 1024
+    DELTA_THRESHOLD = 0.5
+    # request_interrupt() is supported
+    INTERRUPTIBLE = False
+    PROBE_INFLATE = ('try:\n'
+                     '    from zlib import decompress as _inflate\n'
+                     'except ImportError:\n'
+                     '    try:\n'
+                     '        import deflate, io\n'
+                     '        _inflate = lambda d: deflate.DeflateIO('
+                     'io.BytesIO(d), deflate.ZLIB).read()\n'
+                     '    except ImportError:\n'
+                     '        try:\n'
+                     '            from uzlib import decompress as _inflate\n'
+                     '        except ImportError:\n'
+                     '            _inflate = None\n')
+
+    def __init__(self, compress=False):
+        self.compress = compress
+        self.inflate = None
+        self.transfer_stats = {'bytes': 0, 'sent': 0, 'seconds': 0.0}
+        self.round_trips = 0
+
     def __enter__(self):
         self.enter_raw_repl()
         return self
@@ -26,6 +102,10 @@ class BaseDevice(object):
     def __exit__(self, exc_type, exc_val, exc_tb):
         self.close()
 
+    @staticmethod
+    def execfile_command(filename):
+        return 'exec(open({!r}).read())'.format(str(filename))
+
     def execfile(self, filename, output=sys.stdout):
         """
         Executes a script on the device.
@@ -35,9 +115,592 @@ class BaseDevice(object):
         :param output: File-object to redirect the output of stdout
         :return: output on stdout as string
         """
-        return self.exec('exec(open("{}").read())\x04'.format(filename),
+        return self.exec(self.execfile_command(filename), output=output)
+
+    def stream_chunks(self, command):
+        """
+        Generator which executes a command and yields its output on stdout.
+        Devices which can receive the output while the command runs yield
+        it as it arrives, this implementation yields it at the end.
+        """
+        yield self.exec(command)
+
+    def stream(self, command, lines=False):
+        """
+        Executes a python statement on the device and yields its output
+        on stdout without collecting it. Closing the iterator before the
+        end interrupts the command if the device supports it.
+
+        :param command: Python command (expression or statement) to execute
+        :param lines: yield lines including their line ending instead of
+         chunks as received, lines longer than STREAM_LINE_SIZE are split
+        :raises: MpyDeviceError: after the output if the command raised an
+         Exception on the board
+        :return: iterator of output strings
+
+.. code-block:: python
+
+            for line in dev.stream('import app', lines=True):
+                log.info(line.rstrip())
+
+        """
+        chunks = self.stream_chunks(command)
+        return self.split_lines(chunks) if lines else chunks
+
+    def stream_file(self, filename, lines=False):
+        """
+        Executes a script located on the device and yields its output like
+        stream().
+
+        :param filename: Filename of the script to run on the device.
+        :param lines: yield lines instead of chunks
+        :return: iterator of output strings
+        """
+        return self.stream(self.execfile_command(filename), lines=lines)
+
+    def execfile_local(self, script, output=sys.stdout, bundle=False,
+                       paths=None):
+        """
+        Executes a local script from RAM without writing it to the device.
+        Output and errors are reported like execfile().
+
+        :param script: path of the local script
+        :param output: File-object to redirect the output of stdout
+        :param bundle: send the local modules imported by the script along,
+         see ScriptBundle
+        :param paths: directories searched for bundled modules, defaults to
+         the directory of the script
+        :return: output on stdout as string
+        """
+        return self.exec(ScriptBundle(script, bundle, paths).command(),
                          output=output)
 
+    def stream_file_local(self, script, lines=False, bundle=False,
+                          paths=None):
+        """
+        Executes a local script from RAM like execfile_local() and yields
+        its output like stream().
+
+        :param script: path of the local script
+        :param lines: yield lines instead of chunks
+        :param bundle: send the local modules imported by the script along
+        :param paths: directories searched for bundled modules
+        :return: iterator of output strings
+        """
+        return self.stream(ScriptBundle(script, bundle, paths).command(),
+                           lines=lines)
+
+    def split_lines(self, chunks):
+        """
+        Generator which regroups output chunks into lines. Holds at most
+        STREAM_LINE_SIZE characters of an incomplete line.
+        """
+        pending = ''
+        try:
+            for chunk in chunks:
+                pending += chunk
+                while True:
+                    index = pending.find('\n', 0, self.STREAM_LINE_SIZE)
+                    if index < 0 and len(pending) < self.STREAM_LINE_SIZE:
+                        break
+                    end = self.STREAM_LINE_SIZE if index < 0 else index + 1
+                    line, pending = pending[:end], pending[end:]
+                    yield line
+            if pending:
+                yield pending
+        finally:
+            chunks.close()
+
+    def batch(self, commands):
+        """
+        Executes several commands in one submission. The commands are
+        executed in order until the first one fails.
+
+        :param commands: list of tuples of mode ('exec' or 'eval') and command
+        :raises: MpyBatchError: with the error of the first failing command
+        :return: list of results as strings, the output of statements and
+         the values of expressions
+        """
+        if not commands:
+            return []
+        return self.batch_results(commands,
+                                  self.exec(self.batch_script(commands)))
+
+    @staticmethod
+    def batch_script(commands):
+        """
+        :param commands: list of tuples of mode ('exec' or 'eval') and command
+        :return: script which executes the commands and separates their
+         results, see batch_results()
+        """
+        script = ['try:']
+        for mode, command in commands:
+            if mode == 'eval':
+                command = 'print({})'.format(command)
+            script.append(textwrap.indent(command, '    '))
+            script.append("    print('\\x1e', end='')")
+        script.append('except Exception as _e:\n'
+                      "    print('\\x15{}: {}'.format(type(_e).__name__, _e),"
+                      " end='')")
+        return '\n'.join(script)
+
+    @classmethod
+    def batch_results(cls, commands, output):
+        """
+        :param commands: list of tuples of mode and command
+        :param output: output of the script of batch_script()
+        :raises: MpyBatchError: with the error of the first failing command
+        :return: list of results as strings
+        """
+        *outputs, rest = output.split(cls.BATCH_SEPARATOR)
+        results = [output.strip() if mode == 'eval' else output
+                   for (mode, _), output in zip(commands, outputs)]
+        if cls.BATCH_ERROR in rest:
+            raise MpyBatchError(rest.split(cls.BATCH_ERROR, 1)[1],
+                                len(results), results)
+        return results
+
+    @contextmanager
+    def pipeline(self):
+        """
+        Context manager which collects commands and executes them with
+        batch() when the context is left.
+
+.. code-block:: python
+
+            with dev.pipeline() as pipeline:
+                pipeline.exec('import os')
+                size = pipeline.eval('os.stat("main.py")[6]')
+            print(pipeline.results[size])
+
+        :raises: MpyBatchError: with the error of the first failing command
+        """
+        pipeline = Pipeline()
+        yield pipeline
+        pipeline.results = self.batch(pipeline.commands)
+
+    def probe_inflate(self):
+        """
+        Looks up a zlib decompressor on the device (zlib, deflate or uzlib,
+        whichever the firmware provides) and stores it as _inflate.
+        The result is cached for the session.
+
+        :return: True if the device can decompress data
+        """
+        if self.inflate is None:
+            self.exec(self.PROBE_INFLATE)
+            self.inflate = self.eval('_inflate is not None') == 'True'
+        return self.inflate
+
+    def write_chunks(self, var, data, chunk_size=None, compress=None,
+                     setup=None):
+        """
+        Writes bytes to a file object opened in binary mode on the device.
+        The data is transferred base64 encoded in chunks and the number of
+        bytes written by the device is verified for every chunk.
+        With compression every chunk is deflated on the host and inflated
+        on the device, so the device never holds more than one chunk.
+        Up to PIPELINE_SIZE bytes of chunks are sent in one submission.
+
+        :param var: name of the file object on the device
+        :param data: bytes to write
+        :param chunk_size: number of bytes transferred per command
+        :param compress: compress the chunks, defaults to the compress
+         setting of the device
+        :param setup: statement executed in front of the first chunk, e.g.
+         a seek (optional)
+        :raises: MpyDeviceError: if the device wrote less bytes than sent
+        :return: number of bytes written
+        """
+        start_time = time.monotonic()
+        commands, sizes = self.chunk_commands(var, data,
+                                              chunk_size=chunk_size,
+                                              compress=compress)
+        self.submit_chunks(
+            [('exec', 'import ubinascii\n{}'.format(setup or ''))] + commands,
+            [None] + sizes)
+        self.transfer_stats['bytes'] += len(data)
+        self.transfer_stats['seconds'] += time.monotonic() - start_time
+        return len(data)
+
+    def chunk_commands(self, var, data, chunk_size=None, compress=None):
+        """
+        :param var: name of the file object on the device
+        :param data: bytes to write
+        :param chunk_size: number of bytes transferred per command
+        :param compress: compress the chunks, defaults to the compress
+         setting of the device
+        :return: tuple of the batch commands which write the chunks and the
+         sizes of the chunks
+        """
+        chunk_size = chunk_size or self.CHUNK_SIZE
+        compress = self.compress if compress is None else compress
+        compress = compress and self.probe_inflate()
+        commands = []
+        sizes = []
+        for start in range(0, len(data), chunk_size):
+            chunk = data[start:start + chunk_size]
+            command, sent = self.chunk_command(var, chunk, compress)
+            commands.append(command)
+            sizes.append(len(chunk))
+            self.transfer_stats['sent'] += sent
+        return commands, sizes
+
+    @staticmethod
+    def chunk_command(var, chunk, compress):
+        """
+        :param var: name of the file object on the device
+        :param chunk: bytes to write
+        :param compress: deflate the chunk if it gets smaller, the device
+         must provide _inflate (see probe_inflate())
+        :return: tuple of the batch command which writes the chunk and the
+         number of bytes sent before base64 encoding
+        """
+        payload = chunk
+        expression = "{}.write(ubinascii.a2b_base64('{}'))"
+        if compress:
+            compressed = zlib.compress(chunk, 9)
+            if len(compressed) < len(chunk):
+                payload = compressed
+                expression = "{}.write(_inflate(" \
+                             "ubinascii.a2b_base64('{}')))"
+        return ('eval', expression.format(
+            var, base64.b64encode(payload).decode('ascii'))), len(payload)
+
+    def submit_chunks(self, commands, sizes):
+        """
+        Executes batch commands in submissions of up to PIPELINE_SIZE bytes
+        of chunks and verifies the number of bytes written by every chunk.
+
+        :param commands: list of batch commands
+        :param sizes: chunk size for every command, None for commands
+         which do not write a chunk
+        :raises: MpyDeviceError: if the device wrote less bytes than sent
+        :return: list of results of the commands
+        """
+        results = []
+        for submission in self.split_submissions(commands, sizes):
+            written = self.batch([command for command, _ in submission])
+            self.verify_written(submission, written)
+            results += written
+        return results
+
+    @classmethod
+    def split_submissions(cls, commands, sizes):
+        """
+        :param commands: list of batch commands
+        :param sizes: chunk size for every command or None
+        :return: list of submissions with up to PIPELINE_SIZE bytes of
+         chunks, each a list of tuples of command and chunk size
+        """
+        submissions = [[]]
+        pending = 0
+        for command, size in zip(commands, sizes):
+            if size is not None:
+                if pending and pending + size > cls.PIPELINE_SIZE:
+                    submissions.append([])
+                    pending = 0
+                pending += size
+            submissions[-1].append((command, size))
+        return submissions
+
+    @staticmethod
+    def verify_written(submission, results):
+        """
+        :param submission: list of tuples of command and chunk size
+        :param results: results of the submission
+        :raises: MpyDeviceError: if the device wrote less bytes than sent
+        """
+        for (_, size), result in zip(submission, results):
+            if size is not None and int(result) != size:
+                raise MpyDeviceError('Wrote {} of {} bytes'
+                                     .format(result, size))
+
+    def transfer_summary(self):
+        """
+        :return: dict with transferred bytes, bytes sent (before base64
+         encoding), compression ratio and effective throughput in bytes/s
+        """
+        stats = self.transfer_stats
+        return {'bytes': stats['bytes'],
+                'sent': stats['sent'],
+                'ratio': stats['bytes'] / stats['sent']
+                if stats['sent'] else 1.0,
+                'throughput': stats['bytes'] / stats['seconds']
+                if stats['seconds'] else 0.0}
+
+    def read_chunks(self, var, length=None, chunk_size=None, setup=None):
+        """
+        Reads bytes from a file object opened in binary mode on the device.
+        The data is transferred base64 encoded in chunks, up to
+        PIPELINE_SIZE bytes of chunks are requested in one submission.
+
+        :param var: name of the file object on the device
+        :param length: maximum number of bytes to read, None reads until EOF
+        :param chunk_size: number of bytes transferred per command
+        :param setup: statement executed in front of the first chunk, e.g.
+         a seek (optional)
+        :return: bytes read
+        """
+        chunk_size = chunk_size or self.CHUNK_SIZE
+        depth = max(1, self.PIPELINE_SIZE // chunk_size)
+        data = bytearray()
+        commands = [('exec', 'import ubinascii\n{}'.format(setup or ''))]
+        while length is None or len(data) < length:
+            sizes = []
+            requested = len(data)
+            while len(sizes) < depth and (length is None
+                                          or requested < length):
+                size = chunk_size
+                if length is not None:
+                    size = min(size, length - requested)
+                commands.append(self.read_command(var, size))
+                sizes.append(size)
+                requested += size
+            results = self.batch(commands)[-len(sizes):]
+            commands = []
+            for size, result in zip(sizes, results):
+                chunk = base64.b64decode(result)
+                data += chunk
+                if len(chunk) < size:
+                    return bytes(data)
+        return bytes(data)
+
+    @staticmethod
+    def read_command(var, size):
+        """
+        :return: batch command which reads up to size bytes base64 encoded
+        """
+        return ('eval', 'ubinascii.b2a_base64({}.read({})).decode()'
+                .format(var, size))
+
+    def put_file(self, local, remote, chunk_size=None, compress=None):
+        """
+        Copies a local file byte-exact to the device.
+
+        :param local: path of the local file
+        :param remote: path of the file on the device
+        :param chunk_size: number of bytes transferred per command
+        :param compress: compress the transfer, defaults to the compress
+         setting of the device
+        :raises: MpyDeviceError: if the file size on the device mismatches
+        :return: number of bytes copied
+        """
+        with open(str(local), 'rb') as f:
+            data = f.read()
+        self.exec('_transfer = open({!r}, "wb")'.format(str(remote)))
+        try:
+            self.write_chunks('_transfer', data, chunk_size=chunk_size,
+                              compress=compress)
+        except BaseException:
+            self.exec('_transfer.close()')
+            raise
+        with self.pipeline() as pipeline:
+            pipeline.exec('_transfer.close()\nimport os')
+            size = pipeline.eval('os.stat({!r})[6]'.format(str(remote)))
+        size = int(pipeline.results[size])
+        if size != len(data):
+            raise MpyDeviceError('{} has {} bytes on the device, expected {}'
+                                 .format(remote, size, len(data)))
+        return len(data)
+
+    def get_file(self, remote, local, chunk_size=None):
+        """
+        Copies a file byte-exact from the device.
+
+        :param remote: path of the file on the device
+        :param local: path of the local file
+        :param chunk_size: number of bytes transferred per command
+        :raises: MpyDeviceError: if the received size mismatches
+        :return: number of bytes copied
+        """
+        with self.pipeline() as pipeline:
+            pipeline.exec('import os')
+            size = pipeline.eval('os.stat({!r})[6]'.format(str(remote)))
+            pipeline.exec('_transfer = open({!r}, "rb")'.format(str(remote)))
+        size = int(pipeline.results[size])
+        try:
+            data = self.read_chunks('_transfer', chunk_size=chunk_size)
+        finally:
+            self.exec('_transfer.close()')
+        if len(data) != size:
+            raise MpyDeviceError('Received {} of {} bytes of {}'
+                                 .format(len(data), size, remote))
+        with open(str(local), 'wb') as f:
+            f.write(data)
+        return len(data)
+
+    def hash_blocks(self, remote, block_size=None):
+        """
+        Computes sha256 digests of fixed-size blocks of a file on the device.
+
+        :param remote: path of the file on the device
+        :param block_size: size of the hashed blocks
+        :return: tuple of file size and list of hex digests or None if the
+         file does not exist
+        """
+        block_size = block_size or self.DELTA_BLOCK_SIZE
+        ret = self.exec(
+            'import os, uhashlib, ubinascii\n'
+            'try:\n'
+            '    print(os.stat({path!r})[6])\n'
+            '    with open({path!r}, "rb") as _f:\n'
+            '        _b = _f.read({size})\n'
+            '        while _b:\n'
+            '            print(ubinascii.hexlify('
+            'uhashlib.sha256(_b).digest()).decode())\n'
+            '            _b = _f.read({size})\n'
+            'except OSError:\n'
+            '    print("-")\n'.format(path=str(remote), size=block_size))
+        lines = ret.split()
+        if not lines or lines[0] == '-':
+            return None
+        return int(lines[0]), lines[1:]
+
+    def put_file_delta(self, local, remote, block_size=None,
+                       threshold=None, chunk_size=None, compress=None):
+        """
+        Copies a local file to the device, transferring only the blocks
+        which differ from the existing copy on the device. Changed blocks
+        are written in place. Falls back to a full copy if the file does not
+        exist on the device, shrank or more than threshold of its blocks
+        changed.
+
+        :param local: path of the local file
+        :param remote: path of the file on the device
+        :param block_size: size of the compared blocks
+        :param threshold: fraction of changed blocks above which the whole
+         file is copied
+        :param chunk_size: number of bytes transferred per command
+        :param compress: compress the transfer, defaults to the compress
+         setting of the device
+        :raises: MpyDeviceError: if the file on the device mismatches after
+         the transfer
+        :return: number of bytes transferred
+        """
+        block_size = block_size or self.DELTA_BLOCK_SIZE
+        threshold = self.DELTA_THRESHOLD if threshold is None else threshold
+        with open(str(local), 'rb') as f:
+            data = f.read()
+        blocks = [data[i:i + block_size]
+                  for i in range(0, len(data), block_size)]
+
+        remote_blocks = self.hash_blocks(remote, block_size=block_size)
+        if remote_blocks is None or remote_blocks[0] > len(data):
+            # files cannot be truncated on the device
+            return self.put_file(local, remote, chunk_size=chunk_size,
+                                 compress=compress)
+        remote_digests = remote_blocks[1]
+
+        changed = [i for i, block in enumerate(blocks)
+                   if i >= len(remote_digests)
+                   or hashlib.sha256(block).hexdigest() != remote_digests[i]]
+        if len(changed) > threshold * max(1, len(blocks)):
+            return self.put_file(local, remote, chunk_size=chunk_size,
+                                 compress=compress)
+
+        # consecutive changed blocks are written as one run
+        runs = []
+        for index in changed:
+            if runs and runs[-1][1] == index:
+                runs[-1][1] = index + 1
+            else:
+                runs.append([index, index + 1])
+
+        # the runs, the close and the verification are submitted together
+        start_time = time.monotonic()
+        commands = [('exec', 'import ubinascii\n'
+                             '_transfer = open({!r}, "r+b")'
+                             .format(str(remote)))]
+        sizes = [None]
+        transferred = 0
+        for first, end in runs:
+            run = data[first * block_size:end * block_size]
+            commands.append(('exec', '_transfer.seek({})'
+                                     .format(first * block_size)))
+            sizes.append(None)
+            run_commands, run_sizes = self.chunk_commands(
+                '_transfer', run, chunk_size=chunk_size, compress=compress)
+            commands += run_commands
+            sizes += run_sizes
+            transferred += len(run)
+        commands.append(('exec', '_transfer.close()\n'
+                                 + self.hash_files_command([remote])))
+        sizes.append(None)
+        try:
+            results = self.submit_chunks(commands, sizes)
+        except BaseException:
+            try:
+                self.exec('_transfer.close()')
+            except MpyDeviceError:
+                pass
+            raise
+        self.transfer_stats['bytes'] += transferred
+        self.transfer_stats['seconds'] += time.monotonic() - start_time
+
+        digest = self.parse_digests([remote], results[-1])[str(remote)]
+        if digest != hashlib.sha256(data).hexdigest():
+            raise MpyDeviceError('{} differs on the device after the delta '
+                                 'transfer'.format(remote))
+        return transferred
+
+    def hash_files(self, paths):
+        """
+        Computes the sha256 digests of files on the device with uhashlib.
+        All files are hashed in one command.
+
+        :param paths: paths of the files on the device
+        :return: dict of path and hex digest, missing files map to None
+        """
+        paths = [str(p) for p in paths]
+        if not paths:
+            return dict()
+        return self.parse_digests(paths,
+                                  self.exec(self.hash_files_command(paths)))
+
+    def hash_files_command(self, paths):
+        """
+        :param paths: paths of the files on the device
+        :return: command which prints the sha256 digests of the files, see
+         parse_digests()
+        """
+        return ('import uhashlib, ubinascii\n'
+                'for _p in {!r}:\n'
+                '    try:\n'
+                '        _h = uhashlib.sha256()\n'
+                '        with open(_p, "rb") as _f:\n'
+                '            _b = _f.read({})\n'
+                '            while _b:\n'
+                '                _h.update(_b)\n'
+                '                _b = _f.read({})\n'
+                '        print(ubinascii.hexlify(_h.digest()).decode())\n'
+                '    except OSError:\n'
+                '        print("-")\n'.format([str(p) for p in paths],
+                                              self.CHUNK_SIZE,
+                                              self.CHUNK_SIZE))
+
+    @staticmethod
+    def parse_digests(paths, ret):
+        """
+        :param paths: paths of the files on the device
+        :param ret: output of the hash_files_command() of the paths
+        :raises: MpyDeviceError: if the number of digests mismatches
+        :return: dict of path and hex digest, missing files map to None
+        """
+        paths = [str(p) for p in paths]
+        digests = ret.split()
+        if len(digests) != len(paths):
+            raise MpyDeviceError('Received {} digests for {} files'
+                                 .format(len(digests), len(paths)))
+        return {p: None if d == '-' else d for p, d in zip(paths, digests)}
+
+    def unique_id(self):
+        """
+        :return: unique id of the board as hex string
+        """
+        self.exec('import machine, ubinascii')
+        return self.eval('ubinascii.hexlify(machine.unique_id()).decode()')
+
     def connect(self):
         raise NotImplementedError()
 
@@ -50,6 +713,19 @@ class BaseDevice(object):
     def close(self):
         raise NotImplementedError()
 
+    def request_interrupt(self):
+        """
+        Asks the running command to stop with a KeyboardInterrupt. Can be
+        called from another thread while the command runs, which receives
+        the error. Only supported if INTERRUPTIBLE is set.
+
+        :raises: MpyDeviceError: if the device cannot interrupt commands
+        :return: False if no command runs yet, e.g. while it is submitted,
+         nothing is sent then
+        """
+        raise MpyDeviceError('{} cannot interrupt commands'
+                             .format(self.__class__.__name__))
+
     def exec(self, command, output=None):
         raise NotImplementedError()
 
@@ -0,0 +1,141 @@
+import ast
+import os
+from collections import OrderedDict
+
+BUNDLE_PRELUDE = '''\
+import sys
+
+
+class _MpyModule:
+    pass
+
+
+def _mpy_module(name, source):
+    module = _MpyModule()
+    sys.modules[name] = module
+    parent, _, child = name.rpartition('.')
+    if parent in sys.modules:
+        setattr(sys.modules[parent], child, module)
+    for key in sys.modules:
+        if key.rpartition('.')[0] == name:
+            setattr(module, key.rpartition('.')[2], sys.modules[key])
+    namespace = {'__name__': name}
+    exec(source, namespace)
+    for key in namespace:
+        setattr(module, key, namespace[key])
+
+
+'''
+
+
+class ScriptBundle(object):
+    """
+    Local script with the local modules it imports, built into one command
+    which runs the script from RAM on the device.
+
+    Modules are bundled if they are found as <name>.py or package
+    <name>/__init__.py in the search paths. Absolute imports of bundled
+    modules are followed, relative imports are not. Modules which are not
+    found locally are imported on the device as usual. The bundled modules
+    exist until the script ends.
+.. code-block:: python
+
+        bundle = ScriptBundle('tests/test_sensor.py', bundle=True)
+        print(bundle.modules.keys())
+        dev.exec(bundle.command())
+
+    """
+    def __init__(self, script, bundle=False, paths=None):
+        """
+        :param script: path of the local script
+        :param bundle: bundle the local modules imported by the script
+        :param paths: directories searched for modules, defaults to the
+         directory of the script
+        """
+        self.script = str(script)
+        self.paths = [str(p) for p in paths] if paths is not None \
+            else [os.path.dirname(os.path.abspath(self.script))]
+        self.source = self.read(self.script)
+        self.modules = OrderedDict()
+        if bundle:
+            visiting = set()
+            for name in self.imports(self.source, self.script):
+                self.add(name, visiting)
+
+    def __repr__(self):
+        return 'ScriptBundle({}, modules={})'.format(
+            self.script, list(self.modules))
+
+    @staticmethod
+    def read(path):
+        with open(path, encoding='utf-8') as f:
+            return f.read()
+
+    @staticmethod
+    def imports(source, filename):
+        """
+        :return: names of the modules imported absolutely by the source,
+         including the candidates of "from package import name"
+        """
+        names = []
+        for node in ast.walk(ast.parse(source, filename)):
+            if isinstance(node, ast.Import):
+                names.extend(alias.name for alias in node.names)
+            elif isinstance(node, ast.ImportFrom) and not node.level:
+                names.append(node.module)
+                names.extend('{}.{}'.format(node.module, alias.name)
+                             for alias in node.names if alias.name != '*')
+        return names
+
+    def find(self, name):
+        """
+        :return: path of the local module source or None
+        """
+        parts = name.split('.')
+        for path in self.paths:
+            base = os.path.join(path, *parts)
+            for candidate in (base + '.py', os.path.join(base, '__init__.py')):
+                if os.path.isfile(candidate):
+                    return candidate
+        return None
+
+    def add(self, name, visiting):
+        """
+        Adds a module after the modules it imports, followed by its parent
+        package. Packages usually import their submodules, so submodules
+        are registered first and attached to their package when it follows.
+        """
+        if name in self.modules or name in visiting:
+            return
+        path = self.find(name)
+        if path is None:
+            return
+        visiting.add(name)
+        source = self.read(path)
+        for imported in self.imports(source, path):
+            self.add(imported, visiting)
+        visiting.discard(name)
+        self.modules[name] = source
+        parent = name.rpartition('.')[0]
+        if parent:
+            self.add(parent, visiting)
+
+    def command(self):
+        """
+        :return: command which registers the bundled modules, runs the
+         script in the global namespace like BaseDevice.execfile and
+         unregisters the modules
+        """
+        if not self.modules:
+            return 'exec({!r})'.format(self.source)
+        lines = [BUNDLE_PRELUDE]
+        for name, source in self.modules.items():
+            lines.append('_mpy_module({!r}, {!r})'.format(name, source))
+        lines.append('try:\n'
+                     '    exec({!r})\n'
+                     'finally:\n'
+                     '    for _name in {!r}:\n'
+                     '        sys.modules.pop(_name, None)\n'
+                     '    del _mpy_module, _MpyModule, _name'
+                     .format(self.source, list(self.modules)))
+        return '\n'.join(lines)
@@ -0,0 +1,177 @@
+import base64
+import json
+import os
+import socket
+import sys
+import tempfile
+from contextlib import contextmanager
+
+from .base_device import BaseDevice, MpyDeviceError
+
+DEFAULT_SOCKET = os.path.join(tempfile.gettempdir(),
+                              'mpy_daemon-{}.sock'.format(os.getuid()))
+
+
+def encode(value):
+    if isinstance(value, (bytes, bytearray)):
+        return {'__bytes__': base64.b64encode(value).decode('ascii')}
+    return value
+
+
+def decode(value):
+    if isinstance(value, dict) and '__bytes__' in value:
+        return base64.b64decode(value['__bytes__'])
+    return value
+
+
+class DaemonDevice(BaseDevice):
+    """
+    micropython board interface through a mpy_daemon session
+
+    The daemon keeps the device connected and in raw REPL mode, so opening
+    a DaemonDevice skips the connect handshake. Every command is executed
+    atomically; use session() to execute a sequence of commands without
+    interleaving commands of other clients.
+.. code-block:: python
+
+        with DaemonDevice('/dev/tty.SLAB_USBtoUART') as dev:
+            with dev.session():
+                dev.exec('import machine')
+                freq = dev.eval('machine.freq()')
+
+    """
+    def __init__(self, dev, socket_path=None, compress=False):
+        super().__init__(compress=compress)
+        self.dev = dev
+        self.socket_path = socket_path or DEFAULT_SOCKET
+        self.socket = None
+        self.reader = None
+        self.connect()
+
+    def __repr__(self):
+        return 'DaemonDevice({}, {})'.format(self.dev, self.socket_path)
+
+    def connect(self):
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            self.socket.connect(self.socket_path)
+        except OSError as e:
+            self.socket.close()
+            raise MpyDeviceError('No mpy_daemon listening on {}: {}'
+                                 .format(self.socket_path, e))
+        self.reader = self.socket.makefile('rb')
+
+    def request(self, method, *args, output=None, **kwargs):
+        """
+        Executes a device method in the daemon.
+
+        :param method: name of the device method
+        :param output: File-object to redirect the output of stdout
+        :raises: MpyDeviceError: if the method raised an exception
+        :return: return value of the method
+        """
+        if method in ('put_file', 'get_file', 'put_file_delta'):
+            # the daemon runs in another working directory
+            index = 1 if method == 'get_file' else 0
+            args = list(args)
+            args[index] = os.path.abspath(str(args[index]))
+        message = {'device': self.dev, 'method': method,
+                   'args': [encode(a) for a in args],
+                   'kwargs': {k: encode(v) for k, v in kwargs.items()},
+                   'output': output is not None}
+        self.round_trips += 1
+        self.socket.sendall(json.dumps(message).encode() + b'\n')
+        while True:
+            response = self.response()
+            if 'output' in response:
+                output.write(response['output'])
+                output.flush()
+            elif 'error' in response:
+                raise MpyDeviceError(response['error'])
+            else:
+                return decode(response.get('result'))
+
+    def response(self):
+        line = self.reader.readline()
+        if not line:
+            raise MpyDeviceError('mpy_daemon closed the connection')
+        return json.loads(line.decode())
+
+    def stream_chunks(self, command):
+        """
+        Generator which yields the output of a command as the daemon
+        forwards it. Closing it before the end reconnects to the daemon,
+        which interrupts the command when it fails to forward the next
+        output. Sessions of the connection end with it.
+        """
+        message = {'device': self.dev, 'method': 'stream', 'args': [command],
+                   'kwargs': {}, 'output': True}
+        self.round_trips += 1
+        self.socket.sendall(json.dumps(message).encode() + b'\n')
+        finished = False
+        try:
+            while True:
+                response = self.response()
+                if 'output' in response:
+                    yield response['output']
+                    continue
+                finished = True
+                if 'error' in response:
+                    raise MpyDeviceError(response['error'])
+                return
+        finally:
+            if not finished:
+                self.close()
+                self.connect()
+
+    @contextmanager
+    def session(self):
+        """
+        Context manager which reserves the device for this client.
+        """
+        self.request('acquire')
+        try:
+            yield self
+        finally:
+            self.request('release')
+
+    def flush(self):
+        pass
+
+    def enter_raw_repl(self):
+        pass
+
+    def close(self):
+        if self.socket is not None:
+            self.reader.close()
+            self.socket.close()
+            self.socket = None
+
+    def exec(self, command, output=None):
+        return self.request('exec', command, output=output)
+
+    def eval(self, expression, output=None):
+        return self.request('eval', expression, output=output)
+
+    def execfile(self, filename, output=sys.stdout):
+        return self.request('execfile', filename, output=output)
+
+    def put_file(self, local, remote, **kwargs):
+        kwargs.setdefault('compress', self.compress)
+        return self.request('put_file', local, remote, **kwargs)
+
+    def put_file_delta(self, local, remote, **kwargs):
+        kwargs.setdefault('compress', self.compress)
+        return self.request('put_file_delta', local, remote, **kwargs)
+
+    def get_file(self, remote, local, **kwargs):
+        return self.request('get_file', remote, local, **kwargs)
+
+    def hash_blocks(self, remote, block_size=None):
+        return self.request('hash_blocks', remote, block_size=block_size)
+
+    def hash_files(self, paths):
+        return self.request('hash_files', [str(p) for p in paths])
+
+    def unique_id(self):
+        return self.request('unique_id')
@@ -0,0 +1,216 @@
+import bisect
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+
+class Histogram(object):
+    """
+    Distribution of observed values in cumulative buckets.
+    """
+    BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+               1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def __repr__(self):
+        return 'Histogram(count={}, sum={:.3f})'.format(self.count, self.sum)
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def cumulative(self):
+        """
+        :return: list of tuples of upper bound and number of values less or
+         equal, the last bound is '+Inf'
+        """
+        total = 0
+        bounds = []
+        for bound, count in zip(self.buckets + ('+Inf',), self.counts):
+            total += count
+            bounds.append((bound, total))
+        return bounds
+
+
+class Metrics(object):
+    """
+    Registry of counters and histograms
+
+    Instrumented code checks enabled before recording, so disabled metrics
+    cost a single attribute lookup. The default registry METRICS is enabled
+    if the environment variable MPY_METRICS is set.
+.. code-block:: python
+
+        METRICS.enable()
+        METRICS.start_dump('metrics.prom', interval=5, prometheus=True)
+        with MpyDevice('/dev/ttyUSB0') as dev:
+            dev.eval('machine.freq()')
+        print(METRICS.stats()['histograms'])
+
+    """
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.lock = threading.Lock()
+        self.counters = dict()
+        self.histograms = dict()
+        self.dumper = None
+        self.dumping = threading.Event()
+
+    def __repr__(self):
+        return 'Metrics(enabled={}, {} series)'.format(
+            self.enabled, len(self.counters) + len(self.histograms))
+
+    def enable(self):
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def reset(self):
+        with self.lock:
+            self.counters.clear()
+            self.histograms.clear()
+
+    @staticmethod
+    def key(name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    def count(self, name, value=1, **labels):
+        """
+        Increments a counter.
+
+        :param name: metric name
+        :param value: increment
+        :param labels: labels of the series
+        """
+        key = self.key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        """
+        Adds a value to a histogram.
+
+        :param name: metric name
+        :param value: observed value, e.g. a duration in seconds
+        :param labels: labels of the series
+        """
+        key = self.key(name, labels)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(value)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """
+        Context manager which observes its duration in seconds, if enabled.
+        """
+        if not self.enabled:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    @staticmethod
+    def series(name, labels, extra=()):
+        labels = tuple(labels) + tuple(extra)
+        if not labels:
+            return name
+        return '{}{{{}}}'.format(name, ','.join(
+            '{}="{}"'.format(k, str(v).replace('\\', '\\\\')
+                             .replace('"', '\\"')) for k, v in labels))
+
+    def stats(self):
+        """
+        :return: dict with the counters and with count, sum, mean and
+         cumulative buckets of the histograms, keyed by series name
+        """
+        with self.lock:
+            counters = {self.series(name, labels): value
+                        for (name, labels), value
+                        in sorted(self.counters.items())}
+            histograms = {self.series(name, labels): {
+                'count': h.count,
+                'sum': h.sum,
+                'mean': h.sum / h.count if h.count else 0.0,
+                'buckets': [[str(b), c] for b, c in h.cumulative()]}
+                for (name, labels), h in sorted(self.histograms.items())}
+        return {'counters': counters, 'histograms': histograms}
+
+    def prometheus(self):
+        """
+        :return: metrics in the Prometheus text exposition format
+        """
+        lines = []
+        typed = set()
+        with self.lock:
+            for (name, labels), value in sorted(self.counters.items()):
+                if name not in typed:
+                    typed.add(name)
+                    lines.append('# TYPE {} counter'.format(name))
+                lines.append('{} {}'.format(self.series(name, labels), value))
+            for (name, labels), h in sorted(self.histograms.items()):
+                if name not in typed:
+                    typed.add(name)
+                    lines.append('# TYPE {} histogram'.format(name))
+                for bound, count in h.cumulative():
+                    lines.append('{} {}'.format(self.series(
+                        name + '_bucket', labels, [('le', bound)]), count))
+                lines.append('{} {}'.format(
+                    self.series(name + '_sum', labels), h.sum))
+                lines.append('{} {}'.format(
+                    self.series(name + '_count', labels), h.count))
+        return '\n'.join(lines) + '\n'
+
+    def dump(self, path, prometheus=False):
+        """
+        Writes the metrics to a file, replacing it atomically.
+
+        :param path: file to write
+        :param prometheus: write the Prometheus text format instead of JSON
+        """
+        content = self.prometheus() if prometheus \
+            else json.dumps(self.stats(), indent=2)
+        tmp = '{}.{}.tmp'.format(path, os.getpid())
+        with open(tmp, 'w') as f:
+            f.write(content)
+        os.replace(tmp, path)
+
+    def start_dump(self, path, interval=10.0, prometheus=False):
+        """
+        Dumps the metrics periodically in a background thread until
+        stop_dump() is called, which writes a final dump.
+        """
+        self.stop_dump()
+        self.dumping.clear()
+
+        def run():
+            while not self.dumping.wait(interval):
+                self.dump(path, prometheus=prometheus)
+            self.dump(path, prometheus=prometheus)
+
+        self.dumper = threading.Thread(target=run, name='mpy-metrics',
+                                       daemon=True)
+        self.dumper.start()
+
+    def stop_dump(self):
+        if self.dumper is not None:
+            self.dumping.set()
+            self.dumper.join()
+            self.dumper = None
+
+
+METRICS = Metrics(enabled=bool(os.environ.get('MPY_METRICS')))
@@ -0,0 +1,166 @@
+import struct
+
+from .base_device import MpyDeviceError
+
+
+class RawRepl(object):
+    """
+    Protocol of the micropython raw REPL, shared by SerialRepl and
+    AsyncSerialRepl.
+
+    The protocol steps are generators which yield I/O requests as tuples
+    of an operation and its argument and receive the results, so the
+    transports only perform the I/O, blocking or with asyncio:
+
+    * WRITE, bytes: writes the bytes, no result
+    * READ_BYTES, size: result are the next size bytes
+    * READ_UNTIL, marker: result is the text in front of the marker, the
+      marker is consumed
+    * STREAM_UNTIL, marker: passes the text in front of the marker on to
+      the caller of the transport as it arrives, no result
+    * PENDING, None: result is True if received bytes wait to be read
+    """
+    CTRL_A = b'\x01'
+    CTRL_B = b'\x02'
+    CTRL_C = b'\x03'
+    CTRL_D = b'\x04'
+    CTRL_E = b'\x05'
+
+    ENTER_RAW_REPL = CTRL_A
+    COMMAND_TERMINATION = CTRL_D
+    PROMPT = 'raw REPL; CTRL-B to exit\r\n>'
+
+    RAW_PASTE_REQUEST = CTRL_E + b'A' + CTRL_A
+    RAW_PASTE_SUPPORTED = b'R\x01'
+    RAW_PASTE_UNSUPPORTED = b'R\x00'
+    RAW_PASTE_WINDOW_INCREMENT = CTRL_A
+    RAW_PASTE_END = CTRL_D
+
+    WRITE = 'write'
+    READ_BYTES = 'read_bytes'
+    READ_UNTIL = 'read_until'
+    STREAM_UNTIL = 'stream_until'
+    PENDING = 'pending'
+
+    def __init__(self, raw_paste=True):
+        """
+        :param raw_paste: use raw-paste mode if the firmware supports it
+        """
+        self.raw_paste = raw_paste
+        # a command was submitted and its prompt was not received yet
+        self.busy = False
+        # the submission finished and the output of the command is streamed
+        self.running = False
+
+    def __repr__(self):
+        return 'RawRepl(raw_paste={})'.format(self.raw_paste)
+
+    @staticmethod
+    def take_until(buffer, until, decoder):
+        """
+        Removes the data in front of a marker from a read buffer. If the
+        marker was not received yet, only the data which cannot be part of
+        the marker is removed.
+
+        :param buffer: bytearray of received data
+        :param until: marker as bytes
+        :param decoder: incremental utf-8 decoder of the read
+        :return: tuple of the decoded text and whether the marker was found,
+         a found marker is consumed
+        """
+        index = buffer.find(until)
+        if index >= 0:
+            text = decoder.decode(bytes(buffer[:index]), final=True)
+            del buffer[:index + len(until)]
+            return text, True
+        # everything in front of a partial marker can be passed on
+        start = max(0, len(buffer) - len(until) + 1)
+        text = decoder.decode(bytes(buffer[:start]))
+        del buffer[:start]
+        return text, False
+
+    def enter(self):
+        """
+        Steps which enter the raw REPL.
+        """
+        yield self.WRITE, self.ENTER_RAW_REPL
+        yield self.READ_UNTIL, self.PROMPT
+
+    def execute(self, command):
+        """
+        Steps which submit a command, stream its output on stdout and wait
+        for the prompt of the next command.
+
+        :param command: command as bytes
+        :raises: MpyDeviceError: after the output if the command raised an
+         Exception on the board
+        """
+        self.busy = True
+        yield from self.send(command)
+        self.running = True
+        try:
+            yield self.STREAM_UNTIL, '\x04'
+        finally:
+            self.running = False
+        err = yield self.READ_UNTIL, '\x04'
+        yield self.READ_UNTIL, '>'
+        self.busy = False
+        if err:
+            raise MpyDeviceError(err)
+
+    def send(self, command):
+        """
+        Steps which submit a command to the raw REPL.
+        Uses the raw-paste protocol if the firmware supports it, otherwise
+        the command is written at once.
+
+        :param command: command as bytes
+        """
+        if self.raw_paste:
+            sent = yield from self.send_raw_paste(command)
+            if sent:
+                return
+        yield self.WRITE, command + self.COMMAND_TERMINATION
+        yield self.READ_UNTIL, 'OK'
+
+    def send_raw_paste(self, command):
+        """
+        Steps which submit a command with the raw-paste protocol, which lets
+        the device control the data flow through a window size.
+
+        :param command: command as bytes
+        :raises: MpyDeviceError: on protocol errors
+        :return: False if the firmware does not support raw-paste mode
+        """
+        yield self.WRITE, self.RAW_PASTE_REQUEST
+        response = yield self.READ_BYTES, 2
+        if response != self.RAW_PASTE_SUPPORTED:
+            if response != self.RAW_PASTE_UNSUPPORTED:
+                # firmware without raw-paste just reenters the raw REPL
+                yield self.READ_UNTIL, 'w REPL; CTRL-B to exit\r\n>'
+            self.raw_paste = False
+            return False
+
+        window_size = struct.unpack('<H', (yield self.READ_BYTES, 2))[0]
+        window = window_size
+        sent = 0
+        while sent < len(command):
+            while window == 0 or (yield self.PENDING, None):
+                flow = yield self.READ_BYTES, 1
+                if flow == self.RAW_PASTE_WINDOW_INCREMENT:
+                    window += window_size
+                elif flow == self.RAW_PASTE_END:
+                    # device aborted, acknowledge and read the error
+                    yield self.WRITE, self.RAW_PASTE_END
+                    return True
+                else:
+                    raise MpyDeviceError('Unexpected raw-paste flow control '
+                                         'byte {!r}'.format(flow))
+            chunk = command[sent:sent + window]
+            yield self.WRITE, chunk
+            window -= len(chunk)
+            sent += len(chunk)
+
+        yield self.WRITE, self.RAW_PASTE_END
+        yield self.READ_UNTIL, '\x04'
+        return True
@@ -1,9 +1,17 @@
+import base64
+import codecs
+import json
+import os
 import re
+import time
+from pathlib import Path
 
 import serial
 
 
 from .base_device import BaseDevice, MpyDeviceError
+from .metrics import METRICS
+from .raw_repl import RawRepl
 
 
 class SerialRepl(BaseDevice):
@@ -20,23 +28,62 @@ class SerialRepl(BaseDevice):
             dev.execfile('main.py')
 
     """
-    CTRL_A = b'\x01'
-    CTRL_B = b'\x02'
-    CTRL_C = b'\x03'
-    CTRL_D = b'\x04'
+    CTRL_A = RawRepl.CTRL_A
+    CTRL_B = RawRepl.CTRL_B
+    CTRL_C = RawRepl.CTRL_C
+    CTRL_D = RawRepl.CTRL_D
+    CTRL_E = RawRepl.CTRL_E
 
     ENTER_REPL = CTRL_B
-    ENTER_RAW_REPL = CTRL_A
+    ENTER_RAW_REPL = RawRepl.ENTER_RAW_REPL
     SOFT_REBOOT = CTRL_D
-    COMMAND_TERMINATION = CTRL_D
+    COMMAND_TERMINATION = RawRepl.COMMAND_TERMINATION
 
     FLUSH_SIZE = 1024
+    INTERRUPTIBLE = True
 
     DEFAULT_BAUDRATE = 115200
+    READ_TIMEOUT = 0.05
 
-    def __init__(self, dev):
+    # candidates of the baud rate upgrade, tried from the fastest
+    BAUDRATES = (2000000, 1500000, 921600, 460800, 230400)
+    BAUDRATE_CACHE = Path('~/.cache/mpy_dev_tools/baudrates.json')
+    BAUDRATE_ACK = b'\x06'
+    # seconds the host waits for the acknowledge at the new rate, the
+    # device waits twice as long before it restores the previous rate
+    BAUDRATE_TIMEOUT = 0.5
+    ECHO_SIZE = 192
+    REPL_UART = 0
+    BAUDRATE_COMMAND = """\
+import machine, select, sys, time
+time.sleep_ms(20)
+machine.UART({uart}, {baudrate})
+_poll = select.poll()
+_poll.register(sys.stdin, select.POLLIN)
+sys.stdout.write('\\x06')
+if not (_poll.poll({timeout}) and sys.stdin.read(1) == '\\x06'):
+    machine.UART({uart}, {previous})
+del _poll"""
+
+    def __init__(self, dev, timeout=None, raw_paste=True, compress=False,
+                 upgrade=False):
+        """
+        :param dev: serial port of the device
+        :param timeout: seconds to wait for responses, None waits forever
+        :param raw_paste: use raw-paste mode if the firmware supports it
+        :param compress: compress file transfers
+        :param upgrade: switch the REPL UART of the device to the fastest
+         working rate of BAUDRATES when entering the raw REPL, see
+         upgrade_baudrate()
+        """
+        super().__init__(compress=compress)
         self.dev = dev
+        self.timeout = timeout
+        self.protocol = RawRepl(raw_paste=raw_paste)
+        self.upgrade = upgrade
+        self.upgraded = False
         self.serial = None
+        self.buffer = bytearray()
         self.mpy_version = None
         self.git_hash = None
         self.build_date = None
@@ -46,23 +93,105 @@ class SerialRepl(BaseDevice):
     def connect(self):
         self.serial = serial.Serial(self.dev,
                                     baudrate=SerialRepl.DEFAULT_BAUDRATE,
-                                    timeout=0)
+                                    timeout=SerialRepl.READ_TIMEOUT)
         self.serial.write(SerialRepl.CTRL_C+SerialRepl.CTRL_C)
         self.flush()
 
     def flush(self):
+        self.buffer.clear()
         while self.serial.read(SerialRepl.FLUSH_SIZE) != b'':
             pass
 
-    def read_until(self, until, output=None):
-        buf = b''
-        while buf[-len(until):] != until.encode():
-            c = self.serial.read(1)
+    def write(self, data):
+        self.serial.write(data)
+        if METRICS.enabled:
+            METRICS.count('mpy_bytes_sent_total', len(data),
+                          transport='serial')
+
+    def fill(self, deadline=None):
+        """
+        Appends all bytes waiting at the serial port to the read buffer.
+        Blocks up to READ_TIMEOUT if no bytes are waiting.
+
+        :param deadline: time.monotonic() value after which waiting fails
+        :raises: MpyDeviceError: if the deadline passed without new data
+        :return: number of bytes read
+        """
+        data = self.serial.read(max(1, self.serial.in_waiting))
+        if data:
+            self.buffer += data
+            if METRICS.enabled:
+                METRICS.count('mpy_bytes_received_total', len(data),
+                              transport='serial')
+        elif deadline is not None and time.monotonic() > deadline:
+            raise MpyDeviceError('Timeout while reading from {}'
+                                 .format(self.dev))
+        return len(data)
+
+    def iter_until(self, until, timeout=None):
+        """
+        Generator which reads from the device until a marker is received
+        and yields the decoded data in front of it as it arrives. Yielded
+        bytes are removed from the read buffer, so its size is bounded by
+        the reads instead of the total data. The marker is consumed, bytes
+        received after the marker stay in the read buffer.
+
+        :param until: marker to read until
+        :param timeout: seconds to wait for the marker, defaults to the
+         timeout of the instance (None waits forever)
+        :raises: MpyDeviceError: if the marker was not received in time
+        :return: yields received data as strings
+        """
+        until = until.encode()
+        timeout = self.timeout if timeout is None else timeout
+        deadline = None if timeout is None else time.monotonic() + timeout
+        decoder = codecs.getincrementaldecoder('utf-8')('replace')
+
+        while True:
+            text, found = RawRepl.take_until(self.buffer, until, decoder)
+            if text:
+                yield text
+            if found:
+                return
+            self.fill(deadline)
+
+    def read_until(self, until, output=None, timeout=None):
+        """
+        Reads from the device until a marker is received.
+        Everything in front of the marker is returned, the marker itself is
+        consumed. Bytes received after the marker stay in the read buffer.
+
+        :param until: marker to read until
+        :param output: File-object to redirect the received data
+        :param timeout: seconds to wait for the marker, defaults to the
+         timeout of the instance (None waits forever)
+        :raises: MpyDeviceError: if the marker was not received in time
+        :return: received data as string
+        """
+        received = []
+        for text in self.iter_until(until, timeout=timeout):
             if output:
-                print(c.decode('utf-8'), file=output, end='')
+                output.write(text)
                 output.flush()
-            buf += c
-        return buf[:-len(until)].decode('utf8')
+            received.append(text)
+        return ''.join(received)
+
+    def read_bytes(self, size, timeout=None):
+        """
+        Reads an exact number of bytes from the device.
+
+        :param size: number of bytes to read
+        :param timeout: seconds to wait, defaults to the instance timeout
+        :raises: MpyDeviceError: if the bytes were not received in time
+        :return: received bytes
+        """
+        timeout = self.timeout if timeout is None else timeout
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while len(self.buffer) < size:
+            self.fill(deadline)
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
 
     def readline(self):
         return self.read_until('\r\n')
@@ -86,7 +215,7 @@ class SerialRepl(BaseDevice):
         return False
 
     def enter_repl(self):
-        self.serial.write(SerialRepl.ENTER_REPL)
+        self.write(SerialRepl.ENTER_REPL)
         lines = self.readlines(4)
 
         while not self.set_info_from_string(next(lines)):
@@ -98,13 +227,180 @@ class SerialRepl(BaseDevice):
         if next(lines) != '>>> ':
             raise SerialRepl('Error starting REPL')
 
+    def perform(self, steps):
+        """
+        Generator which performs the I/O requests of RawRepl protocol steps
+        and yields the output they stream. If the generator is closed
+        while the output is streamed, the command is interrupted with
+        CTRL-C and the rest of its output is discarded.
+
+        :param steps: generator of RawRepl protocol steps
+        :return: yields received data as strings
+        """
+        result = None
+        while True:
+            try:
+                op, arg = steps.send(result)
+            except StopIteration:
+                return
+            result = None
+            if op == RawRepl.STREAM_UNTIL:
+                finished = False
+                try:
+                    yield from self.iter_until(arg)
+                    finished = True
+                finally:
+                    if not finished:
+                        self.interrupt()
+            elif op == RawRepl.WRITE:
+                self.write(arg)
+            elif op == RawRepl.READ_UNTIL:
+                result = self.read_until(arg)
+            elif op == RawRepl.READ_BYTES:
+                result = self.read_bytes(arg)
+            elif op == RawRepl.PENDING:
+                result = bool(self.buffer or self.serial.in_waiting)
+
+    def complete(self, steps):
+        """
+        Performs RawRepl protocol steps which stream no output.
+        """
+        for _ in self.perform(steps):
+            pass
+
     def enter_raw_repl(self):
-        self.serial.write(SerialRepl.ENTER_RAW_REPL)
-        self.read_until('raw REPL; CTRL-B to exit\r\n>')
+        self.complete(self.protocol.enter())
+        if self.upgrade and not self.upgraded:
+            self.upgraded = True
+            self.upgrade_baudrate()
 
     def close(self):
+        if self.serial.baudrate != SerialRepl.DEFAULT_BAUDRATE:
+            # leave the device at the rate other tools expect
+            try:
+                self.change_baudrate(SerialRepl.DEFAULT_BAUDRATE)
+            except (MpyDeviceError, serial.SerialException):
+                pass
         self.serial.close()
 
+    @classmethod
+    def load_baudrates(cls):
+        try:
+            with cls.BAUDRATE_CACHE.expanduser().open() as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return dict()
+
+    @classmethod
+    def store_baudrate(cls, dev, baudrate):
+        path = cls.BAUDRATE_CACHE.expanduser()
+        baudrates = cls.load_baudrates()
+        baudrates[dev] = baudrate
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            tmp = '{}.{}.tmp'.format(path, os.getpid())
+            with open(tmp, 'w') as f:
+                json.dump(baudrates, f, indent=2, sort_keys=True)
+            os.replace(tmp, str(path))
+        except OSError:
+            pass
+
+    def upgrade_baudrate(self):
+        """
+        Switches the host port and the REPL UART of the device to the
+        fastest working baud rate. Starts with the rate cached for the
+        port, otherwise with the fastest of BAUDRATES, and steps down on
+        errors. The result is cached per port, so later sessions switch
+        at the first attempt or do not try at all if no rate worked.
+
+        :return: negotiated baud rate
+        """
+        cached = self.load_baudrates().get(self.dev)
+        if cached is not None and cached <= SerialRepl.DEFAULT_BAUDRATE:
+            return self.serial.baudrate
+        candidates = [b for b in SerialRepl.BAUDRATES
+                      if cached is None or b < cached]
+        if cached is not None:
+            candidates.insert(0, cached)
+        baudrate = SerialRepl.DEFAULT_BAUDRATE
+        for candidate in candidates:
+            if self.change_baudrate(candidate):
+                baudrate = candidate
+                break
+        self.store_baudrate(self.dev, baudrate)
+        return baudrate
+
+    def change_baudrate(self, baudrate):
+        """
+        Switches the host port and the REPL UART of the device to a baud
+        rate and checks the link with an echo round trip. The device
+        restores its previous rate if the host does not acknowledge the
+        switch, so both sides end on a common rate if it fails.
+
+        :param baudrate: new baud rate
+        :raises: MpyDeviceError: if the device is not reachable afterwards
+        :return: True if the link works at the new rate
+        """
+        previous = self.serial.baudrate
+        command = SerialRepl.BAUDRATE_COMMAND.format(
+            uart=SerialRepl.REPL_UART, baudrate=baudrate, previous=previous,
+            timeout=int(SerialRepl.BAUDRATE_TIMEOUT * 2000))
+        self.round_trips += 1
+        self.write(command.encode() + SerialRepl.COMMAND_TERMINATION)
+        self.read_until('OK')
+        self.serial.baudrate = baudrate
+        try:
+            self.read_until(SerialRepl.BAUDRATE_ACK.decode(),
+                            timeout=SerialRepl.BAUDRATE_TIMEOUT)
+            self.write(SerialRepl.BAUDRATE_ACK)
+            self.read_until('\x04', timeout=SerialRepl.BAUDRATE_TIMEOUT)
+            err = self.read_until('\x04', timeout=SerialRepl.BAUDRATE_TIMEOUT)
+            self.read_until('>', timeout=SerialRepl.BAUDRATE_TIMEOUT)
+            if not err and self.echo():
+                return True
+        except MpyDeviceError:
+            pass
+        self.resynchronize((previous, baudrate))
+        return False
+
+    def echo(self):
+        """
+        :return: True if random data is echoed unchanged by the device
+        """
+        data = base64.b64encode(os.urandom(SerialRepl.ECHO_SIZE)).decode()
+        timeout, self.timeout = self.timeout, SerialRepl.BAUDRATE_TIMEOUT * 2
+        try:
+            return self.exec('print({!r})'.format(data)).strip() == data
+        except MpyDeviceError:
+            return False
+        finally:
+            self.timeout = timeout
+
+    def resynchronize(self, baudrates):
+        """
+        Finds the baud rate the device answers at after a failed change.
+
+        :param baudrates: rates to try in order
+        :raises: MpyDeviceError: if the device answers at none of them
+        """
+        # let the device restore its previous rate
+        time.sleep(SerialRepl.BAUDRATE_TIMEOUT * 2)
+        for baudrate in baudrates:
+            self.serial.baudrate = baudrate
+            self.write(SerialRepl.CTRL_C)
+            time.sleep(SerialRepl.READ_TIMEOUT)
+            self.flush()
+            try:
+                self.write(SerialRepl.ENTER_RAW_REPL)
+                self.read_until(RawRepl.PROMPT,
+                                timeout=SerialRepl.BAUDRATE_TIMEOUT)
+            except MpyDeviceError:
+                continue
+            if self.echo():
+                return
+        raise MpyDeviceError('{} does not answer at {} baud'.format(
+            self.dev, ' or '.join(str(b) for b in baudrates)))
+
     def exec(self, command, output=None):
         """
         Executes a python expression or statement on the device
@@ -114,13 +410,56 @@ class SerialRepl(BaseDevice):
         :raises: MpyDeviceError: if the command raises an Exception on the board
         :return: output on stdout as string
         """
-        self.serial.write(command.encode() + SerialRepl.COMMAND_TERMINATION)
-        self.read_until('OK', output=None)
-        ret = self.read_until('\x04', output=output)
-        err = self.read_until('\x04', output=None)
-        if err:
-            raise MpyDeviceError(err)
-        return ret
+        self.round_trips += 1
+        received = []
+        with METRICS.timer('mpy_command_seconds', transport='serial'):
+            for text in self.perform(self.protocol.execute(command.encode())):
+                if output:
+                    output.write(text)
+                    output.flush()
+                received.append(text)
+        return ''.join(received)
+
+    def stream_chunks(self, command):
+        """
+        Generator which executes a command and yields its output on stdout
+        as it is received. If the generator is closed before the end of the
+        output, the command is interrupted with CTRL-C and the rest of its
+        output is discarded.
+        """
+        self.round_trips += 1
+        yield from self.perform(self.protocol.execute(command.encode()))
+
+    def interrupt(self):
+        """
+        Interrupts the running command and discards its remaining output,
+        so the raw REPL accepts the next command.
+        """
+        self.write(SerialRepl.CTRL_C)
+        try:
+            for _ in self.iter_until('\x04', timeout=1):
+                pass
+            self.read_until('\x04', timeout=1)
+            self.read_until('>', timeout=1)
+        except MpyDeviceError:
+            # the device did not answer as expected, resynchronize
+            self.flush()
+            self.enter_raw_repl()
+
+    def request_interrupt(self):
+        if not self.protocol.running:
+            # CTRL-C would break the submission, e.g. the raw-paste handshake
+            return False
+        self.write(SerialRepl.CTRL_C)
+        return True
+
+    def send(self, command):
+        """
+        Submits a command to the raw REPL, see RawRepl.send.
+
+        :param command: command as bytes
+        """
+        self.complete(self.protocol.send(command))
 
     def eval(self, expression, output=None):
         """
@@ -0,0 +1,694 @@
+"""
+Module to emulate a micropython device on a pseudo-terminal.
+
+The emulator speaks the (raw) REPL protocol of a micropython board and
+executes the received commands with CPython. Commands run in their own
+namespace and see a directory on the host as device file system. The
+namespace isolates the commands from the tools but is no security boundary.
+"""
+import builtins
+import ctypes
+import errno
+import hashlib
+import io
+import os
+import pty
+import re
+import select
+import shutil
+import struct
+import sys
+import tempfile
+import termios
+import threading
+import time
+import tty
+import types
+import zlib
+import binascii
+import json
+
+
+class DeviceOSError(OSError):
+    """
+    OSError formatted like on micropython, e.g. [Errno 2] ENOENT
+    """
+    def __init__(self, code):
+        super().__init__(code, errno.errorcode.get(code, ''))
+
+    def __str__(self):
+        return '[Errno {}] {}'.format(
+            self.errno, errno.errorcode.get(self.errno, ''))
+
+
+DeviceOSError.__name__ = 'OSError'
+DeviceOSError.__qualname__ = 'OSError'
+
+
+class DeviceOutput(object):
+    """
+    File-like object which sends the output of a command to the host.
+    """
+    def __init__(self, emulator):
+        self.emulator = emulator
+
+    def write(self, s):
+        self.emulator.send(s.replace('\n', '\r\n').encode())
+        return len(s)
+
+    def flush(self):
+        pass
+
+
+class DeviceInput(object):
+    """
+    File-like object which reads the bytes the host sends while a command
+    runs.
+    """
+    def __init__(self, emulator):
+        self.emulator = emulator
+
+    def read(self, size=1):
+        data = self.emulator.read_stdin(size)
+        return data.decode('utf8', 'replace')
+
+
+class DevicePoll(object):
+    """
+    select.poll of the emulated device, stdin is the only pollable stream.
+    """
+    def __init__(self, emulator):
+        self.emulator = emulator
+        self.registered = dict()
+
+    def register(self, stream, eventmask=select.POLLIN):
+        self.registered[id(stream)] = (stream, eventmask)
+
+    def modify(self, stream, eventmask):
+        self.register(stream, eventmask)
+
+    def unregister(self, stream):
+        self.registered.pop(id(stream), None)
+
+    def poll(self, timeout=-1):
+        """
+        :param timeout: milliseconds to wait, negative waits forever
+        """
+        deadline = None if timeout is None or timeout < 0 \
+            else time.monotonic() + timeout / 1000
+        stdin = self.emulator.stdin_stream
+        while True:
+            if self.emulator.stdin and id(stdin) in self.registered:
+                return [(stdin, select.POLLIN)]
+            if deadline is not None and time.monotonic() >= deadline:
+                return []
+            time.sleep(0.005)
+
+    ipoll = poll
+
+
+class DeviceUART(object):
+    """
+    machine.UART of the emulated device, UART 0 is the REPL.
+    """
+    def __init__(self, emulator, id, baudrate=None, **kwargs):
+        self.emulator = emulator
+        self.id = id
+        self.init(baudrate=baudrate)
+
+    def init(self, baudrate=None, **kwargs):
+        if self.id == 0 and baudrate:
+            self.emulator.set_uart_baudrate(baudrate)
+
+    def any(self):
+        return 0
+
+    def read(self, size=None):
+        return None
+
+    def write(self, data):
+        return len(data)
+
+
+class DeviceFileSystem(object):
+    """
+    os module of the emulated device, operating on a host directory.
+    """
+    def __init__(self, root):
+        self.root = os.path.realpath(root)
+        self.cwd = '/'
+
+    def __repr__(self):
+        return 'DeviceFileSystem({})'.format(self.root)
+
+    def path(self, path):
+        """
+        :return: host path of a device path, which cannot leave the root
+        """
+        path = os.path.normpath(os.path.join(self.cwd, str(path)))
+        return os.path.join(self.root, path.lstrip('/'))
+
+    def call(self, function, *args):
+        try:
+            return function(*args)
+        except OSError as e:
+            raise DeviceOSError(e.errno or errno.EIO)
+
+    def open(self, path, mode='r', *args, **kwargs):
+        return self.call(open, self.path(path), mode, *args, **kwargs)
+
+    def stat(self, path):
+        st = self.call(os.stat, self.path(path))
+        mtime = int(st.st_mtime)
+        mode = 0x4000 if os.path.isdir(self.path(path)) else 0x8000
+        return mode, 0, 0, 0, 0, 0, st.st_size, mtime, mtime, mtime
+
+    def statvfs(self, path):
+        usage = self.call(shutil.disk_usage, self.path(path))
+        blocks = 4096
+        return (blocks, blocks, usage.total // blocks, usage.free // blocks,
+                usage.free // blocks, 0, 0, 0, 0, 255)
+
+    def ilistdir(self, path='.'):
+        for name in sorted(self.call(os.listdir, self.path(path))):
+            host = os.path.join(self.path(path), name)
+            kind = 0x4000 if os.path.isdir(host) else 0x8000
+            yield name, kind, 0, os.path.getsize(host)
+
+    def listdir(self, path='.'):
+        return [entry[0] for entry in self.ilistdir(path)]
+
+    def mkdir(self, path):
+        self.call(os.mkdir, self.path(path))
+
+    def rmdir(self, path):
+        self.call(os.rmdir, self.path(path))
+
+    def remove(self, path):
+        self.call(os.remove, self.path(path))
+
+    def rename(self, old, new):
+        self.call(os.rename, self.path(old), self.path(new))
+
+    def getcwd(self):
+        return self.cwd
+
+    def chdir(self, path):
+        path = os.path.normpath(os.path.join(self.cwd, path))
+        if not os.path.isdir(self.path(path)):
+            raise DeviceOSError(errno.ENOENT)
+        self.cwd = path
+
+    def sync(self):
+        pass
+
+    def uname(self):
+        return ('emulator', 'emulator', MpyEmulator.VERSION,
+                MpyEmulator.VERSION, MpyEmulator.BOARD)
+
+
+class MpyEmulator(object):
+    """
+    micropython device emulator
+
+    Serves the raw REPL protocol including raw-paste mode on a
+    pseudo-terminal, which can be opened like a serial port. The link
+    works if the baud rate of the host port matches the REPL UART of the
+    device, which can be changed with machine.UART(0, baudrate), and does
+    not exceed max_baudrate. Otherwise both directions receive garbage.
+.. code-block:: python
+
+        with MpyEmulator(baudrate=115200, latency=0.002) as emulator:
+            with MpyDevice(emulator.port) as dev:
+                dev.exec('import machine')
+                freq = dev.eval('machine.freq()')
+
+    """
+    VERSION = '1.20.0'
+    BOARD = 'CPython emulator'
+    BANNER = 'MicroPython v{}-0-g00000000 on 2024-01-01; {}'.format(
+        VERSION, BOARD)
+    RAW_REPL_BANNER = b'raw REPL; CTRL-B to exit\r\n>'
+    DEFAULT_BAUDRATE = 115200
+    SPEEDS = {getattr(termios, name): int(name[1:]) for name in dir(termios)
+              if re.match(r'B\d+$', name)}
+    WINDOW_SIZE = 128
+    READ_SIZE = 4096
+
+    def __init__(self, root=None, baudrate=None, latency=0.0,
+                 window_size=WINDOW_SIZE, max_baudrate=None,
+                 raw_paste=True):
+        """
+        :param root: host directory used as device file system, defaults
+         to a temporary directory removed by stop()
+        :param baudrate: emulated baud rate to throttle the transfer, None
+         transfers at full speed. Follows changes of the REPL UART.
+        :param latency: seconds added to the response of every command
+        :param window_size: raw-paste window size
+        :param max_baudrate: fastest REPL UART rate which transfers
+         correctly, None if all rates work
+        :param raw_paste: support raw-paste mode, otherwise requests are
+         answered like firmware before raw-paste mode
+        """
+        self.temporary = root is None
+        self.root = tempfile.mkdtemp(prefix='mpy_emulator_') \
+            if root is None else root
+        self.baudrate = baudrate
+        self.latency = latency
+        self.window_size = window_size
+        self.max_baudrate = max_baudrate
+        self.raw_paste = raw_paste
+        self.uart_baudrate = self.DEFAULT_BAUDRATE
+        self.fs = DeviceFileSystem(self.root)
+        self.output = DeviceOutput(self)
+        self.stdin = bytearray()
+        self.stdin_stream = DeviceInput(self)
+        self.master = None
+        self.slave = None
+        self.port = None
+        self.thread = None
+        self.running = False
+        self.write_lock = threading.Lock()
+        self.command = None
+        self.mode = 'friendly'
+        self.line = bytearray()
+        self.paste = None
+        self.pasted = 0
+        self.modules = dict()
+        self.namespace = None
+        self.reset()
+
+    def __repr__(self):
+        return 'MpyEmulator(port={}, root={}, baudrate={}, latency={})'\
+            .format(self.port, self.root, self.baudrate, self.latency)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+    def start(self):
+        """
+        Opens the pseudo-terminal and serves it in a background thread.
+
+        :return: path of the device to open with MpyDevice
+        """
+        self.master, self.slave = pty.openpty()
+        tty.setraw(self.slave)
+        self.port = os.ttyname(self.slave)
+        self.running = True
+        self.thread = threading.Thread(target=self.serve,
+                                       name='mpy-emulator', daemon=True)
+        self.thread.start()
+        return self.port
+
+    def stop(self):
+        self.running = False
+        self.interrupt()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        for fd in (self.master, self.slave):
+            if fd is not None:
+                os.close(fd)
+        self.master = self.slave = None
+        if self.temporary:
+            shutil.rmtree(self.root, ignore_errors=True)
+
+    def throttle(self, size):
+        if self.baudrate:
+            # 8N1: ten bits per byte
+            time.sleep(size * 10 / self.baudrate)
+
+    def send(self, data):
+        with self.write_lock:
+            self.throttle(len(data))
+            os.write(self.master, data if self.link() else self.garble(data))
+
+    def link(self):
+        """
+        :return: True if host and device transfer at the same working rate
+        """
+        speed = termios.tcgetattr(self.slave)[5]
+        return self.SPEEDS.get(speed) == self.uart_baudrate and (
+            self.max_baudrate is None
+            or self.uart_baudrate <= self.max_baudrate)
+
+    @staticmethod
+    def garble(data):
+        return b'\xff' * len(data)
+
+    def set_uart_baudrate(self, baudrate):
+        self.uart_baudrate = baudrate
+        if self.baudrate:
+            self.baudrate = baudrate
+
+    def read_stdin(self, size):
+        """
+        Blocks until the host sent size bytes to the running command.
+        """
+        while len(self.stdin) < size:
+            time.sleep(0.005)
+        data = bytes(self.stdin[:size])
+        del self.stdin[:size]
+        return data
+
+    #
+    # Device namespace
+    #
+
+    def reset(self):
+        """
+        Soft reboot: clears the namespace and the imported modules.
+        """
+        self.modules.clear()
+        self.namespace = {'__name__': '__main__',
+                          '__builtins__': self.device_builtins()}
+
+    def device_builtins(self):
+        device_builtins = dict(vars(builtins))
+        for name in ('input', 'exit', 'quit', 'help', 'breakpoint'):
+            device_builtins.pop(name, None)
+        device_builtins['open'] = self.fs.open
+        device_builtins['print'] = self.print
+        device_builtins['__import__'] = self.import_module
+        device_builtins['exec'] = self.exec
+        device_builtins['eval'] = self.eval
+        return device_builtins
+
+    def exec(self, source, globals=None, locals=None):
+        # without __builtins__ CPython would add the builtins of the host
+        globals = self.namespace if globals is None else globals
+        globals.setdefault('__builtins__', self.namespace['__builtins__'])
+        exec(source, globals, locals)
+
+    def eval(self, source, globals=None, locals=None):
+        globals = self.namespace if globals is None else globals
+        globals.setdefault('__builtins__', self.namespace['__builtins__'])
+        return eval(source, globals, locals)
+
+    def print(self, *args, **kwargs):
+        kwargs.setdefault('file', self.output)
+        print(*args, **kwargs)
+
+    def sleep(self, seconds):
+        # short steps, so CTRL-C interrupts sleeping commands
+        end = time.monotonic() + seconds
+        while time.monotonic() < end:
+            time.sleep(min(0.01, max(0.0, end - time.monotonic())))
+
+    def device_module(self, name):
+        """
+        :return: emulated micropython module or None
+        """
+        module = types.ModuleType(name)
+        if name in ('os', 'uos'):
+            for attr in ('stat', 'statvfs', 'ilistdir', 'listdir', 'mkdir',
+                         'rmdir', 'remove', 'rename', 'getcwd', 'chdir',
+                         'sync', 'uname'):
+                setattr(module, attr, getattr(self.fs, attr))
+        elif name in ('time', 'utime'):
+            module.time = time.time
+            module.localtime = time.localtime
+            module.sleep = self.sleep
+            module.sleep_ms = lambda ms: self.sleep(ms / 1000)
+            module.sleep_us = lambda us: self.sleep(us / 1000000)
+            module.ticks_ms = lambda: int(time.monotonic() * 1000)
+            module.ticks_us = lambda: int(time.monotonic() * 1000000)
+            module.ticks_diff = lambda a, b: a - b
+        elif name in ('sys', 'usys'):
+            module.modules = self.modules
+            module.path = ['', '/lib']
+            module.platform = 'emulator'
+            module.version = '3.4.0'
+            module.implementation = types.SimpleNamespace(
+                name='micropython',
+                version=tuple(int(v) for v in self.VERSION.split('.')))
+            module.stdout = self.output
+            module.stdin = self.stdin_stream
+            module.print_exception = lambda e, file=self.output: print(
+                self.format_exception(e), file=file)
+            module.exit = sys.exit
+        elif name == 'machine':
+            module.unique_id = lambda: hashlib.sha256(
+                self.root.encode()).digest()[:6]
+            module.freq = lambda: 160000000
+            module.UART = lambda *args, **kwargs: DeviceUART(
+                self, *args, **kwargs)
+            module.idle = lambda: None
+            module.reset = self.reset
+            module.soft_reset = self.reset
+        elif name == 'gc':
+            module.collect = lambda: None
+            module.mem_free = lambda: 100000
+            module.mem_alloc = lambda: 10000
+        elif name == 'micropython':
+            module.const = lambda value: value
+        elif name in ('select', 'uselect'):
+            module.POLLIN = select.POLLIN
+            module.POLLOUT = select.POLLOUT
+            module.POLLERR = select.POLLERR
+            module.POLLHUP = select.POLLHUP
+            module.poll = lambda: DevicePoll(self)
+        else:
+            return {'ubinascii': binascii, 'binascii': binascii,
+                    'uhashlib': hashlib, 'hashlib': hashlib,
+                    'ujson': json, 'json': json,
+                    'zlib': zlib, 'uzlib': zlib,
+                    'uio': io, 'io': io,
+                    'ustruct': struct, 'struct': struct,
+                    'uerrno': errno, 'errno': errno,
+                    'math': __import__('math'),
+                    'urandom': __import__('random'),
+                    'random': __import__('random'),
+                    'ure': __import__('re'), 're': __import__('re'),
+                    'collections': __import__('collections')}.get(name)
+        return module
+
+    def import_module(self, name, globals=None, locals=None, fromlist=(),
+                      level=0):
+        """
+        __import__ of the device: emulated modules and .py files in the
+        root or /lib directory of the device file system.
+        """
+        if name in self.modules:
+            top = name.partition('.')[0]
+            if not fromlist and top in self.modules:
+                # import a.b binds the package a
+                return self.modules[top]
+            return self.modules[name]
+        module = self.device_module(name)
+        if module is None:
+            for directory in ('/', '/lib/'):
+                path = self.fs.path(directory + name + '.py')
+                if os.path.isfile(path):
+                    module = types.ModuleType(name)
+                    module.__file__ = directory + name + '.py'
+                    module.__builtins__ = self.namespace['__builtins__']
+                    self.modules[name] = module
+                    with open(path) as f:
+                        code = compile(f.read(), module.__file__, 'exec')
+                    try:
+                        exec(code, vars(module))
+                    except BaseException:
+                        del self.modules[name]
+                        raise
+                    return module
+            raise ImportError("no module named '{}'".format(name))
+        self.modules[name] = module
+        return module
+
+    @staticmethod
+    def format_exception(e):
+        if isinstance(e, OSError) and e.errno:
+            return 'OSError: [Errno {}] {}'.format(
+                e.errno, errno.errorcode.get(e.errno, ''))
+        if e.args:
+            return '{}: {}'.format(type(e).__name__, e)
+        return type(e).__name__
+
+    def execute(self, source):
+        """
+        Runs a command in the device namespace and sends the result frames.
+        Runs in its own thread, so CTRL-C can interrupt it.
+        """
+        if self.latency:
+            time.sleep(self.latency)
+        error = ''
+        try:
+            code = compile(source, '<stdin>', 'exec')
+            exec(code, self.namespace)
+        except SystemExit:
+            pass
+        except BaseException as e:
+            line = 1
+            tb = e.__traceback__
+            while tb is not None:
+                if tb.tb_frame.f_code.co_filename == '<stdin>':
+                    line = tb.tb_lineno
+                tb = tb.tb_next
+            if isinstance(e, SyntaxError):
+                line = e.lineno or 1
+            error = 'Traceback (most recent call last):\r\n' \
+                    '  File "<stdin>", line {}, in <module>\r\n{}\r\n'\
+                .format(line, self.format_exception(e))
+        self.command = None
+        self.send(b'\x04' + error.encode() + b'\x04>')
+
+    def interrupt(self):
+        """
+        Raises KeyboardInterrupt in the running command.
+        """
+        command = self.command
+        if command is not None:
+            ctypes.pythonapi.PyThreadState_SetAsyncExc(
+                ctypes.c_ulong(command.ident),
+                ctypes.py_object(KeyboardInterrupt))
+
+    def run(self, source):
+        self.stdin.clear()
+        self.command = threading.Thread(target=self.execute,
+                                        args=(source.decode('utf8'),),
+                                        name='mpy-emulator-command',
+                                        daemon=True)
+        self.command.start()
+
+    #
+    # Protocol
+    #
+
+    def serve(self):
+        while self.running:
+            readable, _, _ = select.select([self.master], [], [], 0.1)
+            if not readable:
+                continue
+            try:
+                data = os.read(self.master, self.READ_SIZE)
+            except OSError:
+                break
+            self.throttle(len(data))
+            if not self.link():
+                data = self.garble(data)
+            for byte in data:
+                self.receive(byte)
+
+    def receive(self, byte):
+        """
+        Handles one byte received from the host.
+        """
+        if self.command is not None:
+            # stdin of the running command
+            if byte == 0x03:
+                self.interrupt()
+            else:
+                self.stdin.append(byte)
+            return
+
+        if self.paste is not None:
+            self.receive_paste(byte)
+        elif self.mode == 'raw':
+            self.receive_raw(byte)
+        else:
+            self.receive_friendly(byte)
+
+    def receive_paste(self, byte):
+        if byte == 0x04:
+            source = bytes(self.paste)
+            self.paste = None
+            self.send(b'\x04')
+            self.run(source)
+            return
+        self.paste.append(byte)
+        self.pasted += 1
+        if self.pasted == self.window_size:
+            self.pasted = 0
+            self.send(b'\x01')
+
+    def receive_raw(self, byte):
+        if byte == 0x01 and self.line.endswith(b'\x05A') and self.raw_paste:
+            # raw-paste request
+            self.line.clear()
+            self.paste = bytearray()
+            self.pasted = 0
+            self.send(b'R\x01' + struct.pack('<H', self.window_size))
+        elif byte == 0x01:
+            self.line.clear()
+            self.send(b'\r\n' + self.RAW_REPL_BANNER)
+        elif byte == 0x02:
+            self.line.clear()
+            self.mode = 'friendly'
+            self.send('\r\n{}\r\nType "help()" for more information.\r\n>>> '
+                      .format(self.BANNER).encode())
+        elif byte == 0x03:
+            self.line.clear()
+        elif byte == 0x04:
+            if not self.line:
+                self.reset()
+                self.send(b'OK\r\nMPY: soft reboot\r\n' + self.RAW_REPL_BANNER)
+                return
+            source = bytes(self.line)
+            self.line.clear()
+            self.send(b'OK')
+            self.run(source)
+        else:
+            self.line.append(byte)
+
+    def receive_friendly(self, byte):
+        if byte == 0x01:
+            self.mode = 'raw'
+            self.line.clear()
+            self.send(b'\r\n' + self.RAW_REPL_BANNER)
+        elif byte == 0x02:
+            self.send('\r\n{}\r\nType "help()" for more information.\r\n>>> '
+                      .format(self.BANNER).encode())
+        elif byte == 0x03:
+            self.line.clear()
+            self.send(b'\r\n>>> ')
+        elif byte == 0x04:
+            self.reset()
+            self.send(b'MPY: soft reboot\r\n>>> ')
+        elif byte == 0x0d:
+            source = bytes(self.line).decode('utf8', 'replace')
+            self.line.clear()
+            self.send(b'\r\n')
+            self.evaluate(source)
+            self.send(b'>>> ')
+        else:
+            self.line.append(byte)
+            self.send(bytes([byte]))
+
+    def evaluate(self, source):
+        """
+        Executes one line of the friendly REPL and prints the result.
+        """
+        if not source.strip():
+            return
+        try:
+            try:
+                code = compile(source, '<stdin>', 'eval')
+            except SyntaxError:
+                exec(compile(source, '<stdin>', 'exec'), self.namespace)
+            else:
+                value = eval(code, self.namespace)
+                if value is not None:
+                    self.print(repr(value))
+        except Exception as e:
+            self.print(self.format_exception(e))
+
+
+if __name__ == '__main__':
+    from cli import mpy_emulator_parser
+    args = mpy_emulator_parser.parse_args()
+
+    emulator = MpyEmulator(args.root, baudrate=args.baudrate,
+                           latency=args.latency,
+                           max_baudrate=args.max_baudrate,
+                           raw_paste=not args.no_raw_paste)
+    print('Emulating a micropython device on {}'.format(emulator.start()))
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        emulator.stop()
@@ -1,22 +1,246 @@
 """
 Module to mount a micropython device as fuse-filesystem.
 """
+import errno
 import os
 import re
+import threading
+import time
+from collections import OrderedDict
 from multiprocessing import Process
 
 from fuse import FUSE, FuseOSError, Operations
 
-from mpy_device import MpyDevice, MpyDeviceError
+from mpy_device import METRICS, DeviceAgent, MpyDevice, MpyDeviceError
+from mpy_scheduler import DeviceScheduler
+
+
+class MetadataCache(object):
+    """
+    Size-bounded LRU cache with time-to-live for file attributes and
+    directory listings of the device file system.
+    Entries are keyed by ('attr', path) or ('dir', path). Missing files are
+    cached as negative entries holding the raised FuseOSError.
+    """
+    MISS = object()
+
+    def __init__(self, ttl=2.0, max_size=1024):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, key):
+        """
+        :param key: cache key
+        :return: cached value or MetadataCache.MISS
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                self.entries.move_to_end(key)
+                self.hits += 1
+                if METRICS.enabled:
+                    METRICS.count('mpy_fuse_cache_lookups_total',
+                                  kind=key[0], result='hit')
+                return entry[1]
+            if entry is not None:
+                del self.entries[key]
+            self.misses += 1
+            if METRICS.enabled:
+                METRICS.count('mpy_fuse_cache_lookups_total',
+                              kind=key[0], result='miss')
+            return MetadataCache.MISS
+
+    def store(self, key, value):
+        if not self.ttl or self.ttl <= 0:
+            return
+        with self.lock:
+            self.entries[key] = (time.monotonic() + self.ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def discard(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def invalidate(self, path, listing=False, parent=False, tree=False):
+        """
+        Removes cached data of a path.
+
+        :param path: path to invalidate the attributes for
+        :param listing: also invalidate the directory listing of path
+        :param parent: also invalidate the listing of the parent directory
+        :param tree: also invalidate everything below path
+        """
+        with self.lock:
+            self.discard(('attr', path))
+            if listing:
+                self.discard(('dir', path))
+            if parent:
+                self.discard(('dir', os.path.dirname(path)))
+            if tree:
+                prefix = path.rstrip('/') + '/'
+                for key in [k for k in self.entries
+                            if k[1].startswith(prefix)]:
+                    del self.entries[key]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        """
+        :return: dict with hits, misses, hit_rate and size of the cache
+        """
+        lookups = self.hits + self.misses
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'size': len(self.entries)}
+
+
+class FileHandle(object):
+    """
+    Host-side state of a file opened on the device.
+    Holds the write-back buffer, the read-ahead buffer and the last known
+    file position on the device, which saves the seek if it did not change.
+    """
+    def __init__(self, var, path):
+        self.var = var
+        self.path = path
+        self.position = None
+        self.write_offset = 0
+        self.write_buffer = bytearray()
+        self.read_offset = 0
+        self.read_buffer = b''
+        self.read_ahead = 0
+
+    @property
+    def dirty(self):
+        return len(self.write_buffer) > 0
+
+    def buffer_write(self, buf, offset):
+        """
+        Adds data to the write-back buffer if it continues or overlaps the
+        buffered region.
+
+        :return: False if the data cannot be coalesced with the buffer
+        """
+        start = offset - self.write_offset
+        if self.dirty and not 0 <= start <= len(self.write_buffer):
+            return False
+        if not self.dirty:
+            self.write_offset = offset
+            start = 0
+        self.write_buffer[start:start + len(buf)] = buf
+        self.read_buffer = b''
+        return True
+
+    def buffered_read(self, offset, length):
+        """
+        :return: data from the read-ahead buffer or None if not buffered
+        """
+        start = offset - self.read_offset
+        if 0 <= start and start + length <= len(self.read_buffer):
+            return self.read_buffer[start:start + length]
+        return None
 
 
 class MpyFuseOperations(Operations):
-    def __init__(self, device):
+    STAT_FIELDS = ('st_mode', 'st_ino', 'st_dev', 'st_nlink', 'st_uid',
+                   'st_gid', 'st_size', 'st_atime', 'st_mtime', 'st_ctime')
+    STATVFS_FIELDS = ('f_bsize', 'f_frsize', 'f_blocks', 'f_bfree',
+                      'f_bavail', 'f_files', 'f_ffree', 'f_favail', 'f_flag',
+                      'f_namemax')
+    ERRNO_PATTERN = re.compile(r'OSError: \[Errno (?P<error_number>\d+)\]',
+                               re.MULTILINE)
+    READDIR_PAGE_SIZE = 64
+    METADATA_OPERATIONS = ('getattr', 'readdir', 'statfs', 'access',
+                           'open', 'create', 'mkdir', 'rmdir', 'unlink',
+                           'rename', 'chmod')
+    COALESCED_OPERATIONS = ('getattr', 'readdir', 'statfs')
+
+    def __init__(self, device, chunk_size=None, cache_ttl=2.0,
+                 cache_size=1024, write_buffer_size=64 * 1024,
+                 read_ahead_size=32 * 1024, scheduler=None, compress=False,
+                 metrics_file=None, metrics_interval=10.0):
         self.board = device
+        self.board.compress = compress
+        self.scheduler = scheduler
+        self.chunk_size = chunk_size
+        self.write_buffer_size = write_buffer_size
+        self.read_ahead_size = read_ahead_size
+        self.block_size = None
+        self.cache = MetadataCache(ttl=cache_ttl, max_size=cache_size)
+        self.metrics_file = metrics_file
+        self.metrics_interval = metrics_interval
         self.board.enter_raw_repl()
         self.exec('import os')
+        self.agent = DeviceAgent(self.board)
+        self.call(self.agent.install)
         self.file_handles = dict()
 
+    def __call__(self, op, *args):
+        """
+        Dispatches a FUSE operation. With a scheduler every operation which
+        cannot be answered from host memory is executed on the scheduler
+        thread, metadata operations with a higher priority than data
+        transfers.
+        """
+        if self.scheduler is None or op in ('init', 'destroy'):
+            return self.dispatch(op, *args)
+
+        if op in ('getattr', 'readdir'):
+            cached = self.cached(op, args[0])
+            if cached is not MetadataCache.MISS:
+                return cached
+
+        priority = DeviceScheduler.DATA
+        if op in self.METADATA_OPERATIONS:
+            priority = DeviceScheduler.METADATA
+        key = None
+        if op in self.COALESCED_OPERATIONS:
+            key = (op, args[0])
+        return self.scheduler.run(op, self.dispatch, op, *args,
+                                  priority=priority, key=key)
+
+    def dispatch(self, op, *args):
+        """
+        Executes a FUSE operation. With metrics enabled its duration and the
+        number of device round trips are recorded per operation.
+        """
+        if not METRICS.enabled:
+            return super().__call__(op, *args)
+        round_trips = self.board.round_trips
+        start = time.perf_counter()
+        try:
+            return super().__call__(op, *args)
+        finally:
+            METRICS.observe('mpy_fuse_operation_seconds',
+                            time.perf_counter() - start, op=op)
+            METRICS.count('mpy_fuse_round_trips_total',
+                          self.board.round_trips - round_trips, op=op)
+
+    def cached(self, op, path):
+        """
+        :return: cached result of a getattr or readdir operation or
+         MetadataCache.MISS
+        """
+        if any(h.dirty and h.path == path
+               for h in list(self.file_handles.values())):
+            return MetadataCache.MISS
+        kind = 'attr' if op == 'getattr' else 'dir'
+        value = self.cache.lookup((kind, path))
+        if isinstance(value, FuseOSError):
+            raise value
+        if value is MetadataCache.MISS:
+            return value
+        return dict(value) if kind == 'attr' else list(value)
+
     #
     # Mpy methods
     #
@@ -24,12 +248,13 @@ class MpyFuseOperations(Operations):
         cmd = self.board.exec
         if eval:
             cmd = self.board.eval
+        return self.call(cmd, command)
+
+    def call(self, function, *args, **kwargs):
         try:
-            ret = cmd(command)
+            ret = function(*args, **kwargs)
         except MpyDeviceError as e:
-            pattern = re.compile(r'OSError: \[Errno (?P<error_number>\d+)\]',
-                                 re.MULTILINE)
-            match = pattern.search(e.args[0])
+            match = self.ERRNO_PATTERN.search(e.args[0])
             if match:
                 error_number = int(match.group('error_number'))
                 raise FuseOSError(error_number)
@@ -52,23 +277,64 @@ class MpyFuseOperations(Operations):
         raise NotImplementedError()
 
     def getattr(self, path, fh=None):
-        pattern = r'\((?P<st_mode>\d+), ' \
-                  r'(?P<st_ino>\d+), ' \
-                  r'(?P<st_dev>\d+), ' \
-                  r'(?P<st_nlink>\d+), ' \
-                  r'(?P<st_uid>\d+), ' \
-                  r'(?P<st_gid>\d+), ' \
-                  r'(?P<st_size>\d+), ' \
-                  r'(?P<st_atime>\d+), ' \
-                  r'(?P<st_mtime>\d+), ' \
-                  r'(?P<st_ctime>\d+)\)'
-        ret = self.exec("os.stat('{}')".format(path), eval=True)
-        attrs = re.match(pattern, ret).groupdict()
-        return {k: int(v) for k, v in attrs.items()}
+        self.flush_path(path)
+        attrs = self.cache.lookup(('attr', path))
+        if isinstance(attrs, FuseOSError):
+            raise attrs
+        if attrs is MetadataCache.MISS:
+            try:
+                attrs = self.stat(path)
+            except FuseOSError as e:
+                if e.errno == errno.ENOENT:
+                    self.cache.store(('attr', path), e)
+                raise
+            self.cache.store(('attr', path), attrs)
+        return dict(attrs)
+
+    def stat(self, path):
+        return dict(zip(self.STAT_FIELDS,
+                        self.call(self.agent.call, 'stat', path)))
 
     def readdir(self, path, fh):
-        ret = self.exec("os.listdir('{}')".format(path), eval=True)
-        return re.findall(r"'\s*([^']*?)\s*'", ret)
+        entries = self.cache.lookup(('dir', path))
+        if entries is MetadataCache.MISS:
+            entries = []
+            prefix = path.rstrip('/') + '/'
+            for name, attrs in self.listdir_stat(path):
+                if prefix + name == DeviceAgent.PATH:
+                    continue
+                entries.append(name)
+                self.cache.store(('attr', prefix + name), attrs)
+            self.cache.store(('dir', path), entries)
+        return list(entries)
+
+    def listdir_stat(self, path):
+        """
+        Generator which lists a directory together with the attributes of
+        every entry. The agent iterates the directory with os.ilistdir and
+        sends the entries in pages of READDIR_PAGE_SIZE entries. The first
+        page is returned when the directory is opened and the agent closes
+        the directory after a short page, so a small directory is listed
+        with one command.
+
+        :param path: directory on the device
+        :return: yields tuples of entry name and attribute dict
+        """
+        entries = self.call(self.agent.call, 'opendir', path,
+                            self.READDIR_PAGE_SIZE)
+        try:
+            while True:
+                for name, *fields in entries:
+                    yield name, dict(zip(self.STAT_FIELDS, fields))
+                if len(entries) < self.READDIR_PAGE_SIZE:
+                    entries = None
+                    break
+                entries = self.call(self.agent.call, 'readdir',
+                                    self.READDIR_PAGE_SIZE)
+        finally:
+            if entries is not None:
+                # closed before the last page
+                self.call(self.agent.call, 'closedir')
 
     def readlink(self, path):
         raise NotImplementedError()
@@ -77,34 +343,28 @@ class MpyFuseOperations(Operations):
         raise NotImplementedError()
 
     def rmdir(self, path):
-        self.exec("os.rmdir('{}')".format(path))
+        self.cache.invalidate(path, listing=True, parent=True)
+        self.exec('os.rmdir({!r})'.format(path))
 
     def mkdir(self, path, mode):
-        self.exec("os.mkdir('{}')".format(path))
+        self.cache.invalidate(path, listing=True, parent=True)
+        self.exec('os.mkdir({!r})'.format(path))
 
     def statfs(self, path):
-        pattern = r'\((?P<f_bsize>\d+), ' \
-                  r'(?P<f_frsize>\d+), ' \
-                  r'(?P<f_blocks>\d+), ' \
-                  r'(?P<f_bfree>\d+), ' \
-                  r'(?P<f_bavail>\d+), ' \
-                  r'(?P<f_files>\d+), ' \
-                  r'(?P<f_ffree>\d+), ' \
-                  r'(?P<f_avail>\d+), ' \
-                  r'(?P<f_flag>\d+), ' \
-                  r'(?P<f_namemax>\d+)\)'
-        ret = self.exec("os.statvfs('{}')".format(path), eval=True)
-        stats = re.match(pattern, ret).groupdict()
-        return {k: int(v) for k, v in stats.items()}
+        return dict(zip(self.STATVFS_FIELDS,
+                        self.call(self.agent.call, 'statvfs', path)))
 
     def unlink(self, path):
-        self.exec("os.remove('{}')".format(path))
+        self.cache.invalidate(path, parent=True)
+        self.exec('os.remove({!r})'.format(path))
 
     def symlink(self, name, target):
         raise NotImplementedError()
 
     def rename(self, old, new):
-        self.exec("os.rename('{}', '{}')".format(old, new))
+        self.cache.invalidate(old, listing=True, parent=True, tree=True)
+        self.cache.invalidate(new, listing=True, parent=True, tree=True)
+        self.exec('os.rename({!r}, {!r})'.format(old, new))
 
     def link(self, target, name):
         raise NotImplementedError()
@@ -112,7 +372,46 @@ class MpyFuseOperations(Operations):
     def utimens(self, path, times=None):
         raise NotImplementedError()
 
+    def put_file(self, local, path):
+        try:
+            return self.call(self.board.put_file, local, path,
+                             chunk_size=self.chunk_size)
+        finally:
+            # also drops attributes cached while the file was written
+            self.cache.invalidate(path, parent=True)
+
+    def get_file(self, path, local):
+        return self.call(self.board.get_file, path, local,
+                         chunk_size=self.chunk_size)
+
+    def get_block_size(self):
+        if self.block_size is None:
+            self.block_size = self.statfs('/')['f_bsize'] or 1
+        return self.block_size
+
+    def transfer_size(self):
+        """
+        :return: bytes per transfer chunk, a multiple of the file system
+         block size
+        """
+        block_size = self.get_block_size()
+        chunk_size = self.chunk_size or self.board.CHUNK_SIZE
+        return max(1, chunk_size // block_size) * block_size
+
+    def init(self, path):
+        if self.scheduler is not None:
+            self.scheduler.start()
+        if self.metrics_file:
+            METRICS.enable()
+            METRICS.start_dump(self.metrics_file, self.metrics_interval,
+                               prometheus=self.metrics_file.endswith('.prom'))
+
     def destroy(self, path):
+        if self.scheduler is not None:
+            self.scheduler.stop()
+        if self.metrics_file:
+            METRICS.stop_dump()
+
         fhs = list(self.file_handles.keys())
         for fh in fhs:
             self.release(None, fh)
@@ -130,50 +429,124 @@ class MpyFuseOperations(Operations):
         var = "fh_{}".format(file_handle)
 
         if flags & (os.O_RDONLY + os.O_APPEND):
-            mode = "a"
+            mode = "ab"
         elif flags == os.O_RDONLY:
-            mode = "r"
+            mode = "rb"
         elif flags & (os.O_RDWR + os.O_CREAT):
-            mode = "w+"
+            mode = "w+b"
         elif flags & os.O_RDWR:
-            mode = "r+"
+            mode = "r+b"
         elif flags & (os.O_WRONLY + os.O_TRUNC + os.O_CREAT):
-            mode = "w"
+            mode = "wb"
         elif flags & os.O_APPEND:
-            mode = "a+"
+            mode = "a+b"
         else:
-            mode = "w+"
+            mode = "w+b"
 
-        self.exec('{} = open("{}", "{}")'.format(var, path, mode))
-        self.file_handles[file_handle] = var
+        self.exec('{} = open({!r}, {!r})'.format(var, path, mode))
+        self.file_handles[file_handle] = FileHandle(var, path)
         return file_handle
 
     def create(self, path, mode, fi=None):
+        self.cache.invalidate(path, parent=True)
         return self.open(path, os.O_RDWR + os.O_CREAT)
 
+    @staticmethod
+    def seek_statement(handle, offset):
+        """
+        :return: statement which moves the device file position of a handle
+         to offset or None if it is there already
+        """
+        if handle.position != offset:
+            return "{}.seek({}, 0)".format(handle.var, offset)
+        return None
+
     def read(self, path, length, offset, fh):
-        var = self.file_handles[fh]
-        self.exec("{}.seek({}, 0)".format(var, offset))
-        w = self.exec("{}.read({})".format(var, length), eval=True).encode('utf-8')
-        return w.replace(b"\r\n", b"\n")
+        handle = self.file_handles[fh]
+        # writes of all handles of the file must reach the device first
+        self.flush_path(handle.path)
+        data = handle.buffered_read(offset, length)
+        if data is not None:
+            return data
+
+        # grow the read-ahead while the file is read sequentially
+        end = handle.read_offset + len(handle.read_buffer)
+        if handle.read_offset <= offset <= end:
+            handle.read_ahead = min(max(2 * handle.read_ahead, length),
+                                    self.read_ahead_size)
+        else:
+            handle.read_ahead = 0
+        size = max(length, handle.read_ahead)
+
+        setup = self.seek_statement(handle, offset)
+        handle.position = None
+        data = self.call(self.board.read_chunks, handle.var, size,
+                         chunk_size=self.transfer_size(), setup=setup)
+        handle.position = offset + len(data)
+        handle.read_offset = offset
+        handle.read_buffer = data
+        return data[:length]
 
     def write(self, path, buf, offset, fh):
-        var = self.file_handles[fh]
-        self.exec("{}.seek({}, 0)".format(var, offset))
-        self.exec('{}.write("""{}""")'.format(var, buf.decode('utf-8')))
+        self.cache.invalidate(path)
+        handle = self.file_handles[fh]
+        for other in self.file_handles.values():
+            if other.path == handle.path:
+                other.read_buffer = b''
+        if not handle.buffer_write(buf, offset):
+            self.write_back(handle)
+            handle.buffer_write(buf, offset)
+        if len(handle.write_buffer) >= self.write_buffer_size:
+            self.write_back(handle)
         return len(buf)
 
+    def write_back(self, handle):
+        """
+        Writes the write-back buffer of a file handle to the device.
+        The first chunk ends at a block boundary, so all following chunks
+        are written block aligned.
+        """
+        if not handle.dirty:
+            return False
+        size = self.transfer_size()
+        data = handle.write_buffer
+        offset = handle.write_offset
+        handle.write_buffer = bytearray()
+        handle.read_buffer = b''
+
+        setup = self.seek_statement(handle, offset)
+        handle.position = None
+        first = size - offset % size
+        self.call(self.board.write_chunks, handle.var, bytes(data[:first]),
+                  chunk_size=size, setup=setup)
+        if len(data) > first:
+            self.call(self.board.write_chunks, handle.var,
+                      bytes(data[first:]), chunk_size=size)
+        handle.position = offset + len(data)
+        self.cache.invalidate(handle.path)
+        return True
+
+    def flush_path(self, path):
+        for handle in self.file_handles.values():
+            if handle.path == path and self.write_back(handle):
+                self.exec("{}.flush()".format(handle.var))
+
     def truncate(self, path, length, fh=None):
         pass
 
     def flush(self, path, fh):
-        var = self.file_handles[fh]
-        self.exec("{}.flush()".format(var))
+        handle = self.file_handles[fh]
+        self.write_back(handle)
+        self.exec("{}.flush()".format(handle.var))
 
     def release(self, path, fh):
-        var = self.file_handles[fh]
-        self.exec("{}.close()".format(var))
-        del self.file_handles[fh]
+        handle = self.file_handles[fh]
+        try:
+            self.write_back(handle)
+        finally:
+            self.exec("{}.close()".format(handle.var))
+            del self.file_handles[fh]
+            self.cache.invalidate(handle.path)
 
     def fsync(self, path, fdatasync, fh):
         self.flush(path, fh)
@@ -197,15 +570,28 @@ class MpyFuse(object):
             shutil.copy('main.py', 'mpy_fs/')
 
     """
-    def __init__(self, device, mntpoint):
+    def __init__(self, device, mntpoint, chunk_size=None, cache_ttl=2.0,
+                 cache_size=1024, write_buffer_size=64 * 1024,
+                 read_ahead_size=32 * 1024, threaded=False, compress=False,
+                 metrics_file=None, metrics_interval=10.0):
         self.process = None
         self.mntpoint = mntpoint
         self.device = device
+        self.chunk_size = chunk_size
+        self.cache_ttl = cache_ttl
+        self.cache_size = cache_size
+        self.write_buffer_size = write_buffer_size
+        self.read_ahead_size = read_ahead_size
+        self.threaded = threaded
+        self.compress = compress
+        self.metrics_file = metrics_file
+        self.metrics_interval = metrics_interval
         self.dev = None
 
     def __repr__(self):
-        return 'MpyFuse(device="{}", mntpoint="{}", mounted={})'\
-            .format(self.device, self.mntpoint, self.process is not None)
+        return 'MpyFuse(device="{}", mntpoint="{}", mounted={}, threaded={})'\
+            .format(self.device, self.mntpoint, self.process is not None,
+                    self.threaded)
 
     def __enter__(self):
         self.mount()
@@ -216,10 +602,24 @@ class MpyFuse(object):
     def mount(self):
         """
         Mounts the MpyFuse-Filesystem by starting a background process.
+        In threaded mode FUSE operations are handled concurrently and all
+        device commands are serialized by a DeviceScheduler.
         """
         self.dev = MpyDevice(self.device)
-        fuse_args = (MpyFuseOperations(self.dev), self.mntpoint)
-        fuse_kwargs = {'nothreads': True, 'foreground': True}
+        scheduler = DeviceScheduler(self.dev) if self.threaded else None
+        operations = MpyFuseOperations(
+            self.dev,
+            chunk_size=self.chunk_size,
+            cache_ttl=self.cache_ttl,
+            cache_size=self.cache_size,
+            write_buffer_size=self.write_buffer_size,
+            read_ahead_size=self.read_ahead_size,
+            scheduler=scheduler,
+            compress=self.compress,
+            metrics_file=self.metrics_file,
+            metrics_interval=self.metrics_interval)
+        fuse_args = (operations, self.mntpoint)
+        fuse_kwargs = {'nothreads': not self.threaded, 'foreground': True}
 
         self.process = Process(target=FUSE, args=fuse_args, kwargs=fuse_kwargs)
         self.process.daemon = True
@@ -237,7 +637,9 @@ if __name__ == '__main__':
     from cli import mpy_fuse_parser
     args = mpy_fuse_parser.parse_args()
 
-    fuse = MpyFuse(args.device, args.mntpoint)
+    fuse = MpyFuse(args.device, args.mntpoint, threaded=args.threaded,
+                   compress=args.compress, metrics_file=args.metrics,
+                   metrics_interval=args.metrics_interval)
     fuse.mount()
 
     import signal
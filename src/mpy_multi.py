@@ -0,0 +1,198 @@
+"""
+Module to synchronize and run scripts on many micropython devices in
+parallel.
+"""
+import glob
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from mpy_compile import MpyCompiler
+from mpy_device import MpyDevice
+from mpy_sync import Manifest, hash_sources, sync
+
+
+class TaggedOutput(object):
+    """
+    File-like object which prefixes every line with the device name and
+    writes complete lines to a shared output.
+    """
+    def __init__(self, tag, output, lock):
+        self.tag = tag
+        self.output = output
+        self.lock = lock
+        self.buffer = ''
+
+    def __repr__(self):
+        return 'TaggedOutput({})'.format(self.tag)
+
+    def write(self, s):
+        self.buffer += s
+        lines = self.buffer.split('\n')
+        self.buffer = lines.pop()
+        if lines:
+            self.emit(lines)
+        return len(s)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        if self.buffer:
+            self.emit([self.buffer])
+            self.buffer = ''
+
+    def emit(self, lines):
+        with self.lock:
+            for line in lines:
+                print('[{}] {}'.format(self.tag, line.rstrip('\r')),
+                      file=self.output)
+            self.output.flush()
+
+
+class DeviceResult(object):
+    """
+    Outcome and phase timings of the work on one device.
+    """
+    def __init__(self, device):
+        self.device = device
+        self.error = None
+        self.operations = 0
+        self.timings = dict()
+
+    def __repr__(self):
+        return 'DeviceResult({}, ok={})'.format(self.device, self.ok)
+
+    @property
+    def ok(self):
+        return self.error is None
+
+    @property
+    def total(self):
+        return sum(self.timings.values())
+
+
+def expand_devices(patterns):
+    """
+    :param patterns: device names or glob patterns like /dev/ttyUSB*
+    :return: list of device names
+    """
+    devices = []
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern)) if ':' not in pattern else []
+        for device in matches or [pattern]:
+            if device not in devices:
+                devices.append(device)
+    return devices
+
+
+def run_many(devices, script, syncpath=None, output=sys.stdout, mode='hash',
+             compiler=None, jobs=None):
+    """
+    Synchronizes a folder with many devices and executes a script on each of
+    them. Every device is handled by its own worker; a failing device does
+    not affect the others. The source tree is hashed once for all devices.
+
+    :param devices: device names or glob patterns
+    :param script: script location on the devices
+    :param syncpath: source-folder to synchronize with the devices
+    :param output: File-object for the device tagged output
+    :param mode: sync mode, 'hash' or 'mtime'
+    :param compiler: MpyCompiler to precompile the sources, devices of the
+     same architecture share one compiler, so every source is compiled
+     once per architecture (optional)
+    :param jobs: number of parallel workers, defaults to one per device
+    :return: list of DeviceResult
+
+.. code-block:: python
+
+        results = run_many(['/dev/ttyUSB*'], 'app.py', 'src/')
+        print(format_summary(results))
+    """
+    devices = expand_devices(devices)
+    lock = threading.Lock()
+
+    manifest = None
+    if syncpath and mode == 'hash':
+        manifest = Manifest(syncpath)
+        hash_sources(syncpath, manifest)
+
+    compilers = dict()
+    compilers_lock = threading.Lock()
+
+    def device_compiler(dev):
+        """
+        :return: compiler shared by the devices with the architecture of dev
+        """
+        if compiler is None or compiler.march is not None:
+            return compiler
+        detected = MpyCompiler(compiler.executable,
+                               cache_dir=compiler.cache_dir)
+        detected.detect(dev)
+        with compilers_lock:
+            return compilers.setdefault(
+                (detected.march, detected.mpy_version), detected)
+
+    def work(device):
+        result = DeviceResult(device)
+        tagged = TaggedOutput(device, output, lock)
+        start = time.monotonic()
+        try:
+            with MpyDevice(device) as dev:
+                result.timings['connect'] = time.monotonic() - start
+                if syncpath:
+                    start = time.monotonic()
+                    for operation in sync(syncpath, dev, mode=mode,
+                                          compiler=device_compiler(dev),
+                                          manifest=manifest):
+                        tagged.write('{}\n'.format(operation))
+                        result.operations += 1
+                    result.timings['sync'] = time.monotonic() - start
+                start = time.monotonic()
+                for text in dev.stream_file(script):
+                    tagged.write(text)
+                result.timings['run'] = time.monotonic() - start
+        except Exception as e:
+            result.error = e
+            tagged.write('{}: {}\n'.format(e.__class__.__name__, e))
+        finally:
+            tagged.close()
+        return result
+
+    with ThreadPoolExecutor(max_workers=jobs or max(1, len(devices))) as ex:
+        return list(ex.map(work, devices))
+
+
+def format_summary(results):
+    """
+    :param results: list of DeviceResult
+    :return: table of the status and phase timings per device
+    """
+    rows = [('device', 'status', 'ops', 'connect', 'sync', 'run', 'total')]
+    for r in results:
+        rows.append((r.device,
+                     'ok' if r.ok else 'FAILED',
+                     str(r.operations),
+                     *('{:.2f}s'.format(r.timings[phase])
+                       if phase in r.timings else '-'
+                       for phase in ('connect', 'sync', 'run')),
+                     '{:.2f}s'.format(r.total)))
+    widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]))]
+    lines = ['  '.join(c.ljust(w) for c, w in zip(row, widths)).rstrip()
+             for row in rows]
+    for r in results:
+        if not r.ok:
+            lines.append('{}: {}'.format(r.device, r.error))
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    from cli import mpy_multi_parser
+    args = mpy_multi_parser.parse_args()
+
+    compiler = MpyCompiler(args.mpy_cross) if args.compile else None
+    results = run_many(args.devices, args.script, args.sync_path,
+                       compiler=compiler, jobs=args.jobs)
+    print(format_summary(results))
+    sys.exit(0 if all(r.ok for r in results) else 1)
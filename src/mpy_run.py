@@ -1,52 +1,67 @@
-import tempfile
-import time
-import shutil
 import sys
 
-from mpy_fuse import MpyFuse
 from mpy_sync import sync
 from mpy_device import MpyDevice
 
 
 def exec_file(device, script, output=None):
     with MpyDevice(device) as dev:
-        dev.execfile(script, output=output)
+        print_output(dev, script, output)
 
 
-def run(device, script, syncpath, script_output=None):
+def print_output(dev, script, output, local=False, bundle=False):
+    """
+    Runs a script on the device and writes its output to a file-object as
+    it is received, without collecting it.
+
+    :param dev: open MpyDevice
+    :param script: script location on the device, or on the host if local
+    :param output: File-object for the script output, None discards it
+    :param local: run the local script from RAM
+    :param bundle: send the local modules imported by a local script along
+    """
+    if local:
+        chunks = dev.stream_file_local(script, bundle=bundle)
+    else:
+        chunks = dev.stream_file(script)
+    for text in chunks:
+        if output is not None:
+            output.write(text)
+            output.flush()
+
+
+def run(device, script, syncpath, script_output=None, local=False,
+        bundle=False):
     """
     Generator which
-    * mounts a micropython device as fuse-filesystem
+    * opens a raw REPL session on a micropython device
     * synchronizes a folder with the micropython file-system
-    * executes a Python-script located a the device
+    * executes a Python-script located a the device, or a local script
+      from RAM without writing it to the device
+
+    Synchronization and script execution share the same device session.
 
     :param device: device name
-    :param script: script location on the device
+    :param script: script location on the device, or on the host if local
     :param syncpath: source-folder to synchronize with the device
     :param script_output: File-object to redirect the script output
+    :param local: run the local script from RAM
+    :param bundle: send the local modules imported by a local script along,
+     see ScriptBundle
     :return: yields the performed actions
 
 .. code-block:: python
 
         run('/dev/tty.SLAB_USBtoUART', 'app.py', 'src/', script_output=sys.stdout)
     """
-    if syncpath:
-        mntpoint = tempfile.mkdtemp()
-
-        fuse = MpyFuse(device, mntpoint)
-        fuse.mount()
-        time.sleep(1)
-        yield 'Device {} mounted at {}'.format(device, mntpoint)
-        yield 'Synchronize'
-        for f in sync(syncpath, mntpoint):
-            yield f
-        fuse.unmount()
-        time.sleep(1)
-        yield 'Device unmounted'
-
-        shutil.rmtree(mntpoint)
-    yield "Run script"
-    exec_file(device, script, output=script_output)
+    with MpyDevice(device) as dev:
+        yield 'Device {} connected'.format(device)
+        if syncpath:
+            yield 'Synchronize'
+            for f in sync(syncpath, dev):
+                yield f
+        yield "Run script"
+        print_output(dev, script, script_output, local=local, bundle=bundle)
 
 
 if __name__ == '__main__':
@@ -54,5 +69,6 @@ if __name__ == '__main__':
     args = mpy_run_parser.parse_args()
 
     for s in run(args.device, args.script, args.sync_path,
-                 script_output=sys.stdout):
+                 script_output=sys.stdout, local=args.local,
+                 bundle=args.bundle):
         print(s)
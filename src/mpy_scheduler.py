@@ -0,0 +1,180 @@
+"""
+Module to serialize the access to a micropython device from multiple threads.
+"""
+import itertools
+import queue
+import threading
+import time
+
+
+class Request(object):
+    """
+    Command submitted to the DeviceScheduler.
+    Can be waited for by any number of threads.
+    """
+    def __init__(self, name, function, args, kwargs, key=None):
+        self.name = name
+        self.function = function
+        self.args = args
+        self.kwargs = kwargs
+        self.key = key
+        self.submitted = time.monotonic()
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+    def __repr__(self):
+        return 'Request({}, done={})'.format(self.name, self.event.is_set())
+
+    def execute(self):
+        try:
+            self.result = self.function(*self.args, **self.kwargs)
+        except BaseException as e:
+            self.error = e
+        self.event.set()
+
+    def wait(self):
+        self.event.wait()
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+class DeviceScheduler(object):
+    """
+    Executes device commands one after another on a dedicated thread which
+    owns the device. Pending commands are ordered by priority, so metadata
+    operations overtake queued bulk transfers. Identical pending commands
+    (same key) are coalesced and executed only once.
+
+.. code-block:: python
+
+        scheduler = DeviceScheduler(MpyDevice('/dev/tty.SLAB_USBtoUART'))
+        scheduler.start()
+        freq = scheduler.run('freq', scheduler.device.eval, 'machine.freq()',
+                             priority=DeviceScheduler.METADATA)
+        print(scheduler.stats())
+        scheduler.stop()
+
+    """
+    METADATA = 0
+    DATA = 1
+
+    def __init__(self, device=None):
+        self.device = device
+        self.queue = queue.PriorityQueue()
+        self.pending = dict()
+        self.lock = threading.Lock()
+        self.counter = itertools.count()
+        self.thread = None
+        self.metrics = dict()
+
+    def __repr__(self):
+        return 'DeviceScheduler(running={}, pending={})'\
+            .format(self.running, self.queue.qsize())
+
+    @property
+    def running(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def start(self):
+        """
+        Starts the scheduler thread if it is not running yet.
+        """
+        if self.running:
+            return
+        self.thread = threading.Thread(target=self.worker, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """
+        Executes the pending commands and stops the scheduler thread.
+        """
+        if not self.running:
+            return
+        if threading.current_thread() is self.thread:
+            raise RuntimeError('DeviceScheduler cannot stop itself')
+        self.queue.put((float('inf'), next(self.counter), None))
+        self.thread.join()
+        self.thread = None
+
+    def submit(self, name, function, *args, priority=DATA, key=None,
+               **kwargs):
+        """
+        Queues a command.
+
+        :param name: operation name used for the metrics
+        :param function: callable to execute on the scheduler thread
+        :param priority: lower values are executed first
+        :param key: hashable key to coalesce identical pending commands
+        :return: Request to wait for
+        """
+        with self.lock:
+            if key is not None and key in self.pending:
+                self.record(name, coalesced=True)
+                return self.pending[key]
+            request = Request(name, function, args, kwargs, key=key)
+            if key is not None:
+                self.pending[key] = request
+            self.queue.put((priority, next(self.counter), request))
+        return request
+
+    def run(self, name, function, *args, **kwargs):
+        """
+        Executes a command on the scheduler thread and waits for its result.
+        Commands submitted from the scheduler thread itself are executed
+        immediately.
+
+        :return: return value of the command
+        """
+        if threading.current_thread() is self.thread:
+            kwargs.pop('priority', None)
+            kwargs.pop('key', None)
+            return function(*args, **kwargs)
+        return self.submit(name, function, *args, **kwargs).wait()
+
+    def worker(self):
+        while True:
+            _, _, request = self.queue.get()
+            if request is None:
+                break
+            with self.lock:
+                if request.key is not None:
+                    del self.pending[request.key]
+            start = time.monotonic()
+            request.execute()
+            end = time.monotonic()
+            with self.lock:
+                self.record(request.name, latency=end - request.submitted,
+                            duration=end - start)
+
+    def record(self, name, latency=0.0, duration=0.0, coalesced=False):
+        metric = self.metrics.setdefault(name, {'count': 0,
+                                                'coalesced': 0,
+                                                'latency_total': 0.0,
+                                                'latency_max': 0.0,
+                                                'duration_total': 0.0})
+        if coalesced:
+            metric['coalesced'] += 1
+            return
+        metric['count'] += 1
+        metric['latency_total'] += latency
+        metric['latency_max'] = max(metric['latency_max'], latency)
+        metric['duration_total'] += duration
+
+    def stats(self):
+        """
+        :return: dict with count, coalesced requests, mean and max latency
+         (queued + executed) and mean execution time per operation
+        """
+        stats = dict()
+        with self.lock:
+            metrics = {k: dict(v) for k, v in self.metrics.items()}
+        for name, metric in metrics.items():
+            count = metric['count'] or 1
+            stats[name] = {'count': metric['count'],
+                           'coalesced': metric['coalesced'],
+                           'latency_mean': metric['latency_total'] / count,
+                           'latency_max': metric['latency_max'],
+                           'duration_mean': metric['duration_total'] / count}
+        return stats
@@ -1,8 +1,22 @@
 import os
 import shutil
+import sys
 import time
-from pathlib import Path
+import hashlib
+import json
+import re
+import threading
+from pathlib import Path, PurePosixPath
 import configparser
+from contextlib import ExitStack, contextmanager
+
+from mpy_compile import MpyCompiler
+from mpy_device import METRICS, DeviceAgent, MpyDevice, MpyDeviceError
+from mpy_device.base_device import BaseDevice
+from mpy_watch import Deleted, Moved, below, create_watcher, rebase
+
+
+config_lock = threading.Lock()
 
 
 class SyncOperation(object):
@@ -20,34 +34,473 @@ class DirectoryDeleted(SyncOperation): pass
 class Ignored(SyncOperation): pass
 
 
-def read_ignore_patterns(config):
-    ignored = []
+class MoveOperation(SyncOperation):
+    def __init__(self, path, old):
+        super().__init__(path)
+        self.old = old
+
+    def __repr__(self):
+        return "{}({} -> {})".format(self.__class__.__name__, self.old,
+                                     self.path)
+
+
+class FileMoved(MoveOperation): pass
+class DirectoryMoved(MoveOperation): pass
+
+
+class Manifest(object):
+    """
+    Content digests of the synchronized files.
+    Stores the sha256 digests of the source files (reused as long as mtime
+    and size do not change) along with the digests of their compiled
+    outputs and per target (board or folder) the digests of the files last
+    copied to it. Saved as JSON in the source folder.
+    A manifest can be shared by syncs to different targets running in
+    parallel.
+    """
+    FILENAME = '.mpy_sync_manifest'
+
+    def __init__(self, src):
+        self.path = Path(src) / Manifest.FILENAME
+        self.lock = threading.RLock()
+        self.host = dict()
+        self.targets = dict()
+        if self.path.exists():
+            with self.path.open() as f:
+                content = json.load(f)
+            self.host = content.get('host', dict())
+            self.targets = content.get('targets', dict())
+
+    def __repr__(self):
+        return 'Manifest({})'.format(self.path)
+
+    def save(self):
+        with self.lock:
+            content = {'host': dict(self.host),
+                       'targets': {k: dict(v)
+                                   for k, v in self.targets.items()}}
+            with self.path.open(mode='w') as f:
+                json.dump(content, f, indent=1, sort_keys=True)
+
+    def host_digest(self, path, relative):
+        """
+        :param path: path of the source file
+        :param relative: path relative to the source folder
+        :return: sha256 hex digest of the source file
+        """
+        stat = os.stat(str(path))
+        entry = self.host.get(str(relative))
+        if entry and entry['mtime'] == stat.st_mtime \
+                and entry['size'] == stat.st_size:
+            return entry['digest']
+        digest = file_digest(path)
+        with self.lock:
+            self.host[str(relative)] = {'mtime': stat.st_mtime,
+                                        'size': stat.st_size,
+                                        'digest': digest}
+            if entry and entry['digest'] == digest and 'compiled' in entry:
+                # touched, the compiled outputs are still valid
+                self.host[str(relative)]['compiled'] = entry['compiled']
+        return digest
+
+    def compiled_digest(self, compiler, path, relative):
+        """
+        Unchanged sources are neither compiled nor hashed again, the
+        digest is stored per compiler key (see MpyCompiler.key).
+
+        :param compiler: MpyCompiler
+        :param path: path of the source file
+        :param relative: path relative to the source folder
+        :return: sha256 hex digest of the compiled output
+        """
+        key = compiler.key(self.host_digest(path, relative),
+                           relative.as_posix())
+        with self.lock:
+            entry = self.host[str(relative)]
+            digest = entry.get('compiled', dict()).get(key)
+        if digest is None:
+            digest = file_digest(compiler.compile(path, relative.as_posix()))
+            with self.lock:
+                entry.setdefault('compiled', dict())[key] = digest
+        return digest
+
+    def prune(self, relatives):
+        """
+        Removes source digests of files not in relatives.
+        """
+        with self.lock:
+            self.host = {r: e for r, e in self.host.items()
+                         if r in relatives}
+
+    def target(self, target_id):
+        """
+        :param target_id: board id or destination folder
+        :return: dict of relative paths and digests copied to the target
+        """
+        with self.lock:
+            return self.targets.setdefault(target_id, dict())
+
+
+def file_digest(path):
+    digest = hashlib.sha256()
+    with open(str(path), 'rb') as f:
+        for block in iter(lambda: f.read(64 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class FolderTarget(object):
+    """
+    Synchronization target in the local file system, e.g. a mounted device.
+    """
+    def __init__(self, path, board=None):
+        self.path = Path(path)
+        self.board = board
+
+    def __repr__(self):
+        return 'FolderTarget({})'.format(self.path)
+
+    @property
+    def id(self):
+        if self.board is not None:
+            return 'board:' + self.board.unique_id()
+        return 'path:' + str(self.path.resolve())
+
+    def entries(self):
+        """
+        :return: dict of all relative posix paths in the target and whether
+         they are directories
+        """
+        return {relative: entry.is_dir()
+                for entry, relative, _ in scan(self.path)}
+
+    @contextmanager
+    def pipeline(self):
+        yield self
+
+    def mkdir(self, relative):
+        (self.path / relative).mkdir(parents=True, exist_ok=True)
+
+    def put(self, f_src, relative, exists=False):
+        shutil.copy(str(f_src), str(self.path / relative))
+
+    def remove(self, relative):
+        (self.path / relative).unlink()
+
+    def rename(self, old, new):
+        (self.path / old).rename(self.path / new)
+
+    def rmtree(self, relative):
+        shutil.rmtree(str(self.path / relative))
+
+    def digests(self, relatives):
+        """
+        :return: dict of relative paths and sha256 digests of existing files
+        """
+        if self.board is not None:
+            return DeviceTarget(self.board).digests(relatives)
+        return {r: file_digest(self.path / r) for r in relatives}
+
+
+class DeviceTarget(object):
+    """
+    Synchronization target on a device file system.
+    All operations are performed over the raw REPL of one open device.
+    """
+    def __init__(self, device, root='/', delta=False, compress=None):
+        self.device = device
+        self.root = PurePosixPath(root)
+        self.delta = delta
+        self.compress = compress
+        self.pending = None
+
+    def __repr__(self):
+        return 'DeviceTarget({}, {})'.format(self.device, self.root)
+
+    @contextmanager
+    def pipeline(self):
+        """
+        Context manager which sends all mkdir, remove and rmtree commands
+        issued in the context in one submission when it is left.
+        """
+        with self.device.pipeline() as pipeline:
+            self.pending = pipeline
+            try:
+                yield self
+            finally:
+                self.pending = None
+
+    def run(self, command):
+        if self.pending is not None:
+            self.pending.exec(command)
+        else:
+            self.device.exec(command)
+
+    @property
+    def id(self):
+        return 'board:' + self.device.unique_id()
+
+    def remote(self, relative):
+        return str(self.root / PurePosixPath(Path(relative).as_posix()))
+
+    def entries(self):
+        """
+        :return: dict of all relative posix paths in the target and whether
+         they are directories, listed with a single command
+        """
+        ret = self.device.exec(
+            'import os\n'
+            'def _walk(d, r):\n'
+            '    for _e in os.ilistdir(d):\n'
+            '        print(int(_e[1] == 0x4000), r + _e[0])\n'
+            '        if _e[1] == 0x4000:\n'
+            '            _walk(d + "/" + _e[0], r + _e[0] + "/")\n'
+            '_walk({!r}, "")\n'
+            'del _walk\n'.format(str(self.root).rstrip('/') or '/'))
+        entries = dict()
+        for line in ret.splitlines():
+            is_dir, relative = line.split(' ', 1)
+            entries[relative] = is_dir == '1'
+        return entries
+
+    def mkdir(self, relative):
+        self.run('import os\nos.mkdir({!r})'.format(self.remote(relative)))
+
+    def put(self, f_src, relative, exists=False):
+        if self.delta and exists:
+            self.device.put_file_delta(f_src, self.remote(relative),
+                                       compress=self.compress)
+        else:
+            self.device.put_file(f_src, self.remote(relative),
+                                 compress=self.compress)
+
+    def remove(self, relative):
+        self.run('import os\nos.remove({!r})'.format(self.remote(relative)))
+
+    def rename(self, old, new):
+        self.run('import os\nos.rename({!r}, {!r})'.format(
+            self.remote(old), self.remote(new)))
+
+    def rmtree(self, relative):
+        self.run(
+            'import os\n'
+            'def _rmtree(d):\n'
+            '    for _e in os.ilistdir(d):\n'
+            '        if _e[1] == 0x4000:\n'
+            '            _rmtree(d + "/" + _e[0])\n'
+            '        else:\n'
+            '            os.remove(d + "/" + _e[0])\n'
+            '    os.rmdir(d)\n'
+            '_rmtree({!r})\n'
+            'del _rmtree\n'.format(self.remote(relative)))
+
+    def digests(self, relatives):
+        """
+        :return: dict of relative paths and sha256 digests of existing
+         files, computed on the device
+        """
+        paths = {self.remote(r): r for r in relatives}
+        digests = self.device.hash_files(paths.keys())
+        return {paths[p]: d for p, d in digests.items() if d is not None}
+
+
+def make_target(dest, board=None, delta=False, compress=None):
+    if isinstance(dest, (FolderTarget, DeviceTarget)):
+        return dest
+    if isinstance(dest, BaseDevice):
+        return DeviceTarget(dest, delta=delta, compress=compress)
+    return FolderTarget(dest, board=board)
+
+
+class IgnoreMatcher(object):
+    """
+    Matches relative paths against patterns with gitignore-like semantics.
+    The patterns are compiled once.
+
+    * a pattern without a slash matches a name in any directory
+    * a pattern containing a slash is anchored at the synchronized folder
+    * a trailing slash only matches directories
+    * * and ? do not match slashes, ** matches any number of directories
+    * a leading ! re-includes paths excluded by a previous pattern
+    * everything below an ignored directory is ignored
+    """
+    def __init__(self, patterns):
+        self.patterns = list(patterns)
+        self.rules = [self.compile(p) for p in self.patterns if p.strip()]
+        self.directories = dict()
+
+    def __repr__(self):
+        return 'IgnoreMatcher({})'.format(self.patterns)
+
+    @staticmethod
+    def compile(pattern):
+        """
+        :return: tuple of compiled regex, negation and directory-only flag
+        """
+        pattern = pattern.strip()
+        negate = pattern.startswith('!')
+        if negate:
+            pattern = pattern[1:]
+        dir_only = pattern.endswith('/')
+        pattern = pattern.rstrip('/')
+        anchored = '/' in pattern
+        pattern = pattern.lstrip('/')
+
+        regex = ''
+        for token in re.split(r'(\*\*/|/\*\*$|\*|\?|\[[^\]]*\])', pattern):
+            if token == '**/':
+                regex += '(?:.*/)?'
+            elif token == '/**':
+                regex += '/.*'
+            elif token == '*':
+                regex += '[^/]*'
+            elif token == '?':
+                regex += '[^/]'
+            elif token.startswith('[') and token.endswith(']') \
+                    and len(token) > 2:
+                regex += '[' + token[1:-1].replace('!', '^', 1) + ']'
+            else:
+                regex += re.escape(token)
+        if not anchored:
+            regex = '(?:.*/)?' + regex
+        return re.compile(regex + '$'), negate, dir_only
+
+    def match(self, relative, is_dir=False):
+        """
+        :param relative: posix path relative to the synchronized folder
+        :param is_dir: True if the path is a directory
+        :return: True if the path itself matches the patterns
+        """
+        ignored = False
+        for regex, negate, dir_only in self.rules:
+            if dir_only and not is_dir:
+                continue
+            if regex.match(relative):
+                ignored = not negate
+        return ignored
+
+    def ignored(self, relative, is_dir=False):
+        """
+        :param relative: posix path relative to the synchronized folder
+        :param is_dir: True if the path is a directory
+        :return: True if the path or any of its parent directories matches
+        """
+        parent = relative.rpartition('/')[0]
+        if parent:
+            if parent not in self.directories:
+                self.directories[parent] = self.ignored(parent, is_dir=True)
+            if self.directories[parent]:
+                return True
+        return self.match(relative, is_dir=is_dir)
+
+
+def scan(root, matcher=None, relative=''):
+    """
+    Generator which walks a folder with os.scandir and does not descend into
+    ignored directories.
+
+    :param root: folder to walk
+    :param matcher: IgnoreMatcher for the paths to prune (optional)
+    :return: yields tuples of DirEntry, relative posix path and
+     ignore state
+    """
+    with os.scandir(str(root)) as it:
+        entries = sorted(it, key=lambda e: e.name)
+    for entry in entries:
+        path = relative + entry.name
+        is_dir = entry.is_dir()
+        if matcher is not None and matcher.match(path, is_dir=is_dir):
+            yield entry, path, True
+            continue
+        yield entry, path, False
+        if is_dir:
+            yield from scan(entry.path, matcher, relative=path + '/')
+
+
+# never copied or deleted: the agent installed by mpy_fuse, the .mpy_sync
+# file which is rewritten with the last sync time and the manifest
+INTERNAL_PATTERNS = [DeviceAgent.PATH, '/.mpy_sync', '/' + Manifest.FILENAME]
+
+
+def contains_ignored(existing, matcher, posix):
+    """
+    :param existing: dict of the paths in the target and whether they are
+     directories
+    :param matcher: IgnoreMatcher
+    :param posix: directory in the target
+    :return: True if an entry below the directory is ignored, so the
+     directory cannot be deleted as a whole
+    """
+    return any(below(path, posix) and matcher.ignored(path, is_dir=is_dir)
+               for path, is_dir in existing.items())
+
+
+def read_ignore_patterns(config, extra=()):
+    """
+    :param config: parsed .mpy_sync file
+    :param extra: patterns ignored in addition to the configured ones
+    :return: IgnoreMatchers for copying and for deleting files
+    """
+    ignored = list(extra)
     ignored_sync = []
     ignored_del = []
     if config.has_section('ignore'):
-        ignored = list(config['ignore'])
+        ignored += list(config['ignore'])
 
     if config.has_section('ignore.sync'):
         ignored_sync = list(config['ignore.sync'])
 
     if config.has_section('ignore.delete'):
         ignored_del = list(config['ignore.delete'])
-    return ignored+ignored_sync, ignored+ignored_del
+    return IgnoreMatcher(ignored + ignored_sync), \
+        IgnoreMatcher(ignored + ignored_del)
+
+
+def read_compile_exclude(config):
+    """
+    :param config: parsed .mpy_sync file
+    :return: IgnoreMatcher for the files which must not be compiled
+    """
+    excluded = ['/boot.py', '/main.py']
+    if config.has_section('compile.exclude'):
+        excluded += list(config['compile.exclude'])
+    return IgnoreMatcher(excluded)
 
 
-def sync(src, dest, cleanup=True):
+def sync(src, dest, cleanup=True, mode='mtime', board=None, delta=False,
+         compress=None, compiler=None, manifest=None):
     """
     Generator which syncs a source-folder to a destination folder.
     Copies files where the modification date is newer then the last sync date.
     Last sync date is saved in .last_sync-file stored in the source-folder.
     Optional deletes files from destination folder if not existend in source folder.
 
+    In hash mode files are copied if their content differs. The digests are
+    stored per target in a .mpy_sync_manifest file in the source-folder.
+    Digests of files unknown to the manifest are computed on the board with
+    uhashlib if a board is given.
+
     Can be configured with a ini-like .mpy_sync file in the source directory.
+    Ignore patterns have gitignore-like semantics (see IgnoreMatcher),
+    ignored directories are not descended into.
 
     :param src: source-folder
-    :param dest: destination-folder
+    :param dest: destination-folder or MpyDevice to synchronize directly
+     over its raw REPL
     :param cleanup: If true, files not existing in the source folder gets
      deleted form the destination folder (optional)
+    :param mode: 'mtime' or 'hash' (optional)
+    :param board: MpyDevice the destination-folder belongs to, used to
+     identify the target and to compute digests in hash mode (optional)
+    :param delta: If true, files existing on a device destination are
+     updated by transferring only changed blocks (optional)
+    :param compress: If true, uploads to a device destination are
+     compressed, defaults to the compress setting of the device (optional)
+    :param compiler: MpyCompiler to upload .py files as precompiled .mpy
+     files, boot.py, main.py and files matching [compile.exclude] are
+     uploaded as source (optional)
+    :param manifest: Manifest to use in hash mode instead of loading it from
+     the source-folder, e.g. shared by parallel syncs (optional)
     :return: yields sync operations e.g. FileCreated, FileDeleted, FileUpdated,
      DirectoryCreated, DirectoryDeleted
 
@@ -63,16 +516,24 @@ def sync(src, dest, cleanup=True):
 
         [ignore] # File/Directory pattern to ignore over whole synchronisation process
         .git*
+        __pycache__/
 
         [ignore.sync] # File/Directory pattern ignored at copiing files to the board
         test
 
         [ignore.delete] # File/Directoy pattern ignored at deleting from the board
-        boot.py
-        main.py
+        /boot.py
+        /main.py
+
+        [compile.exclude] # Files uploaded as source if a compiler is used
+        config.py
     """
+    if mode not in ('mtime', 'hash'):
+        raise ValueError('Unknown sync mode {}'.format(mode))
+
     sync_config_path = src / Path('.mpy_sync')
     config = configparser.ConfigParser(allow_no_value=True)
+    config.optionxform = str
     config.read(str(sync_config_path))
 
     if config.has_section('last_sync'):
@@ -81,57 +542,568 @@ def sync(src, dest, cleanup=True):
         config.add_section('last_sync')
         last_sync_time = 0
 
-    ignore_sync, ignore_delete = read_ignore_patterns(config)
-
     src = Path(src)
-    dest = Path(dest)
-    for f_src in src.glob('**/*'):
-        mtime = os.stat(str(f_src)).st_mtime
-        if mtime > last_sync_time:
-            relative = f_src.relative_to(src)
-            f_dest = dest / relative
-
-            if any(Path(f_src) in src.glob(pattern)
-                   for pattern in ignore_sync):
-                yield Ignored(relative)
+    target = make_target(dest, board=board, delta=delta, compress=compress)
+    with METRICS.timer('mpy_sync_phase_seconds', phase='entries'):
+        existing = target.entries()
+
+    if mode != 'hash':
+        manifest = None
+    elif manifest is None:
+        manifest = Manifest(src)
+    if manifest:
+        copied = manifest.target(target.id)
+    ignore_sync, ignore_delete = read_ignore_patterns(config,
+                                                      INTERNAL_PATTERNS)
+
+    if compiler is not None:
+        compile_exclude = read_compile_exclude(config)
+        device = getattr(target, 'device', board)
+        if device is not None and compiler.march is None:
+            compiler.detect(device)
+
+    sources = []
+    operations = []
+    with METRICS.timer('mpy_sync_phase_seconds', phase='scan'):
+        for entry, posix, ignored in scan(src, ignore_sync):
+            relative = Path(posix)
+            if ignored:
+                operations.append(Ignored(relative))
                 continue
+            precompile = compiler is not None \
+                and entry.name.endswith('.py') and entry.is_file() \
+                and not compile_exclude.ignored(posix)
+            dest_relative = relative
+            if precompile:
+                dest_relative = relative.with_suffix('.mpy')
+            sources.append((Path(entry.path), relative, dest_relative,
+                            precompile))
+    yield from operations
 
-            if f_src.is_dir() and not f_dest.exists():
-                f_dest.mkdir(parents=True, exist_ok=True)
-                yield DirectoryCreated(relative)
-            elif f_src.is_file():
-                created = False
-                if not f_dest.exists():
-                    created = True
-                shutil.copy(str(f_src), str(f_dest))
-                if created:
-                    yield FileCreated(relative)
+    def upload_path(f_src, relative, precompile):
+        if precompile:
+            return compiler.compile(f_src, relative.as_posix())
+        return f_src
+
+    if manifest:
+        with METRICS.timer('mpy_sync_phase_seconds', phase='hash'):
+            digests = dict()
+            for f_src, relative, dest_relative, precompile in sources:
+                if not f_src.is_file():
+                    continue
+                if precompile:
+                    digest = manifest.compiled_digest(compiler, f_src,
+                                                      relative)
                 else:
-                    yield FileUpdated(relative)
+                    digest = manifest.host_digest(f_src, relative)
+                digests[dest_relative.as_posix()] = digest
+            manifest.prune({relative.as_posix()
+                            for _, relative, _, _ in sources})
+            unknown = [r for r in digests
+                       if r not in copied and existing.get(r) is False]
+            copied.update(target.digests(unknown))
+
+    expected = set()
+    replaced = set()
+    changed_sources = []
+    for f_src, relative, dest_relative, precompile in sources:
+        posix = dest_relative.as_posix()
+        expected.add(posix)
+        if precompile:
+            replaced.add(relative.as_posix())
+        if manifest:
+            changed = posix not in existing \
+                or digests.get(posix) != copied.get(posix)
+        else:
+            changed = os.stat(str(f_src)).st_mtime > last_sync_time
+        if changed:
+            changed_sources.append((f_src, relative, dest_relative,
+                                    precompile))
+
+    # directories are created in one submission before the files
+    operations = []
+    with METRICS.timer('mpy_sync_phase_seconds', phase='mkdir'), \
+            target.pipeline():
+        for f_src, _, dest_relative, _ in changed_sources:
+            posix = dest_relative.as_posix()
+            if f_src.is_dir() and posix not in existing:
+                target.mkdir(dest_relative)
+                existing[posix] = True
+                operations.append(DirectoryCreated(dest_relative))
+    yield from operations
+
+    for f_src, relative, dest_relative, precompile in changed_sources:
+        posix = dest_relative.as_posix()
+        if f_src.is_file():
+            created = posix not in existing
+            with METRICS.timer('mpy_sync_phase_seconds', phase='upload'):
+                target.put(upload_path(f_src, relative, precompile),
+                           dest_relative, exists=not created)
+            existing[posix] = False
+            if manifest:
+                copied[posix] = digests[posix]
+            if created:
+                yield FileCreated(dest_relative)
+            else:
+                yield FileUpdated(dest_relative)
 
     if cleanup:
-        for f_dest in dest.glob('**/*'):
-            relative = f_dest.relative_to(dest)
-            if any(Path(f_dest) in dest.glob(pattern)
-                   for pattern in ignore_delete):
-                yield Ignored(relative)
+        # deletions are sent in one submission
+        operations = []
+        skipped = []
+        with METRICS.timer('mpy_sync_phase_seconds', phase='cleanup'), \
+                target.pipeline():
+            for posix, is_dir in sorted(existing.items()):
+                relative = Path(posix)
+                if any(posix.startswith(r + '/') for r in skipped):
+                    continue
+                if ignore_delete.ignored(posix, is_dir=is_dir):
+                    skipped.append(posix)
+                    operations.append(Ignored(relative))
+                    continue
+
+                f_src = src / relative
+                if not is_dir and (posix in replaced or not f_src.exists()
+                                   and posix not in expected):
+                    target.remove(relative)
+                    if manifest:
+                        copied.pop(posix, None)
+                    operations.append(FileDeleted(relative))
+                elif is_dir and not f_src.exists():
+                    if contains_ignored(existing, ignore_delete, posix):
+                        # the other entries are deleted one by one
+                        continue
+                    target.rmtree(relative)
+                    skipped.append(posix)
+                    if manifest:
+                        for path in [p for p in copied
+                                     if p.startswith(posix + '/')]:
+                            del copied[path]
+                    operations.append(DirectoryDeleted(relative))
+        yield from operations
+
+    if manifest:
+        manifest.save()
+    save_last_sync(sync_config_path, config)
+
+
+def save_last_sync(sync_config_path, config):
+    with config_lock:
+        if not config.has_section('last_sync'):
+            config.add_section('last_sync')
+        config['last_sync'].clear()
+        config['last_sync'][str(time.time())] = None
+        with sync_config_path.open(mode='w') as f:
+            config.write(f)
+
+
+def hash_sources(src, manifest):
+    """
+    Computes the digests of all not ignored source files, so syncs to
+    several targets sharing the manifest do not hash the source tree again.
+
+    :param src: source-folder
+    :param manifest: Manifest of the source-folder
+    """
+    src = Path(src)
+    config = configparser.ConfigParser(allow_no_value=True)
+    config.optionxform = str
+    config.read(str(src / '.mpy_sync'))
+    ignore_sync, _ = read_ignore_patterns(config, INTERNAL_PATTERNS)
+    for entry, posix, ignored in scan(src, ignore_sync):
+        if not ignored and entry.is_file():
+            manifest.host_digest(entry.path, posix)
+
+
+class LiveSync(object):
+    """
+    Applies the changes reported by a watcher of the source-folder to a
+    target which was synchronized before, following the rules of sync():
+    ignore patterns, precompiled files and digests in hash mode. Renames
+    are applied as renames on the target.
+    """
+    def __init__(self, src, target, mode='mtime', compiler=None,
+                 manifest=None):
+        self.src = Path(src)
+        self.target = target
+        self.mode = mode
+        self.compiler = compiler
+        self.manifest = manifest
+        self.sync_config_path = self.src / '.mpy_sync'
+        self.config = configparser.ConfigParser(allow_no_value=True)
+        self.config.optionxform = str
+        self.config.read(str(self.sync_config_path))
+        self.ignore_sync, self.ignore_delete = read_ignore_patterns(
+            self.config, INTERNAL_PATTERNS)
+        self.compile_exclude = read_compile_exclude(self.config)
+        self.copied = manifest.target(target.id) if manifest else None
+        self.existing = dict()
+
+    def __repr__(self):
+        return 'LiveSync({}, {})'.format(self.src, self.target)
+
+    def watch_matcher(self):
+        """
+        :return: IgnoreMatcher for the paths the watcher can skip, which
+         includes the files written by the synchronization
+        """
+        return self.ignore_sync
+
+    def refresh(self):
+        self.existing = self.target.entries()
+
+    def save(self):
+        if self.manifest:
+            self.manifest.save()
+        save_last_sync(self.sync_config_path, self.config)
+
+    def dest(self, posix, is_dir=False):
+        """
+        :return: destination path of a source path
+        """
+        if self.compiler is not None and not is_dir \
+                and posix.endswith('.py') \
+                and not self.compile_exclude.ignored(posix):
+            return posix[:-3] + '.mpy'
+        return posix
+
+    def apply(self, changes):
+        """
+        Generator which applies changes to the target.
+
+        :param changes: list of mpy_watch changes
+        :return: yields sync operations
+        """
+        uploaded = set()
+        for change in changes:
+            if isinstance(change, Moved):
+                yield from self.move(change.old, change.relative,
+                                     change.is_dir, uploaded)
+            elif isinstance(change, Deleted):
+                yield from self.delete(change.relative)
+            elif not change.relative:
+                # the watcher lost events
+                yield from sync(self.src, self.target, mode=self.mode,
+                                compiler=self.compiler,
+                                manifest=self.manifest)
+                self.refresh()
+            else:
+                yield from self.update(change.relative, uploaded)
+
+    def forget(self, posix):
+        """
+        Removes a path and everything below it from the known entries.
+        """
+        for known in (self.existing, self.copied or dict()):
+            for path in [p for p in known if p == posix or below(p, posix)]:
+                del known[path]
+
+    def makedirs(self, posix):
+        parts = posix.split('/') if posix else []
+        for i in range(len(parts)):
+            path = '/'.join(parts[:i + 1])
+            if self.existing.get(path) is True:
                 continue
+            if self.existing.get(path) is False:
+                self.target.remove(Path(path))
+                self.forget(path)
+            self.target.mkdir(Path(path))
+            self.existing[path] = True
+            yield DirectoryCreated(Path(path))
+
+    def update(self, posix, uploaded):
+        f_src = self.src / posix
+        if not f_src.exists():
+            return
+        is_dir = f_src.is_dir()
+        if self.ignore_sync.ignored(posix, is_dir=is_dir):
+            return
+        if not is_dir:
+            yield from self.makedirs(posix.rpartition('/')[0])
+            yield from self.put(posix, uploaded)
+            return
+        yield from self.makedirs(posix)
+        for entry, relative, ignored in scan(f_src, self.ignore_sync,
+                                             relative=posix + '/'):
+            if ignored:
+                continue
+            if entry.is_dir():
+                yield from self.makedirs(relative)
+            else:
+                yield from self.put(relative, uploaded)
+
+    def put(self, posix, uploaded):
+        if posix in uploaded:
+            return
+        uploaded.add(posix)
+        f_src = self.src / posix
+        dest = self.dest(posix)
+        if self.manifest:
+            if dest != posix:
+                digest = self.manifest.compiled_digest(self.compiler, f_src,
+                                                       Path(posix))
+            else:
+                digest = self.manifest.host_digest(f_src, Path(posix))
+            if self.existing.get(dest) is False \
+                    and self.copied.get(dest) == digest:
+                return
+        upload = f_src
+        if dest != posix:
+            upload = self.compiler.compile(f_src, posix)
+        if self.existing.get(dest) is True:
+            self.target.rmtree(Path(dest))
+            self.forget(dest)
+        if dest != posix and self.existing.get(posix) is False:
+            # replaced by the precompiled file like in sync()
+            self.target.remove(Path(posix))
+            self.forget(posix)
+            yield FileDeleted(Path(posix))
+        created = dest not in self.existing
+        with METRICS.timer('mpy_sync_phase_seconds', phase='upload'):
+            self.target.put(upload, Path(dest), exists=not created)
+        self.existing[dest] = False
+        if self.manifest:
+            self.copied[dest] = digest
+        if created:
+            yield FileCreated(Path(dest))
+        else:
+            yield FileUpdated(Path(dest))
+
+    def delete(self, posix):
+        for dest in sorted({posix, self.dest(posix)}):
+            yield from self.delete_dest(dest)
+
+    def delete_dest(self, dest):
+        is_dir = self.existing.get(dest)
+        if is_dir is None:
+            return
+        if self.ignore_delete.ignored(dest, is_dir=is_dir):
+            yield Ignored(Path(dest))
+            return
+        if is_dir and contains_ignored(self.existing, self.ignore_delete,
+                                       dest):
+            # the ignored entries are kept, the others deleted one by one
+            for path in sorted(self.existing):
+                if below(path, dest) and '/' not in path[len(dest) + 1:]:
+                    yield from self.delete_dest(path)
+            return
+        if is_dir:
+            self.target.rmtree(Path(dest))
+            yield DirectoryDeleted(Path(dest))
+        else:
+            self.target.remove(Path(dest))
+            yield FileDeleted(Path(dest))
+        self.forget(dest)
+
+    def move(self, old, new, is_dir, uploaded):
+        old_dest = self.dest(old, is_dir)
+        new_dest = self.dest(new, is_dir)
+        if self.ignore_sync.ignored(new, is_dir=is_dir):
+            if not self.ignore_sync.ignored(old, is_dir=is_dir):
+                yield from self.delete(old)
+            return
+        if old_dest not in self.existing \
+                or self.existing[old_dest] != is_dir \
+                or (old_dest == old) != (new_dest == new) \
+                or self.ignore_sync.ignored(old, is_dir=is_dir) \
+                or self.ignore_delete.ignored(old_dest, is_dir=is_dir):
+            # not a plain rename on the target
+            if not self.ignore_sync.ignored(old, is_dir=is_dir):
+                yield from self.delete(old)
+            yield from self.update(new, uploaded)
+            return
+        if new_dest in self.existing:
+            if self.existing[new_dest]:
+                self.target.rmtree(Path(new_dest))
+            else:
+                self.target.remove(Path(new_dest))
+            self.forget(new_dest)
+        yield from self.makedirs(new.rpartition('/')[0])
+        self.target.rename(Path(old_dest), Path(new_dest))
+        for known in (self.existing, self.copied or dict()):
+            for path in [p for p in known
+                         if p == old_dest or below(p, old_dest)]:
+                known[rebase(path, old_dest, new_dest)] = known.pop(path)
+        if is_dir:
+            yield DirectoryMoved(Path(new_dest), Path(old_dest))
+        else:
+            yield FileMoved(Path(new_dest), Path(old_dest))
+
+
+class ScriptRunner(object):
+    """
+    Runs a script on the device in a background thread and writes its
+    output. stop() interrupts the script, e.g. before the next sync.
+    """
+    INTERRUPT_INTERVAL = 0.5
+    SUBMIT_INTERVAL = 0.01
 
-            f_src = src / relative
-            if f_dest.is_file() and not f_src.exists():
-                f_dest.unlink()
-                yield FileDeleted(relative)
-            elif f_dest.is_dir() and not f_src.exists():
-                shutil.rmtree(str(f_dest))
-                yield DirectoryDeleted(relative)
+    def __init__(self, device, script, output=None):
+        self.device = device
+        self.script = script
+        self.output = output
+        self.thread = None
+        self.stopping = False
 
-    config['last_sync'].clear()
-    config['last_sync'][str(time.time())] = None
-    config.write(sync_config_path.open(mode='w'))
+    def __repr__(self):
+        return 'ScriptRunner({}, {})'.format(self.device, self.script)
+
+    def start(self):
+        self.stopping = False
+        self.thread = threading.Thread(target=self.run,
+                                       name='mpy-sync-script', daemon=True)
+        self.thread.start()
+
+    def run(self):
+        try:
+            for text in self.device.stream_file(self.script):
+                self.write(text)
+        except MpyDeviceError as e:
+            if not self.stopping:
+                self.write('{}\n'.format(e))
+
+    def write(self, text):
+        if self.output is not None:
+            self.output.write(text)
+            self.output.flush()
+
+    def stop(self):
+        if self.thread is None:
+            return
+        self.stopping = True
+        while self.thread.is_alive():
+            if self.device.request_interrupt():
+                # repeated in case the script catches the KeyboardInterrupt
+                self.thread.join(self.INTERRUPT_INTERVAL)
+            else:
+                # the script is still submitted
+                self.thread.join(self.SUBMIT_INTERVAL)
+        self.thread = None
+        # discard a CTRL-C which arrived after the script finished
+        self.device.flush()
+        self.device.enter_raw_repl()
+
+
+def watch(src, dest, mode='mtime', board=None, delta=False, compress=None,
+          compiler=None, debounce=0.05, script=None, script_output=None):
+    """
+    Generator which syncs a source-folder like sync() and afterwards keeps
+    the destination in sync with the changes of the source-folder until
+    it is closed.
+
+    Changes are received from inotify (polling on systems without it).
+    Bursts of changes, e.g. of an editor saving a file or of git checkout,
+    are coalesced and applied after debounce seconds without further
+    changes. Only the changed paths are transferred, renames are applied
+    as os.rename on the destination.
+
+    :param src: source-folder
+    :param dest: destination-folder or MpyDevice, see sync()
+    :param mode: 'mtime' or 'hash', see sync() (optional)
+    :param board: MpyDevice the destination-folder belongs to (optional)
+    :param delta: transfer only changed blocks of updated files (optional)
+    :param compress: compress uploads to a device destination (optional)
+    :param compiler: MpyCompiler to upload precompiled .mpy files
+     (optional)
+    :param debounce: seconds without changes which end a burst (optional)
+    :param script: script on the device which is started after the sync
+     and restarted after every change, requires a device which can
+     interrupt commands, see BaseDevice.INTERRUPTIBLE (optional)
+    :param script_output: File-object for the output of the script
+     (optional)
+    :raises: MpyDeviceError: if a script is given and the device cannot
+     interrupt it
+    :return: yields sync operations
+
+.. code-block:: python
+
+        with MpyDevice('/dev/ttyUSB0') as dev:
+            for operation in watch('src/', dev, script='main.py',
+                                   script_output=sys.stdout):
+                print(operation)
+
+    """
+    src = Path(src)
+    target = make_target(dest, board=board, delta=delta, compress=compress)
+    manifest = Manifest(src) if mode == 'hash' else None
+    live = LiveSync(src, target, mode=mode, compiler=compiler,
+                    manifest=manifest)
+    runner = None
+    if script is not None:
+        device = getattr(target, 'device', board)
+        if not getattr(device, 'INTERRUPTIBLE', False):
+            raise MpyDeviceError('{} cannot restart scripts'
+                                 .format(device.__class__.__name__))
+        runner = ScriptRunner(device, script, script_output)
+
+    # changes during the first sync are reported by the watcher
+    with create_watcher(src, live.watch_matcher()) as watcher:
+        yield from sync(src, target, mode=mode, board=board,
+                        compiler=compiler, manifest=manifest)
+        live.refresh()
+        try:
+            while True:
+                if runner is not None:
+                    runner.start()
+                changes = watcher.wait(debounce)
+                if runner is not None:
+                    runner.stop()
+                yield from live.apply(changes)
+        finally:
+            if runner is not None:
+                runner.stop()
+            live.save()
 
 
 if __name__ == '__main__':
     from cli import mpy_sync_parser
     args = mpy_sync_parser.parse_args()
-    for p in sync(args.src, args.dest):
-        print(str(p))
\ No newline at end of file
+    if args.metrics:
+        METRICS.enable()
+    mode = 'hash' if args.hash else 'mtime'
+    compiler = MpyCompiler(args.mpy_cross) if args.compile else None
+    if args.run and not (args.watch and args.device):
+        mpy_sync_parser.error('--run requires --watch and --device')
+    if (args.delta or args.compress) and not args.device:
+        mpy_sync_parser.error('--delta and --compress require --device')
+    if args.device:
+        with MpyDevice(args.dest) as dev:
+            if args.run and not dev.INTERRUPTIBLE:
+                mpy_sync_parser.error('--run requires a serial connection '
+                                      'without mpy_daemon')
+            if args.watch:
+                operations = watch(args.src, dev, mode=mode, delta=args.delta,
+                                   compress=args.compress, compiler=compiler,
+                                   debounce=args.debounce, script=args.run,
+                                   script_output=sys.stdout)
+            else:
+                operations = sync(args.src, dev, mode=mode, delta=args.delta,
+                                  compress=args.compress, compiler=compiler)
+            try:
+                for p in operations:
+                    print(str(p))
+            except KeyboardInterrupt:
+                operations.close()
+            if args.compress:
+                print('Transferred {bytes} bytes, ratio {ratio:.2f}, '
+                      '{throughput:.0f} bytes/s'
+                      .format(**dev.transfer_summary()))
+    else:
+        with ExitStack() as stack:
+            board = None
+            if args.board:
+                board = stack.enter_context(MpyDevice(args.board))
+            if args.watch:
+                operations = watch(args.src, args.dest, mode=mode,
+                                   board=board, compiler=compiler,
+                                   debounce=args.debounce)
+            else:
+                operations = sync(args.src, args.dest, mode=mode,
+                                  board=board, compiler=compiler)
+            try:
+                for p in operations:
+                    print(str(p))
+            except KeyboardInterrupt:
+                operations.close()
+    if args.metrics:
+        METRICS.dump(args.metrics, prometheus=args.metrics.endswith('.prom'))
\ No newline at end of file
@@ -0,0 +1,428 @@
+"""
+Module to watch a source folder for changes.
+
+InotifyWatcher subscribes to the change events of the Linux kernel,
+PollingWatcher compares snapshots of the folder on other systems. Both
+report the changes as Modified, Deleted and Moved with posix paths relative
+to the watched folder. wait() debounces bursts of events, e.g. of an editor
+saving a file or of git checkout, and coalesces them.
+"""
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import time
+
+
+class Change(object):
+    def __init__(self, relative, is_dir=False):
+        self.relative = relative
+        self.is_dir = is_dir
+
+    def __repr__(self):
+        return '{}({}{})'.format(self.__class__.__name__, self.relative,
+                                 '/' if self.is_dir else '')
+
+
+class Modified(Change):
+    """
+    A file was created or written, or a directory was created. The root
+    directory '' is reported if events were lost and everything may
+    have changed.
+    """
+
+
+class Deleted(Change):
+    pass
+
+
+class Moved(Change):
+    def __init__(self, old, relative, is_dir=False):
+        super().__init__(relative, is_dir=is_dir)
+        self.old = old
+
+    def __repr__(self):
+        return '{}({} -> {}{})'.format(self.__class__.__name__, self.old,
+                                       self.relative,
+                                       '/' if self.is_dir else '')
+
+
+def below(relative, directory):
+    return relative.startswith(directory + '/')
+
+
+def rebase(relative, old, new):
+    """
+    :return: relative path with the directory old replaced by new
+    """
+    if relative == old:
+        return new
+    if below(relative, old):
+        return new + relative[len(old):]
+    return relative
+
+
+def coalesce(changes):
+    """
+    Reduces a sequence of changes to the changes needed to reproduce its
+    result: moves in their order, followed by the last modification or
+    deletion of every path. Deleting a directory drops the changes below
+    it, moving a path which was modified in the same sequence becomes a
+    deletion and a modification.
+
+    :param changes: list of Change in the order they happened
+    :return: list of Change
+    """
+    moves = []
+    latest = dict()
+    for change in changes:
+        if isinstance(change, Moved):
+            old, new = change.old, change.relative
+            if isinstance(latest.get(old), Modified):
+                latest = {r: c for r, c in latest.items()
+                          if r != old and not below(r, old)}
+                latest[old] = Deleted(old, change.is_dir)
+                latest[new] = Modified(new, change.is_dir)
+                continue
+            moves.append(change)
+            latest.pop(new, None)
+            latest = {rebase(r, old, new): c for r, c in latest.items()}
+            for r, c in latest.items():
+                c.relative = r
+            continue
+        if isinstance(change, Deleted) and change.is_dir:
+            latest = {r: c for r, c in latest.items()
+                      if not below(r, change.relative)}
+        latest.pop(change.relative, None)
+        latest[change.relative] = change
+    return moves + list(latest.values())
+
+
+class Watcher(object):
+    """
+    Base class of the watchers.
+
+    :param root: folder to watch
+    :param matcher: IgnoreMatcher of the paths not to watch (optional)
+    """
+    MAX_DELAY = 1.0
+
+    def __init__(self, root, matcher=None):
+        self.root = str(root)
+        self.matcher = matcher
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        pass
+
+    def ignored(self, relative, is_dir=False):
+        return self.matcher is not None and relative \
+            and self.matcher.ignored(relative, is_dir=is_dir)
+
+    def read(self, timeout):
+        """
+        :param timeout: seconds to wait for changes, None waits forever
+        :return: list of changes, empty if the timeout passed
+        """
+        raise NotImplementedError()
+
+    def flush(self):
+        """
+        :return: changes held back while waiting for related events
+        """
+        return []
+
+    def wait(self, debounce=0.05, timeout=None):
+        """
+        Waits for changes and collects further changes until none followed
+        for debounce seconds, but not longer than MAX_DELAY seconds.
+
+        :param debounce: seconds without changes which end a burst
+        :param timeout: seconds to wait for the first change, None waits
+         forever
+        :return: coalesced list of changes, empty if the timeout passed
+        """
+        end = None if timeout is None else time.monotonic() + timeout
+        while True:
+            # ignored changes end read() without changes
+            remaining = None if end is None \
+                else max(0.0, end - time.monotonic())
+            changes = self.read(remaining) or self.flush()
+            if changes:
+                break
+            if end is not None and time.monotonic() >= end:
+                return []
+        deadline = time.monotonic() + self.MAX_DELAY
+        while time.monotonic() < deadline:
+            more = self.read(debounce)
+            if not more:
+                break
+            changes.extend(more)
+        changes.extend(self.flush())
+        return coalesce(changes)
+
+
+class InotifyWatcher(Watcher):
+    """
+    Watcher based on the Linux inotify API.
+    Every directory is watched, new directories are added when they are
+    created or moved into the folder.
+    """
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_Q_OVERFLOW = 0x00004000
+    IN_IGNORED = 0x00008000
+    IN_ONLYDIR = 0x01000000
+    IN_ISDIR = 0x40000000
+    IN_NONBLOCK = 0o4000
+    IN_CLOEXEC = 0o2000000
+    MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE \
+        | IN_DELETE | IN_ONLYDIR
+    EVENT = struct.Struct('iIII')
+    READ_SIZE = 64 * 1024
+
+    def __init__(self, root, matcher=None):
+        super().__init__(root, matcher=matcher)
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'),
+                                use_errno=True)
+        self.fd = self.libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self.directories = dict()
+        self.moves = dict()
+        self.add('')
+
+    def __repr__(self):
+        return 'InotifyWatcher({}, {} directories)'.format(
+            self.root, len(self.directories))
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+    def add(self, relative):
+        """
+        Watches a directory and its not ignored subdirectories.
+
+        :param relative: posix path of the directory
+        """
+        path = os.path.join(self.root, relative)
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path),
+                                         self.MASK)
+        if wd < 0:
+            # removed in the meantime
+            return
+        self.directories[wd] = relative
+        try:
+            with os.scandir(path) as it:
+                subdirectories = [e.name for e in it if e.is_dir()]
+        except OSError:
+            return
+        for name in subdirectories:
+            child = relative + '/' + name if relative else name
+            if not self.ignored(child, is_dir=True):
+                self.add(child)
+
+    def events(self, timeout):
+        """
+        :return: list of tuples of mask, cookie and relative path
+        """
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return []
+        data = b''
+        while True:
+            try:
+                data += os.read(self.fd, self.READ_SIZE)
+            except BlockingIOError:
+                break
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, size = self.EVENT.unpack_from(data, offset)
+            offset += self.EVENT.size
+            name = os.fsdecode(data[offset:offset + size].rstrip(b'\0'))
+            offset += size
+            if mask & self.IN_IGNORED:
+                self.directories.pop(wd, None)
+                continue
+            directory = self.directories.get(wd)
+            if directory is None and not mask & self.IN_Q_OVERFLOW:
+                continue
+            relative = directory + '/' + name if directory else name
+            events.append((mask, cookie, relative))
+        return events
+
+    def read(self, timeout):
+        changes = []
+        for mask, cookie, relative in self.events(timeout):
+            is_dir = bool(mask & self.IN_ISDIR)
+            if mask & self.IN_Q_OVERFLOW:
+                changes.append(Modified('', is_dir=True))
+            elif mask & self.IN_MOVED_FROM:
+                self.moves[cookie] = (relative, is_dir)
+            elif mask & self.IN_MOVED_TO:
+                old = self.moves.pop(cookie, None)
+                if is_dir:
+                    self.moved(old and old[0], relative)
+                if old is None:
+                    changes.append(Modified(relative, is_dir))
+                else:
+                    changes.append(Moved(old[0], relative, is_dir))
+            elif mask & self.IN_DELETE:
+                changes.append(Deleted(relative, is_dir))
+            else:
+                if is_dir and not self.ignored(relative, is_dir=True):
+                    # files may have been created before the watch
+                    self.add(relative)
+                changes.append(Modified(relative, is_dir))
+        return [c for c in changes if not self.ignored_change(c)]
+
+    def moved(self, old, new):
+        """
+        Updates the watched directories after a directory was moved.
+        """
+        if old is not None:
+            for wd, relative in list(self.directories.items()):
+                if relative == old or below(relative, old):
+                    self.directories[wd] = rebase(relative, old, new)
+        if old is None or not any(r == new for r in
+                                  self.directories.values()):
+            if not self.ignored(new, is_dir=True):
+                self.add(new)
+
+    def ignored_change(self, change):
+        if isinstance(change, Moved) and not self.ignored(change.old,
+                                                          change.is_dir):
+            return False
+        return self.ignored(change.relative, change.is_dir)
+
+    def flush(self):
+        # a move out of the folder is a deletion
+        changes = []
+        for relative, is_dir in self.moves.values():
+            changes.append(Deleted(relative, is_dir))
+            if is_dir:
+                for wd, r in list(self.directories.items()):
+                    if r == relative or below(r, relative):
+                        self.libc.inotify_rm_watch(self.fd, wd)
+                        del self.directories[wd]
+        self.moves.clear()
+        return [c for c in changes if not self.ignored_change(c)]
+
+
+class PollingWatcher(Watcher):
+    """
+    Watcher which compares snapshots of modification time, size and inode
+    of all files. Moves are detected by the inode.
+    """
+    INTERVAL = 0.25
+
+    def __init__(self, root, matcher=None, interval=INTERVAL):
+        super().__init__(root, matcher=matcher)
+        self.interval = interval
+        self.snapshot = self.scan()
+
+    def __repr__(self):
+        return 'PollingWatcher({}, {} entries)'.format(
+            self.root, len(self.snapshot))
+
+    def scan(self, directory='', snapshot=None):
+        """
+        :return: dict of relative paths and tuples of directory flag,
+         modification time, size and inode
+        """
+        snapshot = dict() if snapshot is None else snapshot
+        try:
+            with os.scandir(os.path.join(self.root, directory)) as it:
+                entries = list(it)
+        except OSError:
+            return snapshot
+        for entry in entries:
+            relative = directory + '/' + entry.name if directory \
+                else entry.name
+            try:
+                is_dir = entry.is_dir()
+                stat = entry.stat()
+            except OSError:
+                continue
+            if self.ignored(relative, is_dir=is_dir):
+                continue
+            snapshot[relative] = (is_dir, stat.st_mtime_ns, stat.st_size,
+                                  stat.st_ino)
+            if is_dir:
+                self.scan(relative, snapshot)
+        return snapshot
+
+    def read(self, timeout):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            changes = self.compare(self.scan())
+            if changes:
+                return changes
+            if deadline is not None and time.monotonic() >= deadline:
+                return []
+            wait = self.interval if deadline is None \
+                else min(self.interval, deadline - time.monotonic())
+            time.sleep(max(0.0, wait))
+
+    def compare(self, snapshot):
+        """
+        :return: changes from the previous to the new snapshot, which
+         becomes the current one
+        """
+        previous, self.snapshot = self.snapshot, snapshot
+        removed = {r: s for r, s in previous.items() if r not in snapshot}
+        added = {r: s for r, s in snapshot.items() if r not in previous}
+        inodes = {(s[0], s[3]): r for r, s in removed.items()}
+
+        changes = []
+        for relative in sorted(added):
+            if relative not in added:
+                # content of a moved directory
+                continue
+            is_dir, _, _, inode = added[relative]
+            old = inodes.pop((is_dir, inode), None)
+            if old is None or old not in removed:
+                continue
+            changes.append(Moved(old, relative, is_dir))
+            del removed[old]
+            del added[relative]
+            if is_dir:
+                # the content moved with the directory
+                for r in [r for r in removed if below(r, old)]:
+                    new = rebase(r, old, relative)
+                    if new in added and added[new][3] == removed[r][3]:
+                        if added[new][1:3] != removed[r][1:3]:
+                            changes.append(Modified(new))
+                        del added[new]
+                        del removed[r]
+        for relative in sorted(removed, reverse=True):
+            changes.append(Deleted(relative, removed[relative][0]))
+        for relative, (is_dir, mtime, size, _) in sorted(snapshot.items()):
+            old = previous.get(relative)
+            if relative in added or old is not None and not is_dir \
+                    and old[1:3] != (mtime, size):
+                changes.append(Modified(relative, is_dir))
+        return changes
+
+
+def create_watcher(root, matcher=None):
+    """
+    :return: InotifyWatcher if the system supports inotify, otherwise
+     PollingWatcher
+    """
+    try:
+        return InotifyWatcher(root, matcher=matcher)
+    except (OSError, AttributeError, TypeError):
+        return PollingWatcher(root, matcher=matcher)
@@ -0,0 +1,21 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from mpy_device import MpyDevice  # noqa: E402
+from mpy_emulator import MpyEmulator  # noqa: E402
+
+
+@pytest.fixture
+def emulator():
+    with MpyEmulator() as emulator:
+        yield emulator
+
+
+@pytest.fixture
+def device(emulator):
+    with MpyDevice(emulator.port) as dev:
+        yield dev
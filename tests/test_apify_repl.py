@@ -0,0 +1,255 @@
+import asyncio
+import contextlib
+import http.client
+import io
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from mpy_device import AsyncApifyRepl, MpyBatchError, MpyDeviceError
+from mpy_device.apify_repl import ApifyRepl
+
+
+class ApifyHandler(BaseHTTPRequestHandler):
+    """
+    Stand-in for the HTTP API of an apify device with a CPython namespace.
+    Records the path and client port of every request.
+    """
+    protocol_version = 'HTTP/1.1'
+    batch = True
+
+    def log_message(self, *args):
+        pass
+
+    def run(self, mode, command):
+        if mode == 'eval':
+            return eval(command, self.server.namespace)
+        with contextlib.redirect_stdout(io.StringIO()) as out:
+            exec(command, self.server.namespace)
+        return out.getvalue()
+
+    def run_batch(self, commands):
+        results = []
+        for command in commands:
+            try:
+                results.append(self.run(command['mode'], command['command']))
+            except Exception as e:
+                results.append({'error': str(e)})
+                break
+        return results
+
+    def respond(self, status, result):
+        content = json.dumps(result).encode()
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(
+            int(self.headers['Content-Length'])).decode())
+        self.server.requests.append((self.path, self.client_address[1]))
+        mode = self.path.rsplit('/', 1)[-1]
+        if mode not in ('exec', 'eval', 'batch') or \
+                (mode == 'batch' and not self.batch):
+            self.respond(404, None)
+            return
+        try:
+            if mode == 'batch':
+                result = self.run_batch(body)
+            else:
+                result = self.run(mode, body)
+        except Exception as e:
+            self.respond(500, str(e))
+            return
+        self.respond(200, result)
+
+
+class NoBatchHandler(ApifyHandler):
+    batch = False
+
+
+class IdleCloseHandler(ApifyHandler):
+    """
+    Closes every connection after the response, like a device dropping
+    idle keep-alive connections without announcing it.
+    """
+    def do_POST(self):
+        super().do_POST()
+        self.close_connection = True
+
+
+class CrashHandler(ApifyHandler):
+    """
+    Runs the command and closes the connection without a response.
+    """
+    def respond(self, status, result):
+        self.close_connection = True
+
+
+class PartialResponseHandler(ApifyHandler):
+    """
+    Runs the command and closes the connection within the response.
+    """
+    def respond(self, status, result):
+        self.send_response(status)
+        self.send_header('Content-Length', '100')
+        self.end_headers()
+        self.wfile.write(b'"trunc')
+        self.close_connection = True
+
+
+@contextlib.contextmanager
+def apify_server(handler):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    server.namespace = dict()
+    server.requests = []
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield server, '127.0.0.1:{}'.format(server.server_address[1])
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+@pytest.fixture
+def server():
+    with apify_server(ApifyHandler) as server:
+        yield server
+
+
+@pytest.fixture
+def device(server):
+    dev = ApifyRepl('127.0.0.1:{}'.format(server[0].server_address[1]))
+    yield dev
+    dev.close()
+
+
+def test_keep_alive(server, device):
+    for i in range(5):
+        assert device.eval('{} * 2'.format(i)) == str(i * 2)
+    assert device.exec('print("out")') == 'out\n'
+    requests = server[0].requests
+    assert len(requests) == 6
+    # all commands were sent over one pooled connection
+    assert len(set(port for _, port in requests)) == 1
+    assert device.round_trips == 6
+
+
+def test_eval_tuple(device):
+    assert device.eval('[1, 2]') == '(1, 2)'
+
+
+def test_batch(server, device):
+    results = device.batch([('exec', 'x = 3'), ('eval', 'x * 2'),
+                            ('exec', 'print(x)')])
+    assert results == ['', '6', '3\n']
+    assert [path for path, _ in server[0].requests] == ['/repl/batch']
+
+
+def test_batch_error(device):
+    with pytest.raises(MpyBatchError) as e:
+        device.batch([('eval', '1'), ('eval', '1 / 0'), ('eval', '2')])
+    assert e.value.index == 1
+    assert e.value.results == ['1']
+    assert 'division' in str(e.value)
+
+
+def test_batch_fallback():
+    with apify_server(NoBatchHandler) as (server, address):
+        dev = ApifyRepl(address)
+        assert dev.batch([('exec', 'y = 4'), ('eval', 'y + 1')]) \
+            == ['', '5']
+        assert not dev.batch_supported
+        assert dev.batch([('eval', 'y')]) == ['4']
+        dev.close()
+        assert [path for path, _ in server.requests] == \
+            ['/repl/batch', '/repl/exec', '/repl/eval', '/repl/eval']
+
+
+def test_batch_fallback_error():
+    with apify_server(NoBatchHandler) as (server, address):
+        dev = ApifyRepl(address)
+        with pytest.raises(MpyBatchError) as e:
+            dev.batch([('eval', '1'), ('exec', 'raise ValueError("bad")')])
+        dev.close()
+    assert e.value.index == 1
+    assert e.value.results == ['1']
+    assert 'bad' in str(e.value)
+
+
+def test_error_status(device):
+    with pytest.raises(MpyDeviceError, match='division'):
+        device.eval('1 / 0')
+    # the connection stays usable after an error response
+    assert device.eval('1') == '1'
+
+
+def test_unknown_mode(device):
+    with pytest.raises(MpyDeviceError, match='Unknown REPL mode'):
+        device.run_cmd('1', mode='compile')
+
+
+def test_retry_idle_connection():
+    with apify_server(IdleCloseHandler) as (server, address):
+        dev = ApifyRepl(address)
+        dev.exec('count = 0')
+        for _ in range(3):
+            dev.exec('count += 1')
+        assert dev.eval('count') == '3'
+        dev.close()
+        # every command ran once, each on a new connection
+        assert len(server.requests) == 5
+        assert len(set(port for _, port in server.requests)) == 5
+
+
+def test_no_retry_on_new_connection():
+    with apify_server(CrashHandler) as (server, address):
+        dev = ApifyRepl(address)
+        with pytest.raises(ConnectionError):
+            dev.exec('count = 1')
+        dev.close()
+        assert len(server.requests) == 1
+
+
+def test_no_retry_after_response_started():
+    with apify_server(PartialResponseHandler) as (server, address):
+        dev = ApifyRepl(address)
+        with pytest.raises(http.client.IncompleteRead):
+            dev.exec('count = 1')
+        dev.close()
+        assert len(server.requests) == 1
+
+
+def test_async_keep_alive_and_retry():
+    async def run(address):
+        dev = AsyncApifyRepl(address)
+        await dev.exec('count = 0')
+        await dev.exec('count += 1')
+        value = await dev.eval('count')
+        await dev.close()
+        return value
+
+    with apify_server(ApifyHandler) as (server, address):
+        assert asyncio.run(run(address)) == '1'
+        assert len(set(port for _, port in server.requests)) == 1
+    with apify_server(IdleCloseHandler) as (server, address):
+        assert asyncio.run(run(address)) == '1'
+        assert len(server.requests) == 3
+
+
+def test_async_no_retry_on_new_connection():
+    async def run(address):
+        dev = AsyncApifyRepl(address)
+        try:
+            await dev.exec('count = 1')
+        finally:
+            await dev.close()
+
+    with apify_server(CrashHandler) as (server, address):
+        with pytest.raises(ConnectionError):
+            asyncio.run(run(address))
+        assert len(server.requests) == 1
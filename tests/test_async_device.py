@@ -0,0 +1,80 @@
+import asyncio
+import os
+
+import pytest
+
+from mpy_device import AsyncSerialRepl, MpyDeviceError
+
+
+def run(emulator, test, **kwargs):
+    async def main():
+        async with AsyncSerialRepl(emulator.port, **kwargs) as dev:
+            return await test(dev)
+    return asyncio.run(main())
+
+
+def test_exec_eval(emulator):
+    async def test(dev):
+        await dev.exec('x = 5')
+        assert await dev.eval('x * 2') == '10'
+        with pytest.raises(MpyDeviceError, match='NameError'):
+            await dev.exec('undefined')
+        assert await dev.batch([('exec', 'print(x)'), ('eval', 'x + 1')]) \
+            == ['5\r\n', '6']
+    run(emulator, test)
+
+
+def test_timeout_interrupts(emulator):
+    async def test(dev):
+        with pytest.raises(asyncio.TimeoutError):
+            await dev.exec('while True:\n    pass', timeout=0.5)
+        assert await dev.eval('"recovered"') == 'recovered'
+    run(emulator, test)
+
+
+@pytest.mark.parametrize('size', [0, 100, 512, 5000])
+@pytest.mark.parametrize('compress', [False, True])
+def test_put_get_file(emulator, tmp_path, size, compress):
+    data = os.urandom(size // 2) + b'b' * (size - size // 2)
+    local = tmp_path / 'local.bin'
+    local.write_bytes(data)
+    back = tmp_path / 'back.bin'
+
+    async def test(dev):
+        assert await dev.put_file(local, '/remote.bin') == size
+        assert await dev.get_file('/remote.bin', back) == size
+    run(emulator, test, compress=compress)
+    with open(os.path.join(emulator.root, 'remote.bin'), 'rb') as f:
+        assert f.read() == data
+    assert back.read_bytes() == data
+
+
+def test_concurrent_transfers(emulator, tmp_path):
+    files = []
+    for i in range(3):
+        local = tmp_path / 'local{}.bin'.format(i)
+        local.write_bytes(os.urandom(3000 + i))
+        files.append(local)
+
+    async def test(dev):
+        await asyncio.gather(*[
+            dev.put_file(local, '/remote{}.bin'.format(i), chunk_size=256)
+            for i, local in enumerate(files)])
+        await asyncio.gather(*[
+            dev.get_file('/remote{}.bin'.format(i),
+                         tmp_path / 'back{}.bin'.format(i), chunk_size=256)
+            for i in range(len(files))])
+    run(emulator, test)
+    for i, local in enumerate(files):
+        with open(os.path.join(emulator.root,
+                               'remote{}.bin'.format(i)), 'rb') as f:
+            assert f.read() == local.read_bytes()
+        assert (tmp_path / 'back{}.bin'.format(i)).read_bytes() \
+            == local.read_bytes()
+
+
+def test_get_missing_file(emulator, tmp_path):
+    async def test(dev):
+        with pytest.raises(MpyDeviceError, match='ENOENT'):
+            await dev.get_file('/missing.bin', tmp_path / 'missing.bin')
+    run(emulator, test)
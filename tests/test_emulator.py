@@ -0,0 +1,134 @@
+import os
+
+import pytest
+
+from mpy_device import MpyDeviceError
+from mpy_device.serial_repl import SerialRepl
+from mpy_emulator import MpyEmulator
+
+
+def test_eval(device):
+    assert device.eval('1 + 2') == '3'
+    assert device.eval('"text"') == 'text'
+
+
+def test_exec_keeps_namespace(device):
+    device.exec('x = 21')
+    assert device.exec('print(x * 2)') == '42\r\n'
+
+
+def test_exec_error(device):
+    with pytest.raises(MpyDeviceError, match='ZeroDivisionError'):
+        device.exec('1 / 0')
+    assert device.eval('"after error"') == 'after error'
+
+
+def test_stream(device):
+    chunks = list(device.stream('for i in range(3):\n    print(i)'))
+    assert ''.join(chunks) == '0\r\n1\r\n2\r\n'
+
+
+def test_raw_paste(emulator, device):
+    command = 'print({!r})'.format('x' * (emulator.window_size * 5))
+    assert device.exec(command).strip() == 'x' * (emulator.window_size * 5)
+    assert device.protocol.raw_paste
+
+
+def test_raw_paste_fallback():
+    with MpyEmulator(raw_paste=False) as emulator:
+        with SerialRepl(emulator.port) as dev:
+            assert dev.eval('1 + 1') == '2'
+            assert not dev.protocol.raw_paste
+            assert dev.exec('print({!r})'.format('y' * 1000)).strip() \
+                == 'y' * 1000
+
+
+def test_raw_paste_disabled_on_host(emulator):
+    with SerialRepl(emulator.port, raw_paste=False) as dev:
+        assert dev.eval('2 * 3') == '6'
+        assert not dev.protocol.raw_paste
+
+
+@pytest.mark.parametrize('size', [0, 1, 511, 512, 513, 5000])
+@pytest.mark.parametrize('compress', [False, True])
+def test_put_get_file(emulator, device, tmp_path, size, compress):
+    data = os.urandom(size // 2) + b'a' * (size - size // 2)
+    local = tmp_path / 'local.bin'
+    local.write_bytes(data)
+    assert device.put_file(local, '/remote.bin', compress=compress) == size
+    with open(os.path.join(emulator.root, 'remote.bin'), 'rb') as f:
+        assert f.read() == data
+
+    back = tmp_path / 'back.bin'
+    assert device.get_file('/remote.bin', back) == size
+    assert back.read_bytes() == data
+
+
+def test_put_file_delta(emulator, device, tmp_path):
+    data = bytearray(os.urandom(8 * device.DELTA_BLOCK_SIZE))
+    local = tmp_path / 'local.bin'
+    local.write_bytes(data)
+    device.put_file(local, '/remote.bin')
+    data[10:20] = b'x' * 10
+    local.write_bytes(data)
+    transferred = device.put_file_delta(local, '/remote.bin')
+    assert transferred == device.DELTA_BLOCK_SIZE
+    with open(os.path.join(emulator.root, 'remote.bin'), 'rb') as f:
+        assert f.read() == data
+
+
+def test_get_missing_file(device, tmp_path):
+    with pytest.raises(MpyDeviceError, match='ENOENT'):
+        device.get_file('/missing.bin', tmp_path / 'missing.bin')
+
+
+@pytest.fixture
+def baudrate_cache(tmp_path, monkeypatch):
+    cache = tmp_path / 'baudrates.json'
+    monkeypatch.setattr(SerialRepl, 'BAUDRATE_CACHE', cache)
+    return cache
+
+
+def test_change_baudrate_rejected(baudrate_cache):
+    with MpyEmulator(max_baudrate=460800) as emulator:
+        with SerialRepl(emulator.port) as dev:
+            assert not dev.change_baudrate(921600)
+            assert dev.serial.baudrate == SerialRepl.DEFAULT_BAUDRATE
+            assert emulator.uart_baudrate == SerialRepl.DEFAULT_BAUDRATE
+            assert dev.eval('1 + 1') == '2'
+            assert dev.change_baudrate(460800)
+            assert dev.eval('2 + 2') == '4'
+
+
+def test_upgrade_baudrate_capped_and_cached(baudrate_cache, monkeypatch):
+    attempts = []
+    change_baudrate = SerialRepl.change_baudrate
+
+    def record(self, baudrate):
+        attempts.append(baudrate)
+        return change_baudrate(self, baudrate)
+
+    monkeypatch.setattr(SerialRepl, 'change_baudrate', record)
+    with MpyEmulator(max_baudrate=921600) as emulator:
+        with SerialRepl(emulator.port, upgrade=True) as dev:
+            assert dev.serial.baudrate == 921600
+            assert emulator.uart_baudrate == 921600
+            assert dev.exec('print({!r})'.format('z' * 2000)).strip() \
+                == 'z' * 2000
+            assert attempts == [2000000, 1500000, 921600]
+        # close() leaves the device at the default rate
+        assert attempts[-1] == SerialRepl.DEFAULT_BAUDRATE
+        assert emulator.uart_baudrate == SerialRepl.DEFAULT_BAUDRATE
+        assert SerialRepl.load_baudrates() == {emulator.port: 921600}
+
+        del attempts[:]
+        with SerialRepl(emulator.port, upgrade=True) as dev:
+            assert dev.serial.baudrate == 921600
+            assert dev.eval('3 + 3') == '6'
+            assert attempts == [921600]
+
+
+def test_request_interrupt_idle(device):
+    # nothing runs, CTRL-C is not sent
+    assert not device.request_interrupt()
+    assert device.eval('1') == '1'
@@ -0,0 +1,53 @@
+import json
+import os
+import socket
+import stat
+import threading
+import time
+
+import pytest
+
+from mpy_daemon import MpyDaemon
+from mpy_device import DaemonDevice
+
+
+@pytest.fixture
+def daemon(tmp_path):
+    daemon = MpyDaemon(str(tmp_path / 'mpy_daemon.sock'))
+    thread = threading.Thread(target=daemon.serve_forever, daemon=True)
+    thread.start()
+    while daemon.server is None or not os.path.exists(daemon.socket_path):
+        time.sleep(0.01)
+    yield daemon
+    daemon.shutdown()
+    thread.join()
+
+
+def test_socket_owner_only(daemon):
+    mode = os.stat(daemon.socket_path).st_mode
+    assert stat.S_ISSOCK(mode)
+    assert stat.S_IMODE(mode) & 0o077 == 0
+
+
+def test_exec(emulator, daemon):
+    with DaemonDevice(emulator.port, socket_path=daemon.socket_path) as dev:
+        dev.exec('x = 3')
+        assert dev.eval('x * 3') == '9'
+
+
+def test_client_disconnect_during_output(emulator, daemon):
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    client.connect(daemon.socket_path)
+    client.sendall(json.dumps({
+        'device': emulator.port, 'method': 'exec', 'output': True,
+        'args': ['import time\nfor i in range(200):\n'
+                 '    print("x" * 1000)\n    time.sleep(0.005)']})
+        .encode() + b'\n')
+    client.recv(1)
+    client.close()
+
+    with DaemonDevice(emulator.port, socket_path=daemon.socket_path) as dev:
+        device = daemon.devices[emulator.port]
+        assert dev.eval('1 + 1') == '2'
+    # the device connection was kept
+    assert daemon.devices[emulator.port] is device
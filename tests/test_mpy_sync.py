@@ -0,0 +1,109 @@
+import io
+import os
+from pathlib import Path
+
+from mpy_sync import ScriptRunner, sync
+
+
+def test_script_runner_restart(emulator, device):
+    with open(os.path.join(emulator.root, 'main.py'), 'w') as f:
+        f.write('import time\n'
+                'while True:\n'
+                '    print("tick")\n'
+                '    time.sleep(0.01)\n')
+    output = io.StringIO()
+    runner = ScriptRunner(device, '/main.py', output)
+    # stopped right after the start, often during the submission
+    for _ in range(10):
+        runner.start()
+        runner.stop()
+    runner.start()
+    while 'tick' not in output.getvalue():
+        runner.thread.join(0.01)
+    runner.stop()
+    assert 'Error' not in output.getvalue()
+    assert device.eval('1 + 1') == '2'
+
+
+def test_script_runner_finished(emulator, device):
+    with open(os.path.join(emulator.root, 'main.py'), 'w') as f:
+        f.write('print("done")\n')
+    output = io.StringIO()
+    runner = ScriptRunner(device, '/main.py', output)
+    runner.start()
+    runner.thread.join()
+    runner.stop()
+    assert output.getvalue() == 'done\r\n'
+    assert device.eval('2 + 2') == '4'
+
+
+class FakeCompiler(object):
+    """
+    Stand-in for MpyCompiler which counts the compiled files.
+    """
+    def __init__(self, output_dir):
+        self.output_dir = output_dir
+        self.compiled = []
+
+    def key(self, source_digest, name):
+        return source_digest + name
+
+    def compile(self, f_src, name):
+        self.compiled.append(name)
+        output = self.output_dir / (name.replace('/', '_') + '.mpy')
+        output.write_bytes(b'M' + Path(f_src).read_bytes())
+        return output
+
+
+def test_sync_reuses_compiled_digests(tmp_path):
+    src = tmp_path / 'src'
+    dest = tmp_path / 'dest'
+    out = tmp_path / 'out'
+    for path in (src, dest, out):
+        path.mkdir()
+    (src / 'app.py').write_text('x = 1\n')
+    (src / 'lib.py').write_text('y = 2\n')
+    compiler = FakeCompiler(out)
+
+    # compiled for the digest and again for the upload, which MpyCompiler
+    # answers from its cache
+    list(sync(src, dest, mode='hash', compiler=compiler))
+    assert sorted(compiler.compiled) == ['app.py', 'app.py',
+                                         'lib.py', 'lib.py']
+    assert (dest / 'app.mpy').read_bytes() == b'Mx = 1\n'
+
+    del compiler.compiled[:]
+    list(sync(src, dest, mode='hash', compiler=compiler))
+    assert compiler.compiled == []
+
+    # touched without changes, the stored digest stays valid
+    os.utime(str(src / 'lib.py'), (0, 0))
+    (src / 'app.py').write_text('x = 3\n')
+    list(sync(src, dest, mode='hash', compiler=compiler))
+    assert compiler.compiled == ['app.py', 'app.py']
+    assert (dest / 'app.mpy').read_bytes() == b'Mx = 3\n'
+
+
+def test_sync_keeps_agent(tmp_path):
+    src = tmp_path / 'src'
+    dest = tmp_path / 'dest'
+    (src / 'lib').mkdir(parents=True)
+    (dest / 'lib' / 'old').mkdir(parents=True)
+    (src / 'main.py').write_text('x = 1\n')
+    (src / 'lib' / '_mpy_agent.py').write_text('source\n')
+    (dest / 'lib' / '_mpy_agent.py').write_text('agent\n')
+    (dest / 'lib' / 'old' / 'a.py').write_text('a\n')
+    (dest / 'lib' / 'b.py').write_text('b\n')
+
+    list(sync(src, dest))
+    assert (dest / 'lib' / '_mpy_agent.py').read_text() == 'agent\n'
+    assert not (dest / 'lib' / 'b.py').exists()
+    assert not (dest / 'lib' / 'old').exists()
+
+    # without lib in the source only the agent is kept
+    (src / 'lib' / '_mpy_agent.py').unlink()
+    (src / 'lib').rmdir()
+    (dest / 'lib' / 'c.py').write_text('c\n')
+    list(sync(src, dest))
+    assert os.listdir(str(dest / 'lib')) == ['_mpy_agent.py']
+    assert (dest / 'main.py').exists()